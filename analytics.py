@@ -0,0 +1,537 @@
+# %%
+# Vectorized analytics over the song library:
+#
+#   columns = catalog.library.columns()
+#   columns.group_by("genre", "duration", "mean")   # average length per genre
+#   columns.histogram("year")                       # songs per year
+#   columns.group_by("album", "duration", "sum", top=10)  # longest albums
+#   catalog.library.similar("S001", 10)              # "play similar"
+#
+# SongColumns is a NumPy mirror of every Song field the queries use:
+# dictionary codes for genre/artist/album (like DictColumn) and integer
+# arrays for duration/year. HashTable keeps it in sync the same way as its
+# attribute indexes, so a query is a bincount or argpartition over arrays
+# instead of a Python loop over the buckets. SimilarSongs is the
+# content-based recommender, a precomputed nearest-neighbour table kept in
+# sync the same way. Kept out of app.py so NumPy is
+# only imported once analytics are actually used.
+import threading
+
+import numpy as np
+
+
+class Codes:
+    # value <-> dense int code
+    def __init__(self, values=()):
+        self.values = list(values)
+        self.codes = {v: i for i, v in enumerate(self.values)}
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+class SongColumns:
+    # One row per song. A deleted song leaves a dead row (alive is False)
+    # that queries mask out; once over half the rows are dead they are
+    # compacted away. A replaced song is overwritten in its row.
+    LABELS = ("genre", "artist", "album")
+    NUMBERS = ("duration", "year")
+    KEYS = LABELS + ("year", "decade")
+    AGGREGATES = ("count", "sum", "mean", "min", "max")
+    MAX_BUCKETS = 10_000
+    DTYPES = {"genre": np.int32, "artist": np.int32, "album": np.int32,
+              "duration": np.int32, "year": np.int32}
+
+    def __init__(self, capacity=1024):
+        self.size = 0  # rows in use, dead ones included
+        self.dead = 0
+        self.labels = {name: Codes() for name in self.LABELS}
+        self.data = {name: np.zeros(capacity, dtype) for name, dtype in self.DTYPES.items()}
+        self.alive = np.zeros(capacity, bool)
+        self.row_of = {}  # song_id -> row, for songs added one by one
+        # rows loaded straight from a SongCatalog are found through the
+        # catalog's own id lookup: base_pos maps catalog row -> our row
+        self._find_base = None
+        self.base_pos = np.zeros(0, np.int64)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.size - self.dead
+
+    def load_catalog(self, catalog, find_id, skip=()):
+        # Bulk load a SongCatalog (or mmap'd SnapshotCatalog) column by
+        # column with no per-row Python work; ids in skip are left dead.
+        n = len(catalog)
+        with self._lock:
+            if self.size:
+                raise ValueError("load_catalog needs empty columns")
+            self._reserve(n)
+            for name, column in (("genre", catalog.genres), ("artist", catalog.artists),
+                                 ("album", catalog.albums)):
+                self.labels[name] = Codes(column.values)
+                self.data[name][:n] = np.frombuffer(column.rows, dtype=np.uint32)
+            self.data["duration"][:n] = np.frombuffer(catalog.durations, dtype=np.uint32)
+            self.data["year"][:n] = np.frombuffer(catalog.years, dtype=np.uint16)
+            self.alive[:n] = True
+            self.size = n
+            self._find_base = find_id
+            self.base_pos = np.arange(n, dtype=np.int64)
+            for song_id in skip:
+                row = find_id(song_id)
+                if row is not None:
+                    self._kill(row)
+
+    def load(self, songs):
+        # new songs are coded in Python but written as whole arrays
+        with self._lock:
+            fresh = {}
+            for song in songs:
+                if song.song_id in fresh or self._row(song.song_id) is None:
+                    fresh[song.song_id] = song
+                else:
+                    self._set(song)
+            n = len(fresh)
+            self._reserve(n)
+            start, stop = self.size, self.size + n
+            songs = fresh.values()
+            for name in self.LABELS:
+                code = self.labels[name].code
+                self.data[name][start:stop] = [code(getattr(s, name)) for s in songs]
+            self.data["duration"][start:stop] = [s.duration for s in songs]
+            self.data["year"][start:stop] = [s.year for s in songs]
+            self.alive[start:stop] = True
+            self.row_of.update(zip(fresh, range(start, stop)))
+            self.size = stop
+
+    def _reserve(self, n):
+        capacity = len(self.alive)
+        if self.size + n <= capacity:
+            return
+        capacity = max(capacity * 2, self.size + n)
+        for name, column in self.data.items():
+            grown = np.zeros(capacity, column.dtype)
+            grown[: self.size] = column[: self.size]
+            self.data[name] = grown
+        alive = np.zeros(capacity, bool)
+        alive[: self.size] = self.alive[: self.size]
+        self.alive = alive
+
+    def _row(self, song_id):
+        row = self.row_of.get(song_id)
+        if row is None and self._find_base is not None:
+            base_row = self._find_base(song_id)
+            if base_row is not None and self.base_pos[base_row] >= 0:
+                row = int(self.base_pos[base_row])
+        return row if row is not None and self.alive[row] else None
+
+    def _set(self, song):
+        row = self._row(song.song_id)
+        if row is None:
+            self._reserve(1)
+            row = self.size
+            self.size += 1
+            self.alive[row] = True
+        self.row_of[song.song_id] = row
+        data = self.data
+        data["genre"][row] = self.labels["genre"].code(song.genre)
+        data["artist"][row] = self.labels["artist"].code(song.artist)
+        data["album"][row] = self.labels["album"].code(song.album)
+        data["duration"][row] = song.duration
+        data["year"][row] = song.year
+
+    def _kill(self, row):
+        self.alive[row] = False
+        self.dead += 1
+
+    def _unset(self, song_id):
+        row = self._row(song_id)
+        if row is not None:
+            self.row_of.pop(song_id, None)
+            self._kill(row)
+
+    def add(self, song):
+        with self._lock:
+            self._set(song)
+
+    def remove(self, song):
+        with self._lock:
+            self._unset(song.song_id)
+            self._maybe_compact()
+
+    def update(self, removed=(), added=()):
+        # a song in both lists is a replacement and keeps its row
+        with self._lock:
+            kept = {song.song_id for song in added}
+            for song in removed:
+                if song.song_id not in kept:
+                    self._unset(song.song_id)
+            for song in added:
+                self._set(song)
+            self._maybe_compact()
+
+    def _maybe_compact(self):
+        if self.dead * 2 <= self.size:
+            return
+        keep = np.flatnonzero(self.alive[: self.size])
+        remap = np.full(self.size + 1, -1, np.int64)  # remap[-1] stays -1
+        remap[keep] = np.arange(len(keep))
+        for name, column in self.data.items():
+            column[: len(keep)] = column[keep]
+        self.alive[: len(keep)] = True
+        self.alive[len(keep) : self.size] = False
+        self.base_pos = remap[self.base_pos]
+        self.row_of = {song_id: int(remap[row]) for song_id, row in self.row_of.items()}
+        self.size = len(keep)
+        self.dead = 0
+
+    def _live(self, *names):
+        # copies of the live rows, so the math runs outside the lock
+        with self._lock:
+            alive = self.alive[: self.size]
+            return [self.data[name][: self.size][alive] for name in names]
+
+    def _keys(self, by, values):
+        # (group number per row, group number -> JSON label)
+        if by in self.LABELS:
+            names = self.labels[by].values
+            return values, lambda code: names[code]
+        if by == "year":
+            return values, int
+        return values // 10, lambda code: int(code) * 10
+
+    def group_by(self, by, value="duration", agg="count", top=None, ascending=False):
+        # One row per group: {"key", "count", agg}. With top, the top-k
+        # groups by agg (largest first unless ascending); otherwise every
+        # group in key order.
+        if by not in self.KEYS:
+            raise ValueError(f"cannot group by {by}; use one of {', '.join(self.KEYS)}")
+        if value not in self.NUMBERS:
+            raise ValueError(f"cannot aggregate {value}; use duration or year")
+        if agg not in self.AGGREGATES:
+            raise ValueError(f"unknown aggregate {agg}; use one of {', '.join(self.AGGREGATES)}")
+        if top is not None and top < 1:
+            raise ValueError("top must be positive")
+        keys, numbers = self._live("year" if by == "decade" else by, value)
+        keys, label = self._keys(by, keys)
+
+        counts = np.bincount(keys)
+        groups = np.flatnonzero(counts)
+        if agg == "count":
+            result = counts
+        elif agg in ("sum", "mean"):
+            result = np.bincount(keys, weights=numbers)
+            if agg == "mean":
+                result = result / np.maximum(counts, 1)
+        else:
+            result = np.full(len(counts), np.iinfo(np.int64).max if agg == "min" else -1, np.int64)
+            (np.minimum if agg == "min" else np.maximum).at(result, keys, numbers)
+
+        if top is not None:
+            scores = result[groups] if not ascending else -result[groups]
+            if top < len(groups):
+                best = np.argpartition(-scores, top - 1)[:top]
+            else:
+                best = np.arange(len(groups))
+            # ties go to the lower code, so results are repeatable
+            groups = groups[best[np.lexsort((groups[best], -scores[best]))]]
+        elif by in self.LABELS:
+            groups = groups[np.argsort([label(code) for code in groups], kind="stable")]
+
+        as_number = float if agg == "mean" else int
+        return [
+            {"key": label(code), "count": int(counts[code]), agg: as_number(result[code])}
+            for code in groups
+        ]
+
+    def histogram(self, field, width=1):
+        # counts in [start, start + width) buckets from the smallest value
+        # to the largest, empty buckets included
+        if field not in self.NUMBERS:
+            raise ValueError(f"no histogram for {field}; use duration or year")
+        if width < 1:
+            raise ValueError("width must be positive")
+        (numbers,) = self._live(field)
+        if not len(numbers):
+            return []
+        first = int(numbers.min()) // width
+        if int(numbers.max()) // width - first >= self.MAX_BUCKETS:
+            raise ValueError(f"over {self.MAX_BUCKETS} buckets; use a larger width")
+        counts = np.bincount(numbers // width - first)
+        return [
+            {"start": (first + i) * width, "end": (first + i + 1) * width, "count": int(c)}
+            for i, c in enumerate(counts)
+        ]
+
+
+class SimilarSongs:
+    # Content-based "songs like this one". A song's feature vector is
+    # one-hot genre, artist and album plus year / YEAR_SCALE and
+    # duration / DURATION_SCALE; similarity is the weighted dot product of
+    # the one-hot parts minus the distance between the numeric ones,
+    # computed from the codes without building the one-hot matrices.
+    #
+    # Each row keeps its K best neighbours (ids and scores, best first).
+    # build() fills them BATCH rows at a time with matrix ops: every song
+    # is scored against all songs when the library is small, otherwise
+    # against the songs next to it when sorted by (genre, year, duration),
+    # (artist, album, year) and (album, year), which is where close
+    # neighbours sit. Afterwards a new song is scored once against the
+    # songs it could matter to, which gives its own list and enters it
+    # into the lists it beats. Deleted rows are skipped when read; a list that runs short is
+    # recomputed exactly from all rows.
+    WEIGHTS = {"genre": 1.0, "artist": 2.0, "album": 3.0}
+    YEAR_SCALE = 10.0  # a decade apart costs as much as a different genre
+    DURATION_SCALE = 120.0
+    K = 16
+    WINDOW = 16  # candidates on each side of a song in each sort order
+    EXACT = 4096  # libraries up to this size are scored all-pairs
+    BATCH = 2048
+    REBUILD = 512  # add this many songs at once and it is cheaper to rebuild
+
+    def __init__(self):
+        self.size = 0
+        self.dead = 0
+        self.ids = []  # row -> song_id
+        self.row_of = {}
+        self.labels = {name: Codes() for name in self.WEIGHTS}
+        self.data = {}
+        self.alive = np.zeros(0, bool)
+        self.neighbors = np.zeros((0, self.K), np.int32)  # -1 is an empty slot
+        self.scores = np.zeros((0, self.K), np.float32)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.size - self.dead
+
+    def build(self, songs):
+        with self._lock:
+            songs = list({song.song_id: song for song in songs}.values())
+            n = self.size = len(songs)
+            self.dead = 0
+            self.ids = [song.song_id for song in songs]
+            self.row_of = {song_id: row for row, song_id in enumerate(self.ids)}
+            self.labels = {name: Codes() for name in self.WEIGHTS}
+            self.data = {
+                name: np.array([self.labels[name].code(getattr(s, name)) for s in songs], np.int32)
+                for name in self.WEIGHTS
+            }
+            self.data["year"] = np.array([s.year for s in songs], np.float32)
+            self.data["duration"] = np.array([s.duration for s in songs], np.float32)
+            self.alive = np.ones(n, bool)
+            self.neighbors = np.full((n, self.K), -1, np.int32)
+            self.scores = np.full((n, self.K), -np.inf, np.float32)
+
+            windows = None
+            if n > self.EXACT:
+                d = self.data
+                orders = [
+                    np.lexsort((d["duration"], d["year"], d["genre"])),
+                    np.lexsort((d["year"], d["album"], d["artist"])),
+                    np.lexsort((d["year"], d["album"])),
+                ]
+                positions = []
+                for order in orders:
+                    position = np.empty(n, np.int64)
+                    position[order] = np.arange(n)
+                    positions.append(position)
+                steps = np.arange(-self.WINDOW, self.WINDOW + 1)
+                windows = (orders, positions, steps)
+            for start in range(0, n, self.BATCH):
+                rows = np.arange(start, min(start + self.BATCH, n))
+                if windows is None:
+                    candidates = np.broadcast_to(np.arange(n), (len(rows), n))
+                else:
+                    orders, positions, steps = windows
+                    candidates = np.concatenate(
+                        [
+                            order[np.clip(position[rows, None] + steps, 0, n - 1)]
+                            for order, position in zip(orders, positions)
+                        ],
+                        axis=1,
+                    )
+                    candidates.sort(axis=1)
+                self.neighbors[rows], self.scores[rows] = self._best(rows, candidates)
+
+    def _score(self, rows, candidates):
+        # rows (B, 1) against candidates (B, C) -> (B, C) similarity
+        d = self.data
+        score = np.zeros(candidates.shape, np.float32)
+        for name, weight in self.WEIGHTS.items():
+            score += (d[name][candidates] == d[name][rows]) * np.float32(weight)
+        score -= np.abs(d["year"][candidates] - d["year"][rows]) / np.float32(self.YEAR_SCALE)
+        score -= np.abs(d["duration"][candidates] - d["duration"][rows]) / np.float32(
+            self.DURATION_SCALE
+        )
+        return score
+
+    def _best(self, rows, candidates, k=None, skip=None, score=None):
+        # top k candidates per row, best first, as (rows, scores) padded with
+        # -1 / -inf; candidates must be sorted per row (repeats are dropped)
+        k = k or self.K
+        rows = rows[:, None]
+        score = self._score(rows, candidates) if score is None else score.copy()
+        drop = (candidates == rows) | ~self.alive[candidates]
+        drop[:, 1:] |= candidates[:, 1:] == candidates[:, :-1]
+        if skip is not None:
+            drop |= skip[candidates]
+        score[drop] = -np.inf
+        if candidates.shape[1] > k:
+            top = np.argpartition(-score, k - 1, axis=1)[:, :k]
+        else:
+            top = np.broadcast_to(np.arange(candidates.shape[1]), (len(rows), candidates.shape[1]))
+        top_scores = np.take_along_axis(score, top, axis=1)
+        # best first, ties to the lower row so results are repeatable
+        top_rows = np.take_along_axis(candidates, top, axis=1)
+        order = np.lexsort((top_rows, -top_scores), axis=1)
+        top_rows = np.take_along_axis(top_rows, order, axis=1).astype(np.int32)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+        top_rows[np.isneginf(top_scores)] = -1
+        if top_rows.shape[1] < k:
+            pad = k - top_rows.shape[1]
+            top_rows = np.pad(top_rows, ((0, 0), (0, pad)), constant_values=-1)
+            top_scores = np.pad(top_scores, ((0, 0), (0, pad)), constant_values=-np.inf)
+        return top_rows, top_scores
+
+    def _everyone(self, row, k=None, skip=None):
+        # exact: one row against every row
+        candidates = np.arange(self.size)[None, :]
+        return self._best(np.array([row]), candidates, k, skip)
+
+    def _grow(self):
+        capacity = len(self.alive)
+        if self.size < capacity:
+            return
+        capacity = max(capacity * 2, 1024)
+
+        def grown(column, fill):
+            bigger = np.full((capacity,) + column.shape[1:], fill, column.dtype)
+            bigger[: self.size] = column[: self.size]
+            return bigger
+
+        self.data = {name: grown(column, 0) for name, column in self.data.items()}
+        self.alive = grown(self.alive, False)
+        self.neighbors = grown(self.neighbors, -1)
+        self.scores = grown(self.scores, -np.inf)
+
+    def _add(self, song):
+        self._remove(song.song_id)
+        self._grow()
+        row = self.size
+        self.size += 1
+        self.ids.append(song.song_id)
+        self.row_of[song.song_id] = row
+        for name in self.WEIGHTS:
+            self.data[name][row] = self.labels[name].code(getattr(song, name))
+        self.data["year"][row] = song.year
+        self.data["duration"][row] = song.duration
+        self.alive[row] = True
+
+        # One pass over the rows for both the new song's own neighbours and
+        # the lists it gets into. A song sharing no genre, artist or album
+        # with it scores at most 0, so once its own K-th best and every
+        # kept list's worst are above 0 only the songs sharing one count.
+        size, d = self.size, self.data
+        shared = d["genre"][:size] == d["genre"][row]
+        for name in ("artist", "album"):
+            shared |= d[name][:size] == d[name][row]
+        worst = np.min(self.scores[:row, -1], where=self.alive[:row], initial=np.inf)
+        rows = np.flatnonzero(shared) if worst > 0 else np.arange(size)
+        score = self._score(np.array([[row]]), rows[None, :])
+        own = self._best(np.array([row]), rows[None, :], score=score)
+        if not own[1][0, -1] > 0 and len(rows) < size:
+            rows = np.arange(size)
+            score = self._score(np.array([[row]]), rows[None, :])
+            own = self._best(np.array([row]), rows[None, :], score=score)
+        self.neighbors[row], self.scores[row] = own
+
+        score = score[0]
+        better = (score > self.scores[rows, -1]) & self.alive[rows] & (rows != row)
+        better, score = rows[better], score[better]
+        if len(better):
+            neighbors = np.concatenate(
+                [self.neighbors[better], np.full((len(better), 1), row, np.int32)], axis=1
+            )
+            scores = np.concatenate([self.scores[better], score[:, None]], axis=1)
+            order = np.argsort(-scores, axis=1, kind="stable")[:, : self.K]
+            self.neighbors[better] = np.take_along_axis(neighbors, order, axis=1)
+            self.scores[better] = np.take_along_axis(scores, order, axis=1)
+
+    def _remove(self, song_id):
+        row = self.row_of.pop(song_id, None)
+        if row is not None:
+            self.alive[row] = False
+            self.ids[row] = None
+            self.dead += 1
+
+    def add(self, song):
+        with self._lock:
+            self._add(song)
+
+    def remove(self, song):
+        with self._lock:
+            self._remove(song.song_id)
+            self._maybe_compact()
+
+    def update(self, removed=(), added=()):
+        # False when the batch is big enough that the caller should drop
+        # this table and build a new one instead
+        added = list(added)
+        if len(added) > self.REBUILD:
+            return False
+        with self._lock:
+            for song in removed:
+                self._remove(song.song_id)
+            for song in added:
+                self._add(song)
+            self._maybe_compact()
+        return True
+
+    def _maybe_compact(self):
+        if self.dead * 2 <= self.size:
+            return
+        keep = np.flatnonzero(self.alive[: self.size])
+        remap = np.full(self.size + 1, -1, np.int32)  # remap[-1] stays -1
+        remap[keep] = np.arange(len(keep))
+        for column in self.data.values():
+            column[: len(keep)] = column[keep]
+        self.neighbors[: len(keep)] = remap[self.neighbors[keep]]
+        # a deleted neighbour becomes -1 but keeps its score: songs outside
+        # the list still rank below it, so it must not look like a free slot
+        self.scores[: len(keep)] = self.scores[keep]
+        self.alive[: len(keep)] = True
+        self.alive[len(keep) : self.size] = False
+        self.ids = [self.ids[row] for row in keep]
+        self.row_of = {song_id: row for row, song_id in enumerate(self.ids)}
+        self.size = len(keep)
+        self.dead = 0
+
+    def similar(self, song_id, n=10, exclude=()):
+        # up to n song ids most like song_id, best first, none in exclude
+        with self._lock:
+            row = self.row_of.get(song_id)
+            if row is None:
+                return []
+            picks = []
+            for neighbor in self.neighbors[row]:
+                if neighbor < 0 or not self.alive[neighbor]:
+                    continue
+                if self.ids[neighbor] not in exclude:
+                    picks.append(self.ids[neighbor])
+                    if len(picks) == n:
+                        return picks
+
+            # the kept list ran short: refresh it, then score every row
+            # with the exclusions if those are what used it up
+            self.neighbors[row], self.scores[row] = self._everyone(row)
+            if not exclude:
+                picks = [self.ids[i] for i in self.neighbors[row] if i >= 0]
+                if len(picks) >= n or len(picks) == len(self) - 1:
+                    return picks[:n]
+            skip = np.zeros(self.size, bool)
+            skip[[self.row_of[i] for i in exclude if i in self.row_of]] = True
+            rows, _ = self._everyone(row, n, skip)
+            return [self.ids[i] for i in rows[0] if i >= 0]
@@ -1,12 +1,44 @@
 # %%
+import atexit
+import base64
 import csv
-from flask import Flask, render_template, request
+import heapq
+import io
+import json
+import math
+import mmap
+import os
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import weakref
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter, OrderedDict, deque
+from contextlib import closing, contextmanager, nullcontext
+from itertools import islice
+
+from flask import Flask, Response, render_template, request
+from werkzeug.http import parse_accept_header
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks on the state log
+    fcntl = None
 
 
 # ----------------------------------------------------
 # SONG CLASS
 # ----------------------------------------------------
 class Song:
+    __slots__ = ("song_id", "title", "artist", "album", "genre", "duration", "year")
+
     def __init__(self, song_id, title, artist, album, genre, duration, year):
         self.song_id = song_id
         self.title = title
@@ -16,123 +48,1702 @@ class Song:
         self.duration = int(duration)
         self.year = int(year)
 
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
     def __repr__(self):
         return f"[{self.song_id}] {self.title} by {self.artist} ({self.album}, {self.year}) - {self.genre}, {self.duration}s"
 
 
+# ----------------------------------------------------
+# COLUMNAR SONG CATALOG
+# ----------------------------------------------------
+class BlobColumn:
+    # strings packed into one utf-8 buffer, row i is data[offsets[i]:offsets[i+1]]
+    def __init__(self, data=None, offsets=None):
+        self.data = bytearray() if data is None else data
+        self.offsets = array("I", [0]) if offsets is None else offsets
+
+    def append(self, value):
+        self.data += value.encode("utf-8")
+        self.offsets.append(len(self.data))
+
+    def raw(self, row):
+        return self.data[self.offsets[row] : self.offsets[row + 1]]
+
+    def __getitem__(self, row):
+        return bytes(self.raw(row)).decode("utf-8")
+
+
+class DictColumn:
+    # dictionary-encoded strings: each distinct value is stored once
+    def __init__(self, values=None, rows=None):
+        self.values = [] if values is None else values
+        self.codes = {v: i for i, v in enumerate(self.values)}
+        self.rows = array("I") if rows is None else rows
+
+    def append(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        self.rows.append(code)
+
+    def __getitem__(self, row):
+        return self.values[self.rows[row]]
+
+
+class SongCatalog:
+    # Column-oriented alternative to a list of Song objects for big loads.
+    # Rows are turned back into Song objects only when they are read.
+    def __init__(self):
+        self.ids = BlobColumn()
+        self.titles = BlobColumn()
+        self.artists = DictColumn()
+        self.albums = DictColumn()
+        self.genres = DictColumn()
+        self.durations = array("I")
+        self.years = array("H")
+
+    def __len__(self):
+        return len(self.durations)
+
+    def append(self, song_id, title, artist, album, genre, duration, year):
+        self.ids.append(song_id)
+        self.titles.append(title)
+        self.artists.append(artist)
+        self.albums.append(album)
+        self.genres.append(genre)
+        self.durations.append(int(duration))
+        self.years.append(int(year))
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError("catalog row out of range")
+        return Song(
+            self.ids[row],
+            self.titles[row],
+            self.artists[row],
+            self.albums[row],
+            self.genres[row],
+            self.durations[row],
+            self.years[row],
+        )
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+
 # %%
 
 
+# ----------------------------------------------------
+# RANKED FUZZY SEARCH
+# ----------------------------------------------------
+TOKEN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return TOKEN.findall(text.lower())
+
+
+def max_edits(token):
+    # typos tolerated in a token: none for short words and numbers
+    if len(token) < 4 or token.isdigit():
+        return 0
+    return 1 if len(token) < 8 else 2
+
+
+def delete_variants(word, edits):
+    # every string left after deleting up to `edits` characters, word included
+    variants = frontier = {word}
+    for _ in range(edits):
+        frontier = {w[:i] + w[i + 1 :] for w in frontier for i in range(len(w))}
+        variants = variants | frontier
+    return variants
+
+
+def edit_distance(a, b, limit):
+    # optimal string alignment distance (adjacent swaps count as one edit);
+    # gives up with limit + 1 as soon as the answer must exceed limit
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    before, prev = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                cur[j] = min(cur[j], before[j - 2] + 1)
+        if min(cur) > limit:
+            return limit + 1
+        before, prev = prev, cur
+    return prev[-1]
+
+
+def sorted_contains(values, value):
+    i = bisect_left(values, value)
+    return i < len(values) and values[i] == value
+
+
+class SearchIndex:
+    # Inverted index over every text field of a song, kept in sync by
+    # HashTable. Each (term, field) has an array of doc numbers in
+    # ascending order: snapshot rows keep their row number, chained songs
+    # are numbered after them. Deletes only clear the doc's `alive` flag.
+    # Once dead chained docs outnumber live ones a compaction pass starts:
+    # each later write filters dead docs out of the next COMPACT_WORK
+    # posting entries, so no single request pays for the whole index.
+    # Searches skip dead docs anyway, so a pass can stop anywhere. Doc
+    # numbers are never reused, which is what lets postings be cleaned
+    # term by term without renumbering.
+    #
+    # Misspellings are found SymSpell-style: each term is filed under its
+    # delete variants, and a query token matches the terms sharing one of
+    # its own variants, confirmed with edit_distance. The last query token
+    # also matches as a prefix, for search-as-you-type.
+    #
+    # A song scores, per query token, its best weight(field) * idf(term) *
+    # closeness. Every token contributes one of a few such scores, so the
+    # top k come from walking score combinations best-first and
+    # intersecting their postings lazily, without scoring every match.
+    FIELDS = ("title", "artist", "album", "genre")
+    WEIGHTS = (3.0, 2.0, 1.5, 1.0)
+    PREFIX_TERMS = 32  # completions tried for the last token
+    MAX_COMBOS = 500
+    COMPACT_WORK = 50_000  # posting entries filtered per write during a pass
+
+    def __init__(self, base=None):
+        self.base = base
+        self.n_base = len(base) if base is not None else 0
+        self.alive = bytearray(b"\1") * self.n_base
+        self.live = self.n_base
+        self.docs = []  # chained songs; doc number = n_base + position
+        self.doc_of = {}  # song_id -> doc number, chained songs only
+        self.dead_docs = 0  # chained docs died since the last pass started
+        self._compacting = None  # terms the current pass has still to clean
+        self.postings = {}  # term -> [doc array per field]
+        self.deletes = {}  # delete variant -> [terms]
+        self.vocab = None  # sorted terms for prefix matches
+        self._lock = threading.Lock()
+        if base is not None:
+            self._index_base()
+        self.vocab = sorted(self.postings)
+
+    def __len__(self):
+        return self.live
+
+    def _term(self, term):
+        postings = self.postings.get(term)
+        if postings is None:
+            postings = self.postings[term] = [array("I") for _ in self.FIELDS]
+            for variant in delete_variants(term, max_edits(term)):
+                self.deletes.setdefault(variant, []).append(term)
+            if self.vocab is not None:
+                insort(self.vocab, term)
+        return postings
+
+    def _index_base(self):
+        # dictionary-encoded columns are tokenized once per distinct value
+        base = self.base
+        columns = [base.titles, base.artists, base.albums, base.genres]
+        for field, column in enumerate(columns):
+            if isinstance(column, DictColumn):
+                terms = [
+                    [self._term(t)[field] for t in set(tokenize(value))]
+                    for value in column.values
+                ]
+                for row, code in enumerate(column.rows):
+                    for docs in terms[code]:
+                        docs.append(row)
+            else:
+                for row in range(self.n_base):
+                    for t in set(tokenize(column[row])):
+                        self._term(t)[field].append(row)
+
+    def add(self, song):
+        with self._lock:
+            self._add(song)
+            self._compact_step()
+
+    def update(self, removed_ids=(), added=()):
+        # a whole batch under one lock acquisition; artist/album/genre
+        # values repeat, so each distinct value is tokenized once
+        with self._lock:
+            for song_id in removed_ids:
+                self._remove(song_id)
+            terms = {}
+            for song in added:
+                self._add(song, terms)
+            self._compact_step()
+
+    def _add(self, song, terms=None):
+        doc = self.doc_of.get(song.song_id)
+        if doc is not None:
+            old = self.docs[doc - self.n_base]
+            if all(getattr(old, name) == getattr(song, name) for name in self.FIELDS):
+                # same text, nothing to re-index
+                self.docs[doc - self.n_base] = song
+                return
+        self._remove(song.song_id)
+        doc = self.n_base + len(self.docs)
+        self.docs.append(song)
+        self.doc_of[song.song_id] = doc
+        self.alive.append(1)
+        self.live += 1
+        for field, name in enumerate(self.FIELDS):
+            text = getattr(song, name)
+            tokens = terms.get(text) if terms is not None else None
+            if tokens is None:
+                tokens = set(tokenize(text))
+                if terms is not None:
+                    terms[text] = tokens
+            for t in tokens:
+                self._term(t)[field].append(doc)
+
+    def remove(self, song_id):
+        with self._lock:
+            self._remove(song_id)
+            self._compact_step()
+
+    def _remove(self, song_id):
+        doc = self.doc_of.pop(song_id, None)
+        if doc is None and self.base is not None:
+            doc = self.base.find_id(song_id)
+        if doc is None or not self.alive[doc]:
+            return
+        self.alive[doc] = 0
+        self.live -= 1
+        if doc >= self.n_base:
+            self.docs[doc - self.n_base] = None
+            self.dead_docs += 1
+
+    def _compact_step(self):
+        # one slice of a compaction pass, starting one if enough docs died
+        if self._compacting is None:
+            if self.dead_docs <= 1024 or self.dead_docs <= len(self.doc_of):
+                return
+            self._compacting = list(self.postings)
+            self.dead_docs = 0
+        terms, alive, work = self._compacting, self.alive, 0
+        while terms and work < self.COMPACT_WORK:
+            term = terms.pop()
+            fields = self.postings.get(term)
+            if fields is None:
+                continue
+            work += sum(len(docs) for docs in fields)
+            fields = [array("I", [d for d in docs if alive[d]]) for docs in fields]
+            if any(fields):
+                self.postings[term] = fields
+            else:
+                self._drop_term(term)
+        if not terms:
+            self._compacting = None
+
+    def _drop_term(self, term):
+        del self.postings[term]
+        for variant in delete_variants(term, max_edits(term)):
+            terms = self.deletes[variant]
+            terms.remove(term)
+            if not terms:
+                del self.deletes[variant]
+        i = bisect_left(self.vocab, term)
+        if i < len(self.vocab) and self.vocab[i] == term:
+            del self.vocab[i]
+
+    def _song(self, doc):
+        return self.base[doc] if doc < self.n_base else self.docs[doc - self.n_base]
+
+    def _matches(self, token, prefix):
+        # term -> closeness to token, 1.0 for the token itself
+        matches = {token: 1.0} if token in self.postings else {}
+        limit = max_edits(token)
+        for variant in delete_variants(token, limit) if limit else ():
+            for term in self.deletes.get(variant, ()):
+                if term not in matches:
+                    d = edit_distance(token, term, limit)
+                    if d <= limit:
+                        matches[term] = 1.0 - 0.3 * d
+        if prefix and len(token) >= 2:
+            i = bisect_left(self.vocab, token)
+            for term in self.vocab[i : i + self.PREFIX_TERMS]:
+                if not term.startswith(token):
+                    break
+                matches.setdefault(term, 0.5 + 0.3 * len(token) / len(term))
+        return matches
+
+    def _groups(self, token, prefix):
+        # (score, postings) for every field of every matching term, best first
+        groups = []
+        for term, closeness in self._matches(token, prefix).items():
+            fields = self.postings[term]
+            df = sum(len(docs) for docs in fields)
+            if not df:
+                continue
+            idf = math.log(1 + max(self.live, 1) / df)
+            for field, docs in enumerate(fields):
+                if docs:
+                    groups.append((self.WEIGHTS[field] * idf * closeness, docs))
+        groups.sort(key=lambda g: -g[0])
+        return groups
+
+    def search(self, text, k=10):
+        # [(score, song)] best first; tokens matching nothing are ignored
+        tokens = list(dict.fromkeys(tokenize(text)))
+        with self._lock:
+            groups = []
+            for i, token in enumerate(tokens):
+                token_groups = self._groups(token, prefix=i == len(tokens) - 1)
+                if token_groups:
+                    # the last option is "this token doesn't match"
+                    groups.append(token_groups + [(0.0, None)])
+            if not groups:
+                return []
+            return [(score, self._song(doc)) for score, doc in self._top(groups, k)]
+
+    def _top(self, groups, k):
+        # Best-first over combinations (one group per token). A song first
+        # turns up in its best combination, so later repeats are skipped.
+        start = (0,) * len(groups)
+        heap = [(-sum(g[0][0] for g in groups), start)]
+        visited = {start}
+        seen, results, alive = set(), [], self.alive
+        combos = 0
+        while heap and len(results) < k and combos < self.MAX_COMBOS:
+            neg_score, combo = heapq.heappop(heap)
+            combos += 1
+            postings = [groups[t][i][1] for t, i in enumerate(combo)]
+            postings = sorted((p for p in postings if p is not None), key=len)
+            if postings:
+                driver, rest = postings[0], postings[1:]
+                for doc in driver:
+                    if doc in seen or not alive[doc]:
+                        continue
+                    if all(sorted_contains(p, doc) for p in rest):
+                        seen.add(doc)
+                        results.append((-neg_score, doc))
+                        if len(results) == k:
+                            break
+            for t, i in enumerate(combo):
+                if i + 1 < len(groups[t]):
+                    step = combo[:t] + (i + 1,) + combo[t + 1 :]
+                    if step not in visited:
+                        visited.add(step)
+                        drop = groups[t][i][0] - groups[t][i + 1][0]
+                        heapq.heappush(heap, (neg_score + drop, step))
+        return results
+
+
+# ----------------------------------------------------
+# SORTED ATTRIBUTE INDEXES
+# ----------------------------------------------------
+class SortedIndex:
+    # (value, song_id) pairs in order. Pairs live in chunks of at most
+    # 2 * LOAD so an insert only shifts one chunk, and `maxes` holds each
+    # chunk's last pair to pick a chunk by bisect. Inside a chunk values
+    # and ids are parallel sequences (int values pack into an array); a
+    # pair is found by bisecting on the value, then on song_id within the
+    # run of equal values. Positions are (chunk, offset) tuples.
+    LOAD = 1000
+
+    def __init__(self, typecode=None):
+        self.typecode = typecode
+        self.chunks = []  # [values, ids] per chunk
+        self.maxes = []
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _values(self, values):
+        return array(self.typecode, values) if self.typecode else list(values)
+
+    def load(self, pairs):
+        pairs = sorted(pairs)
+        self.chunks = [
+            [self._values(v for v, _ in part), [song_id for _, song_id in part]]
+            for part in (pairs[i : i + self.LOAD] for i in range(0, len(pairs), self.LOAD))
+        ]
+        self.maxes = [(values[-1], ids[-1]) for values, ids in self.chunks]
+        self.size = len(pairs)
+
+    def __iter__(self):
+        for values, ids in self.chunks:
+            yield from zip(values, ids)
+
+    def _locate(self, value, song_id):
+        # where the pair is, or would be inserted
+        if not self.chunks:
+            return 0, 0
+        c = min(bisect_left(self.maxes, (value, song_id)), len(self.chunks) - 1)
+        values, ids = self.chunks[c]
+        lo = bisect_left(values, value)
+        hi = bisect_right(values, value, lo)
+        return c, bisect_left(ids, song_id, lo, hi)
+
+    def add(self, value, song_id):
+        if not self.chunks:
+            self.chunks.append([self._values([value]), [song_id]])
+            self.maxes.append((value, song_id))
+            self.size += 1
+            return
+        c, i = self._locate(value, song_id)
+        values, ids = self.chunks[c]
+        values.insert(i, value)
+        ids.insert(i, song_id)
+        self.maxes[c] = (values[-1], ids[-1])
+        self.size += 1
+        if len(ids) > 2 * self.LOAD:
+            half = len(ids) // 2
+            self.chunks[c + 1 : c + 1] = [[values[half:], ids[half:]]]
+            del values[half:], ids[half:]
+            self.maxes[c : c + 1] = [(values[-1], ids[-1]), self.maxes[c]]
+
+    def remove(self, value, song_id):
+        c, i = self._locate(value, song_id)
+        if not self.chunks:
+            return
+        values, ids = self.chunks[c]
+        if i == len(ids) or ids[i] != song_id or values[i] != value:
+            return
+        del values[i], ids[i]
+        self.size -= 1
+        if ids:
+            self.maxes[c] = (values[-1], ids[-1])
+        else:
+            del self.chunks[c], self.maxes[c]
+
+    def _normal(self, c, i):
+        # the end of a chunk is the start of the next one
+        if c < len(self.chunks) and i == len(self.chunks[c][1]):
+            return c + 1, 0
+        return c, i
+
+    def span(self, lo=None, hi=None, after=None):
+        # (start, stop) positions of the pairs with lo <= value <= hi,
+        # starting past the pair `after` (which need not still be here)
+        def value_of(pair):
+            return pair[0]
+
+        start = (0, 0)
+        if lo is not None:
+            c = bisect_left(self.maxes, lo, key=value_of)
+            if c < len(self.chunks):
+                start = self._normal(c, bisect_left(self.chunks[c][0], lo))
+            else:
+                start = (c, 0)
+        stop = (len(self.chunks), 0)
+        if hi is not None:
+            c = bisect_right(self.maxes, hi, key=value_of)
+            if c < len(self.chunks):
+                stop = self._normal(c, bisect_right(self.chunks[c][0], hi))
+        if after is not None:
+            c, i = self._locate(*after)
+            if self.chunks and i < len(self.chunks[c][1]) and self.chunks[c][1][i] == after[1]:
+                i += 1
+            start = max(start, self._normal(c, i))
+        return start, max(start, stop)
+
+    def rank(self, position):
+        c, i = position
+        return sum(len(ids) for _, ids in self.chunks[:c]) + i
+
+    def pairs(self, start, stop, limit):
+        # up to `limit` (value, song_id) pairs from start, before stop
+        out = []
+        c, i = start
+        while (c, i) < stop and len(out) < limit:
+            values, ids = self.chunks[c]
+            end = len(ids) if c < stop[0] else stop[1]
+            end = min(end, i + limit - len(out))
+            out.extend(zip(values[i:end], ids[i:end]))
+            c, i = self._normal(c, end)
+        return out
+
+
+def decade(year):
+    return year // 10 * 10
+
+
+class AttributeIndex:
+    # Sorted indexes on year, duration and genre (lower-cased) plus facet
+    # counts per genre, artist and decade, kept in sync by HashTable.
+    # Readers take the lock one batch at a time, so a long result never
+    # holds up writers.
+    BATCH = 256
+
+    def __init__(self):
+        self.indexes = {
+            "year": SortedIndex("i"),
+            "duration": SortedIndex("i"),
+            "genre": SortedIndex(),
+        }
+        self.facets = {"genre": Counter(), "artist": Counter(), "decade": Counter()}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def keys(song):
+        return {"year": song.year, "duration": song.duration, "genre": song.genre.lower()}
+
+    def load(self, songs):
+        pairs = {name: [] for name in self.indexes}
+        with self._lock:
+            for song in songs:
+                for name, value in self.keys(song).items():
+                    pairs[name].append((value, song.song_id))
+                self._count(song, 1)
+            for name, index in self.indexes.items():
+                index.load(pairs[name])
+
+    def _count(self, song, delta):
+        for name, key in (
+            ("genre", song.genre),
+            ("artist", song.artist),
+            ("decade", decade(song.year)),
+        ):
+            counter = self.facets[name]
+            counter[key] += delta
+            if counter[key] <= 0:
+                del counter[key]
+
+    def add(self, song):
+        with self._lock:
+            for name, value in self.keys(song).items():
+                self.indexes[name].add(value, song.song_id)
+            self._count(song, 1)
+
+    def update(self, removed=(), added=()):
+        # A batch under one lock; a song in both lists is a replacement and
+        # only moves in the indexes whose value changed. Small batches go
+        # pair by pair; once a batch is a sizeable share of the index, one
+        # merge and re-chunk of each sorted index is cheaper.
+        with self._lock:
+            for song in removed:
+                self._count(song, -1)
+            for song in added:
+                self._count(song, 1)
+            old = {song.song_id: self.keys(song) for song in removed}
+            new = {song.song_id: self.keys(song) for song in added}
+            rebuild = len(old) + len(new) > len(self.indexes["year"]) // 8
+            for name, index in self.indexes.items():
+                gone = [
+                    (keys[name], song_id)
+                    for song_id, keys in old.items()
+                    if song_id not in new or new[song_id][name] != keys[name]
+                ]
+                new_pairs = [
+                    (keys[name], song_id)
+                    for song_id, keys in new.items()
+                    if song_id not in old or old[song_id][name] != keys[name]
+                ]
+                if rebuild:
+                    gone = set(gone)
+                    index.load([pair for pair in index if pair not in gone] + new_pairs)
+                else:
+                    for value, song_id in gone:
+                        index.remove(value, song_id)
+                    for value, song_id in new_pairs:
+                        index.add(value, song_id)
+
+    def remove(self, song):
+        with self._lock:
+            for name, value in self.keys(song).items():
+                self.indexes[name].remove(value, song.song_id)
+            self._count(song, -1)
+
+    def count(self, name, lo=None, hi=None):
+        with self._lock:
+            index = self.indexes[name]
+            start, stop = index.span(lo, hi)
+            return index.rank(stop) - index.rank(start)
+
+    def iter_ids(self, name, lo=None, hi=None, after=None):
+        # (value, song_id) in order; each batch re-finds its place by bisect
+        index = self.indexes[name]
+        while True:
+            with self._lock:
+                start, stop = index.span(lo, hi, after)
+                batch = index.pairs(start, stop, self.BATCH)
+            if not batch:
+                return
+            yield from batch
+            after = batch[-1]
+
+    def facet_counts(self, top=None):
+        with self._lock:
+            return {
+                name: dict(counter.most_common(top))
+                for name, counter in self.facets.items()
+            }
+
+
 # ----------------------------------------------------
 # HASH TABLE FOR SONG LIBRARY
 # ----------------------------------------------------
+class RWLock:
+    # Many readers or one writer. A waiting writer blocks new readers so
+    # writers can't starve. Not reentrant: never take it twice in one thread.
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+def djb2(key):
+    h = 5381
+    for c in key:
+        h = h * 33 + ord(c)
+    return h
+
+
 class HashNode:
-    def __init__(self, key, value):
+    def __init__(self, key, value, h):
         self.key = key
         self.value = value
+        self.hash = h
         self.next = None
 
 
-class HashTable:
-    def __init__(self, size=100):
-        self.size = size
-        self.table = [None] * size
+class TitleIndex:
+    # normalized title -> {song_id: song}, kept in sync by HashTable.
+    # Each distinct title is also split into trigrams so substring queries
+    # only look at titles sharing every trigram of the query.
+    GRAM = 3
 
-    def _hash(self, key):
-        h = 5381
-        for c in key:
-            h = h * 33 + ord(c)
-        return h % self.size
+    def __init__(self):
+        self.titles = {}
+        self.grams = {}  # trigram -> {normalized title: None}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(title):
+        return title.strip().lower()
+
+    @classmethod
+    def trigrams(cls, text):
+        return {text[i : i + cls.GRAM] for i in range(len(text) - cls.GRAM + 1)}
+
+    def add(self, song):
+        with self._lock:
+            self._add(song)
+
+    def remove(self, song):
+        with self._lock:
+            self._remove(song)
+
+    def update(self, removed=(), added=()):
+        # a whole batch under one lock acquisition
+        with self._lock:
+            for song in removed:
+                self._remove(song)
+            for song in added:
+                self._add(song)
+
+    def _add(self, song):
+        key = self.normalize(song.title)
+        bucket = self.titles.get(key)
+        if bucket is None:
+            bucket = self.titles[key] = {}
+            for gram in self.trigrams(key):
+                self.grams.setdefault(gram, {})[key] = None
+        bucket[song.song_id] = song
+
+    def _remove(self, song):
+        key = self.normalize(song.title)
+        bucket = self.titles.get(key)
+        if bucket is None:
+            return
+        bucket.pop(song.song_id, None)
+        if bucket:
+            return
 
-    def insert(self, key, value):
-        index = self._hash(key)
-        node = self.table[index]
+        del self.titles[key]
+        for gram in self.trigrams(key):
+            titles = self.grams.get(gram)
+            if titles is not None:
+                titles.pop(key, None)
+                if not titles:
+                    del self.grams[gram]
+
+    def lookup(self, title):
+        with self._lock:
+            bucket = self.titles.get(self.normalize(title))
+            return list(bucket.values()) if bucket else []
+
+    def candidates(self, partial):
+        # titles that may contain `partial`; short queries can't use trigrams
+        if len(partial) < self.GRAM:
+            return self.titles
+
+        postings = []
+        for gram in self.trigrams(partial):
+            titles = self.grams.get(gram)
+            if not titles:
+                return []
+            postings.append(titles)
+
+        postings.sort(key=len)
+        first, rest = postings[0], postings[1:]
+        return [t for t in first if all(t in p for p in rest)]
+
+    def lookup_partial(self, partial):
+        with self._lock:
+            partial = partial.strip().lower()
+            matches = []
+            for key in self.candidates(partial):
+                if partial in key:
+                    matches.extend(self.titles[key].values())
+            return matches
+
+
+class SearchCache:
+    # Bounded LRU of query -> results with a TTL, for HashTable.find.
+    # Writes invalidate precisely: a song can only appear in the results
+    # of a query that is its id or a substring of its title, so only those
+    # keys are dropped (found by enumerating the title's substrings or by
+    # checking each cached key, whichever is fewer).
+    # `generation` moves on every invalidation; a lookup that started
+    # before a write won't store its possibly stale result.
+    # Memory is bounded by `max_results`, the songs held across all
+    # entries. A result bigger than a 1/16 share of that (a one-letter
+    # partial query on a large library) isn't cached: it would push out
+    # many small entries and is cheap to recompute compared to its size.
+    def __init__(self, max_entries=1024, ttl=60.0, max_results=100_000):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_results = max_results
+        self.max_entry_results = max(1, max_results // 16)
+        self.entries = OrderedDict()  # query -> (expires, results)
+        self.results = 0  # songs held across all entries
+        self.generation = 0
+        self.hits = self.misses = self.evictions = 0
+        self.expirations = self.invalidations = self.oversized = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, query):
+        # (hit, results, generation); pass the generation back to put()
+        with self._lock:
+            entry = self.entries.get(query)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self.entries.move_to_end(query)
+                    self.hits += 1
+                    return True, entry[1], self.generation
+                self._drop(query)
+                self.expirations += 1
+            self.misses += 1
+            return False, None, self.generation
+
+    def put(self, query, results, generation):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            if len(results) > self.max_entry_results:
+                self.oversized += 1
+                return
+            self._drop(query)
+            self.entries[query] = (time.monotonic() + self.ttl, results)
+            self.results += len(results)
+            while (
+                len(self.entries) > self.max_entries
+                or self.results > self.max_results
+            ):
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _drop(self, query):
+        entry = self.entries.pop(query, None)
+        if entry is not None:
+            self.results -= len(entry[1])
+        return entry
+
+    def invalidate(self, song):
+        with self._lock:
+            self.generation += 1
+            self._invalidate(song)
+
+    def invalidate_many(self, songs):
+        # a batch touching more songs than there are entries just drops them all
+        with self._lock:
+            self.generation += 1
+            if len(songs) >= len(self.entries):
+                self.invalidations += len(self.entries)
+                self.entries.clear()
+                self.results = 0
+                return
+            for song in songs:
+                self._invalidate(song)
 
-        if not node:
-            self.table[index] = HashNode(key, value)
+    def _invalidate(self, song):
+        if not self.entries:
             return
+        stale = {song.song_id.lower()}
+        title = TitleIndex.normalize(song.title)
+        n = len(title)
+        if n * (n + 1) // 2 < len(self.entries):
+            stale.update(
+                title[i:j] for i in range(n) for j in range(i + 1, n + 1)
+            )
+        else:
+            stale.update(q for q in self.entries if q in title)
+        for query in stale:
+            if self._drop(query) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self.entries.clear()
+            self.results = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self.entries),
+                "results": self.results,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "oversized": self.oversized,
+            }
+
+
+def stripe_count(size, max_stripes=64):
+    # largest divisor of size up to max_stripes
+    return max(d for d in range(1, max_stripes + 1) if size % d == 0)
 
-        while node.next:
-            if node.key == key:
-                node.value = value
-                return
-            node = node.next
 
-        node.next = HashNode(key, value)
+class HashTable:
+    # Grows/shrinks when the load factor leaves [min_load, max_load].
+    # Rehashing is incremental: the old table is drained a few buckets at a
+    # time on every insert/search/delete, so no single call pays for it.
+    #
+    # A table can also sit on top of a read-only SnapshotCatalog (`base`).
+    # Snapshot songs are read straight from the mapped file; inserts go to
+    # the chains and deletes/replacements of snapshot songs are remembered
+    # in `_shadowed`. `count` and the load factor only cover the chains.
+    #
+    # Locking: bucket b is guarded by stripe b % len(_stripes). Table sizes
+    # are always min_size * 2**k and the stripe count divides min_size, so a
+    # key keeps its stripe in every table and a bucket can be migrated
+    # under a single stripe. Operations hold `_structure` shared; swapping
+    # tables at the start/end of a rehash holds it exclusively.
+    def __init__(
+        self, size=100, max_load=1.0, min_load=0.25, rehash_step=4,
+        cache_size=1024, cache_ttl=60.0, cache_results=100_000,
+    ):
+        self.size = size
+        self.table = [None] * size
+        self.count = 0
+        self.min_size = size
+        self.max_load = max_load
+        self.min_load = min_load
+        self.rehash_step = rehash_step
+        self.titles = TitleIndex()
+        self.cache = SearchCache(cache_size, cache_ttl, cache_results)
+        self.base = None
+        self._shadowed = set()
+        self._ranked = None  # SearchIndex, built by the first ranked search
+        self._attrs = None  # AttributeIndex, built by the first query
+        self._columns = None  # analytics.SongColumns, built by the first analytics call
+        self._similar = None  # analytics.SimilarSongs, built by the first recommendation
+
+        # old table being drained while an incremental rehash is running
+        self._old = None
+        self._old_size = 0
+        self._rehash_pos = 0  # next old bucket to claim
+        self._migrated = 0  # old buckets fully moved
+
+        self._stripes = [threading.Lock() for _ in range(stripe_count(size))]
+        self._structure = RWLock()
+        self._meta = threading.Lock()  # count and rehash progress
+
+    def __len__(self):
+        return self.count + self.base_count()
+
+    @classmethod
+    def from_snapshot(cls, path, size=100):
+        table = cls(size=size)
+        table.base = SnapshotCatalog(path)
+        return table
+
+    def reading(self):
+        # scan() locks bucket by bucket, nothing to hold around it
+        return nullcontext()
+
+    def _stripe(self, h):
+        return self._stripes[h % len(self._stripes)]
+
+    def base_count(self):
+        return len(self.base) - len(self._shadowed) if self.base else 0
+
+    def _base_row(self, key):
+        if self.base is None or key in self._shadowed:
+            return None
+        return self.base.find_id(key)
+
+    def _base_songs(self, rows):
+        base = self.base
+        if not self._shadowed:
+            return [base[row] for row in rows]
+        return [base[row] for row in rows if base.ids[row] not in self._shadowed]
+
+    def songs(self):
+        for song, _ in self.scan():
+            yield song
+
+    def _full_hash(self, key):
+        return djb2(key)
+
+    # ---------------- cursor scan ----------------
+    # A cursor names a bucket in "scan space": the larger of the two tables
+    # while rehashing, otherwise the table itself. A song's scan bucket only
+    # changes when the table is resized, and then (as with Redis SCAN) a
+    # resumed scan may repeat songs but never skips one that stayed put.
+    def _scan_space(self):
+        return max(self.size, self._old_size if self._old is not None else 0)
+
+    def _scan_bucket(self, c, space):
+        tables = [(self.table, self.size)]
+        if self._old is not None:
+            tables.append((self._old, self._old_size))
+        nodes = []
+        for table, size in tables:
+            node = table[c % size]
+            while node:
+                if node.hash % space == c:
+                    nodes.append(node)
+                node = node.next
+        nodes.sort(key=lambda n: n.key)
+        return nodes
+
+    def _scan_start(self, cursor, space):
+        c, last_key = cursor.get("bucket", 0), cursor.get("key")
+        old_space = cursor.get("space", space)
+        if space < old_space:
+            # shrunk: bucket c of the small table holds old buckets
+            # c, c + space, c + 2 * space, ...
+            shift = old_space - space
+            return (c - shift, None) if c >= shift else (0, None)
+        return c, last_key
+
+    def scan(self, cursor=None):
+        # Yields (song, cursor) pairs; scan(cursor) resumes after that song.
+        # Chained songs come first, then rows of the mapped snapshot.
+        cursor = cursor or {}
+        if "row" not in cursor:
+            space = cursor.get("space")
+            c, last_key = cursor.get("bucket", 0), cursor.get("key")
+            while True:
+                with self._structure.read():
+                    current = self._scan_space()
+                    if current != space:
+                        position = {"space": space or current, "bucket": c, "key": last_key}
+                        c, last_key = self._scan_start(position, current)
+                        space = current
+                    if c >= space:
+                        break
+                    with self._stripes[c % len(self._stripes)]:
+                        nodes = self._scan_bucket(c, space)
+                for node in nodes:
+                    if last_key is not None and node.key <= last_key:
+                        continue
+                    yield node.value, {"space": space, "bucket": c, "key": node.key}
+                c += 1
+                last_key = None
+
+        if self.base is None:
+            return
+        for row in range(cursor.get("row", 0), len(self.base)):
+            song = self.base[row]
+            if song.song_id not in self._shadowed:
+                yield song, {"row": row + 1}
 
-    def search(self, key):
-        index = self._hash(key)
-        node = self.table[index]
+    def _hash(self, key):
+        return self._full_hash(key) % self.size
+
+    # ---------------- resizing ----------------
+    def load_factor(self):
+        return self.count / self.size
+
+    def is_rehashing(self):
+        return self._old is not None
+
+    def _start_resize(self, new_size):
+        # caller holds _structure exclusively
+        self._old = self.table
+        self._old_size = self.size
+        self._rehash_pos = 0
+        self._migrated = 0
+        self.size = new_size
+        self.table = [None] * new_size
+
+    def _finish_rehash(self):
+        # caller holds _structure exclusively
+        self._old = None
+        self._old_size = 0
+        self._rehash_pos = 0
+        self._migrated = 0
+
+    def _resize_due(self):
+        if self._old is not None:
+            return self._migrated >= self._old_size
+        return self.count > self.size * self.max_load or (
+            self.size > self.min_size and self.count < self.size * self.min_load
+        )
 
-        while node:
-            if node.key == key:
-                return node.value
-            node = node.next
+    def _maybe_resize(self):
+        # must be called without _structure held
+        if not self._resize_due():
+            return
+        with self._structure.write():
+            if self._old is not None:
+                if self._migrated < self._old_size:
+                    return
+                self._finish_rehash()
+            if self.count > self.size * self.max_load:
+                self._start_resize(self.size * 2)
+            elif self.size > self.min_size and self.count < self.size * self.min_load:
+                self._start_resize(max(self.min_size, self.size // 2))
+
+    def _rehash_some(self, steps=None):
+        # Move up to `steps` non-empty old buckets into the new table.
+        # Caller holds _structure shared; each bucket is claimed under
+        # _meta and moved under its stripe.
+        if self._old is None:
+            return
+        steps = steps or self.rehash_step
+        empty_visits = steps * 10
+        old = self._old
+
+        while steps and empty_visits:
+            with self._meta:
+                if self._rehash_pos >= self._old_size:
+                    return
+                i = self._rehash_pos
+                self._rehash_pos += 1
+
+            with self._stripes[i % len(self._stripes)]:
+                node = old[i]
+                empty = node is None
+                while node:
+                    nxt = node.next
+                    index = node.hash % self.size
+                    node.next = self.table[index]
+                    self.table[index] = node
+                    node = nxt
+                old[i] = None
+
+            with self._meta:
+                self._migrated += 1
+            if empty:
+                empty_visits -= 1
+            else:
+                steps -= 1
+
+    def _find(self, key, h):
+        # returns (table, index, prev, node) or None; checks both tables.
+        # Caller holds _structure shared and the key's stripe.
+        tables = [(self.table, h % self.size)]
+        if self._old is not None:
+            tables.append((self._old, h % self._old_size))
+
+        for table, index in tables:
+            prev = None
+            node = table[index]
+            while node:
+                if node.key == key:
+                    return table, index, prev, node
+                prev, node = node, node.next
         return None
 
-    def search_by_title(self, title):
-        title = title.strip().lower()
-        matches = []
+    def _buckets(self):
+        # caller holds _structure exclusively
+        if self._old is not None:
+            yield from self._old
+        yield from self.table
 
-        for bucket in self.table:
-            node = bucket
+    def _max_chain_length(self):
+        longest = 0
+        for node in self._buckets():
+            length = 0
             while node:
-                if node.value.title.strip().lower() == title:
-                    matches.append(node.value)
+                length += 1
                 node = node.next
+            longest = max(longest, length)
+        return longest
+
+    def max_chain_length(self):
+        with self._structure.write():
+            return self._max_chain_length()
+
+    def _stats(self, longest):
+        return {
+            "count": len(self),
+            "snapshot_count": self.base_count(),
+            "size": self.size,
+            "load_factor": round(self.load_factor(), 3),
+            "max_chain_length": longest,
+            "rehashing": self.is_rehashing(),
+        }
+
+    def stats(self):
+        with self._structure.write():
+            return self._stats(self._max_chain_length())
+
+    # ---------------- operations ----------------
+    def insert(self, key, value):
+        h = self._full_hash(key)
+        replaced = None
+        with self._structure.read():
+            self._rehash_some()
+            with self._stripe(h):
+                found = self._find(key, h)
+                if found:
+                    replaced = found[3].value
+                    self.titles.remove(replaced)
+                    self.titles.add(value)
+                    found[3].value = value
+                    if self._ranked is not None:
+                        self._ranked.add(value)
+                    if self._attrs is not None:
+                        self._attrs.update(removed=[replaced], added=[value])
+                    if self._columns is not None:
+                        self._columns.add(value)
+                    if self._similar is not None:
+                        self._similar.add(value)
+                else:
+                    row = self._base_row(key)
+                    if row is not None:
+                        replaced = self.base[row]
+                        self._shadowed.add(key)
+                        if self._attrs is not None:
+                            self._attrs.remove(replaced)
+                        if self._columns is not None:
+                            self._columns.remove(replaced)
+
+                    index = h % self.size
+                    node = HashNode(key, value, h)
+                    node.next = self.table[index]
+                    self.table[index] = node
+                    self.titles.add(value)
+                    if self._ranked is not None:
+                        self._ranked.add(value)
+                    if self._attrs is not None:
+                        self._attrs.add(value)
+                    if self._columns is not None:
+                        self._columns.add(value)
+                    if self._similar is not None:
+                        self._similar.add(value)
+                    with self._meta:
+                        self.count += 1
+        if replaced is not None:
+            self.cache.invalidate(replaced)
+        self.cache.invalidate(value)
+        if not found:
+            self._maybe_resize()
+
+    def _rehash_now(self, new_size=None):
+        # Finish any running rehash, then optionally resize in one go.
+        # Caller holds _structure exclusively, so no stripes are needed.
+        if self._old is not None:
+            self._rehash_some(self._old_size)
+            self._finish_rehash()
+        if new_size is not None and new_size != self.size:
+            self._start_resize(new_size)
+            self._rehash_some(self._old_size)
+            self._finish_rehash()
+
+    def insert_many(self, items):
+        # Bulk insert/replace of (key, song) pairs; the last one wins for a
+        # repeated key. The batch goes in under one exclusive lock with the
+        # table sized for it up front, then the title/search/attribute
+        # indexes and the cache are each updated once for the whole batch.
+        # Returns the number of new keys (the rest replaced existing songs).
+        items = dict(items)
+        replaced = []
+        nodes = 0
+        with self._structure.write():
+            needed = self.count + len(items)
+            new_size = self.size
+            while needed > new_size * self.max_load:
+                new_size *= 2
+            self._rehash_now(new_size)
+
+            table, size = self.table, self.size
+            for key, value in items.items():
+                h = self._full_hash(key)
+                index = h % size
+                node = table[index]
+                while node and node.key != key:
+                    node = node.next
+                if node:
+                    replaced.append(node.value)
+                    node.value = value
+                    continue
+
+                row = self._base_row(key)
+                if row is not None:
+                    replaced.append(self.base[row])
+                    self._shadowed.add(key)
+                node = HashNode(key, value, h)
+                node.next = table[index]
+                table[index] = node
+                nodes += 1
+            self.count += nodes
+
+            songs = list(items.values())
+            self.titles.update(removed=replaced, added=songs)
+            if self._ranked is not None:
+                self._ranked.update(added=songs)
+            if self._attrs is not None:
+                self._attrs.update(removed=replaced, added=songs)
+            if self._columns is not None:
+                self._columns.update(removed=replaced, added=songs)
+            if self._similar is not None and not self._similar.update(replaced, songs):
+                self._similar = None  # rebuilt on next use, cheaper for a big batch
+            self.cache.invalidate_many(replaced + songs)
+        return len(items) - len(replaced)
+
+    def delete_many(self, keys):
+        # Bulk delete under one exclusive lock, indexes updated once.
+        # Returns the number of songs actually deleted.
+        removed = []
+        with self._structure.write():
+            self._rehash_now()
+            table, size = self.table, self.size
+            for key in dict.fromkeys(keys):
+                h = self._full_hash(key)
+                index = h % size
+                prev, node = None, table[index]
+                while node and node.key != key:
+                    prev, node = node, node.next
+                if node:
+                    if prev:
+                        prev.next = node.next
+                    else:
+                        table[index] = node.next
+                    self.count -= 1
+                    removed.append(node.value)
+                    continue
+                row = self._base_row(key)
+                if row is not None:
+                    self._shadowed.add(key)
+                    removed.append(self.base[row])
+
+            self.titles.update(removed=removed)
+            if self._ranked is not None:
+                self._ranked.update(removed_ids=[song.song_id for song in removed])
+            if self._attrs is not None:
+                self._attrs.update(removed=removed)
+            if self._columns is not None:
+                self._columns.update(removed=removed)
+            if self._similar is not None:
+                self._similar.update(removed=removed)
+            self.cache.invalidate_many(removed)
+        self._maybe_resize()
+        return len(removed)
 
-        return matches
-
-    def search_by_partial_title(self, partial):
-        partial = partial.strip().lower()
-        matches = []
+    def search(self, key):
+        h = self._full_hash(key)
+        with self._structure.read():
+            self._rehash_some()
+            with self._stripe(h):
+                found = self._find(key, h)
+                if found:
+                    return found[3].value
+        self._maybe_resize()
+        row = self._base_row(key)
+        return self.base[row] if row is not None else None
+
+    def find(self, text):
+        # the library search order: id, then exact title, then part of a
+        # title. Results are cached per normalized query and shared between
+        # callers, so they come back as a tuple.
+        query = text.strip().lower()
+        hit, results, generation = self.cache.get(query)
+        if hit:
+            return results
+
+        by_id = self.search(query.upper())
+        if by_id:
+            results = (by_id,)
+        else:
+            results = tuple(
+                self.search_by_title(query) or self.search_by_partial_title(query)
+            )
+        self.cache.put(query, results, generation)
+        return results
 
-        for bucket in self.table:
-            node = bucket
+    def search_index(self):
+        # built on first use, then kept up to date by insert/delete
+        if self._ranked is None:
+            with self._structure.write():
+                if self._ranked is None:
+                    index = SearchIndex(self.base)
+                    for key in self._shadowed:
+                        index.remove(key)
+                    for node in self._buckets():
+                        while node:
+                            index.add(node.value)
+                            node = node.next
+                    self._ranked = index
+        return self._ranked
+
+    def search_ranked(self, text, k=10):
+        # [(score, song)] over title, artist, album and genre, typos allowed
+        return self.search_index().search(text, k)
+
+    def attribute_index(self):
+        # built on first use, then kept up to date by insert/delete
+        if self._attrs is None:
+            with self._structure.write():
+                if self._attrs is None:
+                    index = AttributeIndex()
+                    index.load(self._all_songs())
+                    self._attrs = index
+        return self._attrs
+
+    def columns(self):
+        # NumPy mirror for analytics, built on first use like attribute_index;
+        # base rows are loaded column by column, not song by song
+        if self._columns is None:
+            import analytics
+
+            with self._structure.write():
+                if self._columns is None:
+                    columns = analytics.SongColumns()
+                    if self.base is not None:
+                        columns.load_catalog(self.base, self.base.find_id, self._shadowed)
+                    columns.load(node.value for node in self._nodes())
+                    self._columns = columns
+        return self._columns
+
+    def similar_index(self):
+        # built on first use, then kept up to date by insert/delete
+        if self._similar is None:
+            import analytics
+
+            with self._structure.write():
+                if self._similar is None:
+                    index = analytics.SimilarSongs()
+                    index.build(self._all_songs())
+                    self._similar = index
+        return self._similar
+
+    def similar(self, key, n=10, exclude=()):
+        # songs most like this one, best first, skipping ids in exclude
+        ids = self.similar_index().similar(key, n, exclude)
+        return [song for song in map(self.search, ids) if song]
+
+    def _nodes(self):
+        # caller holds _structure exclusively
+        for node in self._buckets():
             while node:
-                if partial in node.value.title.lower():
-                    matches.append(node.value)
+                yield node
                 node = node.next
 
+    def _all_songs(self):
+        # caller holds _structure exclusively
+        for node in self._nodes():
+            yield node.value
+        if self.base is not None:
+            for row in range(len(self.base)):
+                song = self.base[row]
+                if song.song_id not in self._shadowed:
+                    yield song
+
+    def _filters(self, genre=None, year=None, duration=None):
+        # name -> (lo, hi) for the attribute indexes; either bound may be None
+        filters = {}
+        if genre:
+            filters["genre"] = (genre.lower(), genre.lower())
+        if year and year != (None, None):
+            filters["year"] = tuple(year)
+        if duration and duration != (None, None):
+            filters["duration"] = tuple(duration)
+        return filters
+
+    def query(self, genre=None, year=None, duration=None, cursor=None):
+        # Yields (song, cursor) for songs matching every filter, walking the
+        # most selective index: O(log n) to start, then one step per match
+        # of that index. year/duration are (lo, hi) ranges, inclusive.
+        index = self.attribute_index()
+        filters = self._filters(genre, year, duration)
+        cursor = cursor or {}
+        if not isinstance(cursor, dict):
+            raise ValueError("malformed cursor")
+        by = cursor.get("by")
+        if by is None:
+            by = min(filters, key=lambda name: index.count(name, *filters[name]), default="year")
+        if by not in index.indexes:
+            raise KeyError(f"unknown index {by}")
+        lo, hi = filters.get(by, (None, None))
+        after = tuple(cursor["after"]) if "after" in cursor else None
+        if after is not None and len(after) != 2:
+            raise ValueError("malformed cursor")
+
+        for value, song_id in index.iter_ids(by, lo, hi, after):
+            song = self.search(song_id)
+            if song is None:
+                continue
+            keys = AttributeIndex.keys(song)
+            if all(
+                (f_lo is None or keys[name] >= f_lo) and (f_hi is None or keys[name] <= f_hi)
+                for name, (f_lo, f_hi) in filters.items()
+            ):
+                yield song, {"by": by, "after": [value, song_id]}
+
+    def query_count(self, genre=None, year=None, duration=None):
+        # exact in O(log n) for a single filter, None when filters combine
+        filters = self._filters(genre, year, duration)
+        if len(filters) > 1:
+            return None
+        name, (lo, hi) = next(iter(filters.items()), ("year", (None, None)))
+        return self.attribute_index().count(name, lo, hi)
+
+    def facet_counts(self, top=None):
+        return self.attribute_index().facet_counts(top)
+
+    def search_by_title(self, title):
+        matches = self.titles.lookup(title)
+        if self.base is not None:
+            matches += self._base_songs(self.base.find_title(title))
         return matches
 
-    def delete(self, key):
-        index = self._hash(key)
-        node = self.table[index]
-        prev = None
+    def search_by_partial_title(self, partial):
+        matches = self.titles.lookup_partial(partial)
+        if self.base is not None:
+            matches += self._base_songs(self.base.find_partial_title(partial))
+        return matches
 
-        while node:
-            if node.key == key:
-                if prev:
-                    prev.next = node.next
+    def delete(self, key):
+        h = self._full_hash(key)
+        with self._structure.read():
+            self._rehash_some()
+            with self._stripe(h):
+                found = self._find(key, h)
+                if not found:
+                    row = self._base_row(key)
+                    if row is None:
+                        return False
+                    self._shadowed.add(key)
+                    song = self.base[row]
+                    if self._ranked is not None:
+                        self._ranked.remove(key)
+                    if self._attrs is not None:
+                        self._attrs.remove(song)
+                    if self._columns is not None:
+                        self._columns.remove(song)
+                    if self._similar is not None:
+                        self._similar.remove(song)
                 else:
-                    self.table[index] = node.next
-                return True
-            prev, node = node, node.next
-
-        return False
+                    table, index, prev, node = found
+                    if prev:
+                        prev.next = node.next
+                    else:
+                        table[index] = node.next
+                    self.titles.remove(node.value)
+                    if self._ranked is not None:
+                        self._ranked.remove(key)
+                    if self._attrs is not None:
+                        self._attrs.remove(node.value)
+                    if self._columns is not None:
+                        self._columns.remove(node.value)
+                    if self._similar is not None:
+                        self._similar.remove(node.value)
+                    song = node.value
+                    with self._meta:
+                        self.count -= 1
+        self.cache.invalidate(song)
+        if found:
+            self._maybe_resize()
+        return True
 
     def display_all_songs(self):
-        out = []
-        for bucket in self.table:
-            node = bucket
-            while node:
-                out.append(str(node.value))
-                node = node.next
+        out = [str(song) for song in self.songs()]
         return "\n".join(out) if out else "Library is empty."
 
     def display(self):
-        out = []
-        for i in range(self.size):
-            node = self.table[i]
-            if node:
-                chain = []
-                temp = node
-                while temp:
-                    chain.append(temp.key)
-                    temp = temp.next
-                out.append(f"Bucket {i}: " + " -> ".join(chain))
-        return "\n".join(out) if out else "Hash table is empty."
+        with self._structure.write():
+            out = []
+            tables = [("Bucket", self.table)]
+            if self._old is not None:
+                tables.insert(0, ("Old bucket", self._old))
+
+            for label, table in tables:
+                for i, node in enumerate(table):
+                    if node:
+                        chain = []
+                        temp = node
+                        while temp:
+                            chain.append(temp.key)
+                            temp = temp.next
+                        out.append(f"{label} {i}: " + " -> ".join(chain))
+            if self.base_count():
+                out.append(f"Snapshot: {self.base_count()} songs mapped from disk")
+            if not out:
+                return "Hash table is empty."
+
+            s = self._stats(self._max_chain_length())
+        out.insert(
+            0,
+            f"Songs: {s['count']} | Buckets: {s['size']} | "
+            f"Load factor: {s['load_factor']} | Longest chain: {s['max_chain_length']}",
+        )
+        return "\n".join(out)
+
+
+# %%
+
+
+# ----------------------------------------------------
+# SHUFFLE PLAYBACK
+# ----------------------------------------------------
+SHUFFLE_MODES = ("off", "shuffle", "smart")
+SMART_SPREAD = 3  # smart shuffle avoids the artists of the last few plays
+
+
+class ShuffleCursor:
+    # Lazy Fisher-Yates over range(n). Step i swaps a random slot j >= i
+    # into place i, but only slots that were swapped are remembered (in a
+    # dict), so a step costs O(1) time and memory and no list of n exists.
+    def __init__(self, n, rng):
+        self.n = n
+        self.i = 0
+        self.rng = rng
+        self._swaps = {}
+
+    def done(self):
+        return self.i >= self.n
+
+    def next(self, accept=None, tries=0):
+        # the next index, None once all n are out; a draw accept() turns
+        # down is redrawn, up to `tries` times
+        i = self.i
+        if i >= self.n:
+            return None
+        j = self.rng.randrange(i, self.n)
+        for _ in range(tries):
+            if accept(self._swaps.get(j, j)):
+                break
+            j = self.rng.randrange(i, self.n)
+        value = self._swaps.get(j, j)
+        if j != i:
+            self._swaps[j] = self._swaps.get(i, i)
+        self._swaps.pop(i, None)
+        self.i += 1
+        return value
+
+
+class Shuffle:
+    # One shuffled pass over a LinkedList or Queue, read in place through
+    # their shuffle_range() -> (first slot, stop, version) and slot_song().
+    # The same seed over the same edits gives the same order. "smart"
+    # redraws, a few times at most, a song whose artist is in `avoid` (the
+    # last few played), which spreads an artist out without a lookahead.
+    #
+    # A version change (songs added or removed) restarts the cursor on the
+    # new slots. A playlist keeps its songs as they play, so the pass
+    # remembers the ids played (filled in by the play op, so every worker
+    # agrees) and skips them; a queue drops its songs as they play
+    # (remember=False) and starts another pass for songs queued after
+    # this one began.
+    SMART_TRIES = 8
+
+    def __init__(self, mode, seed=None, remember=True):
+        if mode not in SHUFFLE_MODES[1:]:
+            raise ValueError(f"Unknown shuffle mode: {mode}")
+        self.mode = mode
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.played = set() if remember else None
+        self.cursor = None
+        self.first = self.stop = self.version = None
+
+    def next(self, source, avoid=()):
+        # (slot, song) to play next, or None once the pass is over
+        first, stop, version = source.shuffle_range()
+
+        def artist_apart(index):
+            song = source.slot_song(self.first + index)
+            return song is None or song.artist not in avoid
+
+        accept = artist_apart if self.mode == "smart" and avoid else None
+        while True:
+            if (
+                self.cursor is None
+                or version != self.version
+                or (self.cursor.done() and stop > self.stop)
+            ):
+                self.cursor = ShuffleCursor(stop - first, self.rng)
+                self.first, self.stop, self.version = first, stop, version
+            index = self.cursor.next(accept, self.SMART_TRIES if accept else 0)
+            if index is None:
+                return None
+            song = source.slot_song(self.first + index)
+            if song is None or (self.played is not None and song.song_id in self.played):
+                continue
+            return self.first + index, song
+
+    def to_dict(self):
+        # for state snapshots; the cursor itself restarts after a restore
+        version, internal, gauss = self.rng.getstate()
+        return {
+            "mode": self.mode,
+            "seed": self.seed,
+            "rng": [version, list(internal), gauss],
+            "played": None if self.played is None else list(self.played),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        shuffle = cls(data["mode"], data["seed"], data["played"] is not None)
+        version, internal, gauss = data["rng"]
+        shuffle.rng.setstate((version, tuple(internal), gauss))
+        if data["played"]:
+            shuffle.played.update(data["played"])
+        return shuffle
 
 
 # %%
@@ -144,164 +1755,240 @@ class HashTable:
 class Node:
     def __init__(self, song):
         self.song = song
-        self.next = None
+        # physical [prev, next]; which one is "next" depends on the
+        # playlist's direction flag, see LinkedList
+        self.links = [None, None]
+        self.slot = None  # index in LinkedList._slots
 
 
 class LinkedList:
+    # Doubly linked playlist. `_nodes` maps song_id -> node so lookups,
+    # deletes and reorders never walk the list, and `_rev` selects which
+    # link is "next" so reverse() just flips a flag.
     def __init__(self):
-        self.head = None
+        self._ends = [None, None]  # node with no prev link, node with no next link
+        self._rev = 0
+        self._nodes = {}
+        self.length = 0
+        # normalized title -> {song_id: node}
+        self._titles = {}
+        # every node, in no particular order, for O(1) random access (the
+        # shuffle); a removal moves the last node into the freed slot
+        self._slots = []
+        self.version = 0  # bumped whenever a song is added or removed
+        self.shuffle = None  # the running Shuffle pass, if any
+        # edits take it exclusively, lookups and traversals share it;
+        # hold reading() while iterating the list or a scan()
+        self.lock = RWLock()
+
+    def reading(self):
+        return self.lock.read()
+
+    def __len__(self):
+        return self.length
+
+    def __contains__(self, song_id):
+        return song_id in self._nodes
+
+    def __iter__(self):
+        node = self.head
+        while node:
+            yield node.song
+            node = self.next_node(node)
+
+    @property
+    def head(self):
+        return self._ends[self._rev]
+
+    @property
+    def tail(self):
+        return self._ends[1 - self._rev]
+
+    def next_node(self, node):
+        return node.links[1 - self._rev]
+
+    def prev_node(self, node):
+        return node.links[self._rev]
+
+    def _link(self, node, left, right):
+        # place node between logical neighbours left and right
+        back, fwd = self._rev, 1 - self._rev
+        node.links[back] = left
+        node.links[fwd] = right
+        if left:
+            left.links[fwd] = node
+        else:
+            self._ends[back] = node
+        if right:
+            right.links[back] = node
+        else:
+            self._ends[fwd] = node
+
+    def _unlink(self, node):
+        left, right = node.links
+        if left:
+            left.links[1] = right
+        else:
+            self._ends[0] = right
+        if right:
+            right.links[0] = left
+        else:
+            self._ends[1] = left
+        node.links = [None, None]
+
+    def _add(self, song, left, right):
+        if song.song_id in self._nodes:
+            return None  # callers report the duplicate
+        node = Node(song)
+        self._link(node, left, right)
+        self._nodes[song.song_id] = node
+        node.slot = len(self._slots)
+        self._slots.append(node)
+        self.version += 1
+        key = TitleIndex.normalize(song.title)
+        self._titles.setdefault(key, {})[song.song_id] = node
+        self.length += 1
+        return node
 
     def insert_at_start(self, song):
-        new_node = Node(song)
-        new_node.next = self.head
-        self.head = new_node
+        with self.lock.write():
+            return self._add(song, None, self.head) is not None
 
     def insert_at_end(self, song):
-        new_node = Node(song)
-        if not self.head:
-            self.head = new_node
-            return
-        current = self.head
-        while current.next:
-            current = current.next
-        current.next = new_node
-
-    def delete_song(self, song_id):
-        current = self.head
-        prev = None
-
-        while current and current.song.song_id != song_id:
-            prev = current
-            current = current.next
+        with self.lock.write():
+            return self._add(song, self.tail, None) is not None
 
-        if not current:
-            print("Song not found.")
-            return False
+    def _remove(self, song_id):
+        node = self._nodes.pop(song_id, None)
+        if not node:
+            return None
+        self._unlink(node)
+        key = TitleIndex.normalize(node.song.title)
+        titles = self._titles.get(key, {})
+        titles.pop(song_id, None)
+        if not titles:
+            self._titles.pop(key, None)
+        last = self._slots.pop()
+        if last is not node:
+            self._slots[node.slot] = last
+            last.slot = node.slot
+        self.version += 1
+        self.length -= 1
+        return node
 
-        if not prev:
-            self.head = current.next
+    def delete_song(self, song_id):
+        with self.lock.write():
+            node = self._remove(song_id)
+            if not node:
+                print("Song not found.")
+                return False
+
+            print("Deleted:", node.song.title)
+            return True
+
+    def discard_songs(self, song_ids):
+        # quiet bulk delete for songs leaving the library; ids not in the
+        # playlist are skipped
+        with self.lock.write():
+            return sum(self._remove(song_id) is not None for song_id in song_ids)
+
+    def scan(self, cursor=None):
+        # cursor is the song_id of the last song returned
+        if cursor is None:
+            node = self.head
         else:
-            prev.next = current.next
-
-        print("Deleted:", current.song.title)
-        return True
+            node = self._nodes.get(cursor)
+            if node is None:
+                raise KeyError(f"cursor song {cursor} is no longer in the playlist")
+            node = self.next_node(node)
+        while node:
+            yield node.song, node.song.song_id
+            node = self.next_node(node)
 
     def search(self, song_id):
-        current = self.head
-        while current:
-            if current.song.song_id == song_id:
-                return current.song
-            current = current.next
-        return None
+        with self.lock.read():
+            node = self._nodes.get(song_id)
+            return node.song if node else None
 
     def search_by_title(self, title):
-        title = title.lower()
-        current = self.head
-        results = []
-
-        while current:
-            if current.song.title.lower() == title:
-                results.append(current.song)
-            current = current.next
-
-        return results
+        with self.lock.read():
+            nodes = self._titles.get(TitleIndex.normalize(title), {})
+            return [node.song for node in nodes.values()]
 
     def search_by_partial_title(self, partial):
-        partial = partial.lower()
-        current = self.head
-        results = []
-
-        while current:
-            if partial in current.song.title.lower():
-                results.append(current.song)
-            current = current.next
-
-        return results
+        with self.lock.read():
+            partial = partial.lower()
+            return [song for song in self if partial in song.title.lower()]
 
     def display(self):
-        if not self.head:
-            print("Playlist is empty.")
-            return
-        out = []
-        current = self.head
-        while current:
-            out.append(str(current.song))
-            current = current.next
-        return "\n".join(out)
+        with self.lock.read():
+            if not self.head:
+                print("Playlist is empty.")
+                return
+            return "\n".join(str(song) for song in self)
 
     def insert_after(self, target_id, song):
-        current = self.head
-        while current and current.song.song_id != target_id:
-            current = current.next
-
-        if not current:
-            print("Target song not found.")
-            return False
+        with self.lock.write():
+            target = self._nodes.get(target_id)
+            if not target:
+                print("Target song not found.")
+                return False
 
-        new_node = Node(song)
-        new_node.next = current.next
-        current.next = new_node
-        print(f"Inserted {song.title} after {current.song.title}")
-        return True
+            if not self._add(song, target, self.next_node(target)):
+                return False
+            print(f"Inserted {song.title} after {target.song.title}")
+            return True
 
     def move_up(self, song_id):
-        if not self.head or not self.head.next:
-            return False
-
-        prev = None
-        curr = self.head
-
-        while curr and curr.song.song_id != song_id:
-            prev_prev = prev
-            prev = curr
-            curr = curr.next
-
-        if not curr or not prev:
-            return False
+        with self.lock.write():
+            node = self._nodes.get(song_id)
+            if not node or not self.prev_node(node):
+                return False
 
-        prev.next = curr.next
-        curr.next = prev
-
-        if prev_prev:
-            prev_prev.next = curr
-        else:
-            self.head = curr
-
-        return True
+            prev = self.prev_node(node)
+            self._unlink(node)
+            self._link(node, self.prev_node(prev), prev)
+            return True
 
     def move_down(self, song_id):
-        curr = self.head
-        prev = None
+        with self.lock.write():
+            node = self._nodes.get(song_id)
+            if not node or not self.next_node(node):
+                return False
 
-        while curr and curr.song.song_id != song_id:
-            prev = curr
-            curr = curr.next
+            nxt = self.next_node(node)
+            self._unlink(node)
+            self._link(node, nxt, self.next_node(nxt))
+            return True
 
-        if not curr or not curr.next:
-            return False
-
-        nxt = curr.next
-        curr.next = nxt.next
-        nxt.next = curr
+    def reverse(self):
+        with self.lock.write():
+            self._rev = 1 - self._rev
 
-        if prev:
-            prev.next = nxt
-        else:
-            self.head = nxt
+    def shuffle_range(self):
+        return 0, len(self._slots), self.version
 
-        return True
+    def slot_song(self, slot):
+        return self._slots[slot].song if slot < len(self._slots) else None
 
-    def reverse(self):
-        prev = None
-        current = self.head
+    def set_shuffle(self, mode, seed=None):
+        with self.lock.write():
+            self.shuffle = None if mode == "off" else Shuffle(mode, seed)
 
-        while current:
-            nxt = current.next
-            current.next = prev
-            prev = current
-            current = nxt
+    def next_shuffled(self, avoid=()):
+        # Next song of the shuffle pass, None if shuffle is off or every
+        # song has played. avoid: artists smart shuffle should not play
+        # next. The song counts as played once mark_played() says so.
+        with self.lock.write():
+            if self.shuffle is None:
+                return None
+            picked = self.shuffle.next(self, avoid)
+            return picked and picked[1]
 
-        self.head = prev
+    def mark_played(self, song_id):
+        with self.lock.write():
+            if self.shuffle is not None:
+                self.shuffle.played.add(song_id)
 
 
 # %%
@@ -311,58 +1998,242 @@ class LinkedList:
 # QUEUE FOR PLAYBACK
 # ----------------------------------------------------
 class Queue:
-    def __init__(self):
-        self.items = []
+    # capacity=None means unbounded. When full, overflow="reject" refuses
+    # new songs and overflow="drop_oldest" evicts from the front.
+    OVERFLOW_POLICIES = ("reject", "drop_oldest")
+
+    def __init__(self, capacity=None, overflow="reject"):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        self.capacity = capacity
+        self.overflow = overflow
+        self.items = deque()
+        # songs ever removed from the front; items[i] has absolute
+        # position removed + i, which is what queue cursors refer to
+        self.removed = 0
+        # song_id -> absolute positions of its live entries, oldest first
+        self._positions = {}
+        # positions of entries dropped by discard_songs() or played out of
+        # order by the shuffle; they stay in items until they reach the
+        # front (or a compaction) and are skipped by every reader
+        self._dead = set()
+        self.version = 0  # bumped when a compaction renumbers positions
+        # the running Shuffle pass, if any; dequeue() ignores it, callers
+        # follow it with next_shuffled() + take() (see play_next)
+        self.shuffle = None
+        self.lock = threading.RLock()
+
+    def reading(self):
+        return self.lock
+
+    def __len__(self):
+        return len(self.items) - len(self._dead)
+
+    def _append(self, song):
+        position = self.removed + len(self.items)
+        self.items.append(song)
+        positions = self._positions.get(song.song_id)
+        if positions is None:
+            self._positions[song.song_id] = deque((position,))
+        else:
+            positions.append(position)
+
+    def _skip_dead(self):
+        # keep items[0] live so peek and dequeue stay O(1)
+        while self._dead and self.removed in self._dead:
+            self._dead.discard(self.removed)
+            self.items.popleft()
+            self.removed += 1
+
+    def _popleft(self):
+        self.removed += 1
+        song = self.items.popleft()
+        positions = self._positions[song.song_id]
+        positions.popleft()
+        if not positions:
+            del self._positions[song.song_id]
+        self._skip_dead()
+        return song
+
+    def is_full(self):
+        return self.capacity is not None and len(self) >= self.capacity
+
+    def _make_room(self):
+        if not self.is_full():
+            return True
+        if self.overflow == "reject":
+            return False
+        self._popleft()
+        return True
 
     def enqueue(self, song):
-        self.items.append(song)
-        return f"Added to queue: {song.title}"
+        with self.lock:
+            if not self._make_room():
+                return f"Queue full, not added: {song.title}"
+            self._append(song)
+            return f"Added to queue: {song.title}"
+
+    def enqueue_many(self, songs):
+        with self.lock:
+            added = 0
+            for song in songs:
+                if not self._make_room():
+                    break
+                self._append(song)
+                added += 1
+            return added
 
     def dequeue(self):
-        if not self.items:
-            return "Queue empty.", None
-        song = self.items.pop(0)
-        return f"Now playing: {song.title}", song
+        with self.lock:
+            if not self.items:
+                return "Queue empty.", None
+            song = self._popleft()
+            return f"Now playing: {song.title}", song
+
+    def next_shuffled(self, avoid=()):
+        # The shuffle's next pick as (song, n): the song's n-th entry in
+        # queue order, which take() then plays. None if shuffle is off or
+        # the queue is empty. avoid: artists smart shuffle should not
+        # play next.
+        with self.lock:
+            if self.shuffle is None or not self.items:
+                return None
+            picked = self.shuffle.next(self, avoid)
+            if not picked:
+                return None
+            position, song = picked
+            return song, self._positions[song.song_id].index(position)
+
+    def take(self, song_id, n=0):
+        # play the n-th entry of song_id out of order; it is dropped like a
+        # discarded one. None if there is no such entry.
+        with self.lock:
+            positions = self._positions.get(song_id)
+            if not positions or n >= len(positions):
+                return None
+            position = positions[n]
+            song = self.items[position - self.removed]
+            if position == self.removed:
+                return self._popleft()
+            del positions[n]
+            if not positions:
+                del self._positions[song_id]
+            self._dead.add(position)
+            if len(self._dead) > len(self.items) // 2:
+                self._compact()
+            return song
+
+    def shuffle_range(self):
+        return self.removed, self.removed + len(self.items), self.version
+
+    def slot_song(self, position):
+        i = position - self.removed
+        if i < 0 or i >= len(self.items) or position in self._dead:
+            return None
+        return self.items[i]
+
+    def set_shuffle(self, mode, seed=None):
+        with self.lock:
+            self.shuffle = None if mode == "off" else Shuffle(mode, seed, remember=False)
+
+    def dequeue_many(self, n):
+        with self.lock:
+            return [self._popleft() for _ in range(min(n, len(self)))]
+
+    def discard_songs(self, song_ids):
+        # Drop every entry of these songs in O(their entries): the entries
+        # are only marked dead here. Once dead entries outnumber live ones
+        # the deque is rebuilt, which renumbers the positions after them.
+        with self.lock:
+            dropped = 0
+            for song_id in song_ids:
+                positions = self._positions.pop(song_id, None)
+                if positions:
+                    self._dead.update(positions)
+                    dropped += len(positions)
+            self._skip_dead()
+            if len(self._dead) > len(self.items) // 2:
+                self._compact()
+            return dropped
+
+    def _compact(self):
+        live = [
+            song
+            for i, song in enumerate(self.items, self.removed)
+            if i not in self._dead
+        ]
+        self.items = deque()
+        self._positions = {}
+        self._dead = set()
+        self.version += 1
+        for song in live:
+            self._append(song)
+
+    def scan(self, cursor=None):
+        # cursor is the absolute position of the next song to return
+        start = max(0, (cursor or 0) - self.removed)
+        for i, song in enumerate(islice(self.items, start, None), self.removed + start):
+            if i not in self._dead:
+                yield song, i + 1
 
     def peek(self):
-        if not self.items:
-            return None
-        return self.items[0]
+        with self.lock:
+            if not self.items:
+                return None
+            return self.items[0]
+
+    def song_ids(self):
+        with self.lock:
+            return set(self._positions)
 
     def display(self):
-        if not self.items:
-            return "Queue is empty."
+        with self.lock:
+            if not self.items:
+                return "Queue is empty."
 
-        out = ["Current Queue:"]
-        for i, song in enumerate(self.items, start=1):
-            out.append(f"{i}. {song.title} by {song.artist}")
+            out = ["Current Queue:"]
+            for i, (song, _) in enumerate(self.scan(), start=1):
+                out.append(f"{i}. {song.title} by {song.artist}")
 
-        return "\n".join(out)
+            return "\n".join(out)
 
     def find_song_for_queue(text):
         # ID
-        s = library.search(text)
+        s = catalog.library.search(text)
         if s:
             return s
 
         # full title
-        exact = library.search_by_title(text)
+        exact = catalog.library.search_by_title(text)
         if exact:
             return exact[0]
 
         # partial
-        partial = library.search_by_partial_title(text)
+        partial = catalog.library.search_by_partial_title(text)
         if partial:
             return partial[0]
 
         return None
 
+    def requeue_last(self, stack):
+        # moves the newest song on `stack` to the back of the queue as
+        # (song, queued); a full queue that rejects it leaves it on the stack
+        with self.lock:
+            song = stack.pop()
+            if not song:
+                return None, False
+            if not self._make_room():
+                stack.push(song)
+                return song, False
+            self._append(song)
+            return song, True
+
     def replay(self, stack):
-        song = stack.pop()
+        song, queued = self.requeue_last(stack)
         if not song:
             return "No song to replay."
-
-        self.enqueue(song)
+        if not queued:
+            return f"Queue full, not replayed: {song.title}"
         return f"Replaying: {song.title}"
 
 
@@ -373,30 +2244,528 @@ class Queue:
 # STACK FOR RECENTLY PLAYED
 # ----------------------------------------------------
 class Stack:
-    def __init__(self):
-        self.items = []
+    # Ring buffer of the most recent plays. Once `capacity` songs (or
+    # `max_bytes`, if set) are held, each push overwrites the oldest entry,
+    # so memory stays fixed however long the worker runs.
+    def __init__(self, capacity=1000, max_bytes=None):
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self._buf = [None] * capacity
+        self._sizes = [0] * capacity
+        self._start = 0  # slot of the oldest entry
+        self.length = 0  # slots in use, including dead ones
+        self.nbytes = 0
+        self.pushed = 0  # sequence number of the newest entry
+        # song_id -> sequence numbers of its entries, oldest first;
+        # discard_songs() clears those slots to None and counts them in
+        # `dead` until they reach either end of the buffer
+        self._seqs = {}
+        self.dead = 0
+        self.lock = threading.RLock()
+
+    def reading(self):
+        return self.lock
+
+    def __len__(self):
+        return self.length - self.dead
+
+    @staticmethod
+    def song_nbytes(song):
+        fields = (song.song_id, song.title, song.artist, song.album, song.genre)
+        return sys.getsizeof(song) + sum(sys.getsizeof(f) for f in fields)
+
+    def _slot(self, seq):
+        # the oldest entry has sequence number pushed - length + 1
+        return (self._start + seq - (self.pushed - self.length + 1)) % self.capacity
+
+    def _clear_slot(self, i):
+        self.nbytes -= self._sizes[i]
+        self._buf[i] = None
+        self._sizes[i] = 0
+
+    def _forget(self, song, newest):
+        seqs = self._seqs[song.song_id]
+        if newest:
+            seqs.pop()
+        else:
+            seqs.popleft()
+        if not seqs:
+            del self._seqs[song.song_id]
+
+    def _trim(self):
+        # keep both ends live, so push/pop never land on a dead slot
+        while self.length and self._buf[self._slot(self.pushed)] is None:
+            self.length -= 1
+            self.pushed -= 1
+            self.dead -= 1
+        while self.length and self._buf[self._start] is None:
+            self._start = (self._start + 1) % self.capacity
+            self.length -= 1
+            self.dead -= 1
+
+    def _compact(self):
+        # closes up dead slots so a full buffer of mostly live entries
+        # doesn't evict to make room; the newest entry keeps its sequence
+        # number and older ones are renumbered below it, so a scan() cursor
+        # taken before this may skip or repeat a few songs
+        live = []
+        for seq in range(self.pushed - self.length + 1, self.pushed + 1):
+            i = self._slot(seq)
+            if self._buf[i] is not None:
+                live.append((self._buf[i], self._sizes[i]))
+        self._buf = [None] * self.capacity
+        self._sizes = [0] * self.capacity
+        self._seqs = {}
+        first = self.pushed - len(live) + 1
+        for k, (song, size) in enumerate(live):
+            self._buf[k] = song
+            self._sizes[k] = size
+            self._seqs.setdefault(song.song_id, deque()).append(first + k)
+        self._start = 0
+        self.length = len(live)
+        self.dead = 0
+
+    def _drop_oldest(self):
+        i = self._start
+        self._forget(self._buf[i], newest=False)
+        self._clear_slot(i)
+        self._start = (i + 1) % self.capacity
+        self.length -= 1
+        self._trim()
 
     def push(self, song):
-        self.items.append(song)
+        with self.lock:
+            size = self.song_nbytes(song) if self.max_bytes else 0
+            if self.length == self.capacity:
+                if self.dead:
+                    self._compact()
+                else:
+                    self._drop_oldest()
+            while self.max_bytes and self.length and self.nbytes + size > self.max_bytes:
+                self._drop_oldest()
+
+            i = (self._start + self.length) % self.capacity
+            self._buf[i] = song
+            self._sizes[i] = size
+            self.nbytes += size
+            self.length += 1
+            self.pushed += 1
+            self._seqs.setdefault(song.song_id, deque()).append(self.pushed)
 
     def pop(self):
-        if not self.items:
-            print("No recently played songs.")
-            return None
-        return self.items.pop()
+        with self.lock:
+            if not self.length:
+                print("No recently played songs.")
+                return None
+            i = self._slot(self.pushed)
+            song = self._buf[i]
+            self._forget(song, newest=True)
+            self._clear_slot(i)
+            self.length -= 1
+            self.pushed -= 1
+            self._trim()
+            return song
 
-    def display_list(self):
-        if not self.items:
-            return "No recently played songs."
-        return "\n".join(str(s) for s in reversed(self.items))
+    def peek(self):
+        with self.lock:
+            if not self.length:
+                return None
+            return self._buf[self._slot(self.pushed)]
+
+    def clear(self):
+        with self.lock:
+            self._buf = [None] * self.capacity
+            self._sizes = [0] * self.capacity
+            self._start = 0
+            self.length = 0
+            self.nbytes = 0
+            self._seqs = {}
+            self.dead = 0
+
+    def discard_songs(self, song_ids):
+        # O(entries of these songs): each sequence number maps straight to
+        # its slot, which is cleared rather than closed up
+        with self.lock:
+            dropped = 0
+            for song_id in song_ids:
+                for seq in self._seqs.pop(song_id, ()):
+                    self._clear_slot(self._slot(seq))
+                    dropped += 1
+            self.dead += dropped
+            self._trim()
+            return dropped
+
+    def _newest_first(self, offset=0):
+        # (sequence number, song or None) from `offset` slots below the top
+        for k in range(offset, self.length):
+            yield self.pushed - k, self._buf[self._slot(self.pushed - k)]
+
+    def scan(self, cursor=None):
+        # Newest first. Every push gets the next sequence number and a pop
+        # hands it back, so cursor (the sequence number of the last song
+        # returned) survives new pushes between pages.
+        offset = 0 if cursor is None else max(0, self.pushed - cursor + 1)
+        for seq, song in self._newest_first(offset):
+            if song is not None:
+                yield song, seq
+
+    def iter_recent(self, offset=0, limit=None):
+        # newest first, without copying the buffer
+        songs = (song for _, song in self._newest_first() if song is not None)
+        return islice(songs, offset, None if limit is None else offset + limit)
+
+    def display_list(self, offset=0, limit=None):
+        with self.lock:
+            if not self.length:
+                return "No recently played songs."
+            return "\n".join(str(s) for s in self.iter_recent(offset, limit))
 
     def display(self):
-        if not self.items:
-            print("No recently played songs.")
-            return
-        print("Recently Played:")
-        for song in reversed(self.items):
-            print(song)
+        with self.lock:
+            if not self.length:
+                print("No recently played songs.")
+                return
+            print("Recently Played:")
+            for song in self.iter_recent():
+                print(song)
+
+
+# %%
+
+
+# ----------------------------------------------------
+# NAMED PLAYLISTS
+# ----------------------------------------------------
+class Chunk:
+    # An immutable run of song ids. Playlists share chunks, so a fork
+    # copies the list of chunks (not the ids) and an edit replaces only
+    # the chunks it touches. `stored` is set once the chunk is in the
+    # spill file.
+    __slots__ = ("id", "song_ids", "stored", "__weakref__")
+
+    def __init__(self, chunk_id, song_ids, stored=False):
+        self.id = chunk_id
+        self.song_ids = song_ids
+        self.stored = stored
+
+
+class NamedPlaylist:
+    __slots__ = ("chunks", "length", "dirty")
+
+    def __init__(self, chunks=(), dirty=True):
+        self.chunks = list(chunks)
+        self.length = sum(len(c.song_ids) for c in self.chunks)
+        self.dirty = dirty  # changed since it was last spilled
+
+    def __len__(self):
+        return self.length
+
+    def scan(self, cursor=None):
+        # cursor is the position of the next song id to return
+        start = cursor or 0
+        position = 0
+        for chunk in self.chunks:
+            if position + len(chunk.song_ids) > start:
+                for i in range(max(0, start - position), len(chunk.song_ids)):
+                    yield chunk.song_ids[i], position + i + 1
+            position += len(chunk.song_ids)
+
+
+def remove_spill_dir(path, pid):
+    # forked workers inherit the finalizer; only the creator cleans up
+    if os.getpid() == pid:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+class PlaylistStore:
+    # Playlists keyed by (user, name) holding song ids, not Song objects,
+    # so ids whose song left the library are just skipped on read.
+    # Up to `max_loaded` playlists stay in memory in LRU order, as long as
+    # they hold at most `max_chunks` distinct chunks between them (shared
+    # chunks count once, so forks are nearly free). Colder ones are
+    # evicted to a private SQLite spill file, where chunks are stored once
+    # with a reference count so forks share them on disk too, and loaded
+    # back on first use. The spill is a cache, not durable storage: the
+    # op log is what rebuilds playlists on restart.
+    CHUNK = 256
+
+    def __init__(self, path=None, max_loaded=10_000, max_chunks=20_000):
+        self.path = path
+        self.max_loaded = max_loaded
+        self.max_chunks = max_chunks
+        self._loaded = OrderedDict()  # (user, name) -> NamedPlaylist
+        self._chunks = weakref.WeakValueDictionary()  # chunk id -> Chunk
+        self._next_id = 1
+        self._db = None
+        self._pid = None
+        self._file = None
+        self.loads = self.evictions = 0
+        self.lock = threading.RLock()
+
+    def reading(self):
+        return self.lock
+
+    def _conn(self):
+        # like SQLiteState, never use a connection across a fork; a forked
+        # worker also gets its own copy of the spill file
+        if self._db is not None and self._pid == os.getpid():
+            return self._db
+        parent = self._file if self._db is not None else None
+        if self.path is None or parent:
+            spill_dir = tempfile.mkdtemp(prefix="playlists-")
+            weakref.finalize(self, remove_spill_dir, spill_dir, os.getpid())
+            self._file = os.path.join(spill_dir, "spill.db")
+        else:
+            self._file = self.path
+        db = sqlite3.connect(self._file, isolation_level=None, check_same_thread=False)
+        if parent:
+            with closing(sqlite3.connect(parent)) as src:
+                src.backup(db)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=OFF")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS playlists (user TEXT NOT NULL, name TEXT NOT NULL, "
+            "length INTEGER NOT NULL, chunks TEXT NOT NULL, PRIMARY KEY (user, name))"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "id INTEGER PRIMARY KEY, song_ids TEXT NOT NULL, refs INTEGER NOT NULL)"
+        )
+        self._db, self._pid = db, os.getpid()
+        return db
+
+    def _chunk(self, song_ids):
+        chunk = Chunk(self._next_id, tuple(song_ids))
+        self._next_id += 1
+        self._chunks[chunk.id] = chunk
+        return chunk
+
+    def _row(self, key):
+        return self._conn().execute(
+            "SELECT length, chunks FROM playlists WHERE user = ? AND name = ?", key
+        ).fetchone()
+
+    def _get(self, key):
+        playlist = self._loaded.get(key)
+        if playlist is not None:
+            self._loaded.move_to_end(key)
+            return playlist
+        row = self._row(key)
+        if row is None:
+            raise KeyError(f"no playlist {key[1]!r} for user {key[0]!r}")
+
+        ids = json.loads(row[1])
+        # chunks a loaded fork already shares are reused, the rest are read
+        found = {i: self._chunks.get(i) for i in ids}
+        missing = [i for i, chunk in found.items() if chunk is None]
+        for start in range(0, len(missing), 500):
+            part = missing[start : start + 500]
+            rows = self._conn().execute(
+                f"SELECT id, song_ids FROM chunks WHERE id IN ({','.join('?' * len(part))})",
+                part,
+            )
+            for chunk_id, song_ids in rows:
+                found[chunk_id] = Chunk(chunk_id, tuple(json.loads(song_ids)), stored=True)
+                self._chunks[chunk_id] = found[chunk_id]
+        playlist = NamedPlaylist([found[i] for i in ids], dirty=False)
+        self.loads += 1
+        self._hold(key, playlist)
+        return playlist
+
+    def _hold(self, key, playlist):
+        self._loaded[key] = playlist
+        self._evict()
+
+    def _resized(self, playlist, delta):
+        playlist.length += delta
+        playlist.dirty = True
+        self._evict()
+
+    def _evict(self):
+        # keep the most recently used playlist even if it alone is too big
+        while len(self._loaded) > 1 and (
+            len(self._loaded) > self.max_loaded or len(self._chunks) > self.max_chunks
+        ):
+            key, playlist = self._loaded.popitem(last=False)
+            self.evictions += 1
+            if playlist.dirty:
+                self._spill(key, playlist)
+
+    def _spill(self, key, playlist):
+        db = self._conn()
+        db.execute("BEGIN")
+        new = {c.id: c for c in playlist.chunks if not c.stored}
+        db.executemany(
+            "INSERT INTO chunks (id, song_ids, refs) VALUES (?, ?, 0)",
+            [(c.id, json.dumps(c.song_ids)) for c in new.values()],
+        )
+        for chunk in new.values():
+            chunk.stored = True
+        refs = Counter(c.id for c in playlist.chunks)
+        old = self._row(key)
+        db.execute(
+            "INSERT OR REPLACE INTO playlists (user, name, length, chunks) VALUES (?, ?, ?, ?)",
+            (*key, len(playlist), json.dumps([c.id for c in playlist.chunks])),
+        )
+        self._release(db, refs, json.loads(old[1]) if old else ())
+        db.execute("COMMIT")
+        playlist.dirty = False
+
+    def _release(self, db, refs, old_ids):
+        # apply reference count changes and drop chunks nothing points to
+        refs.subtract(old_ids)
+        db.executemany(
+            "UPDATE chunks SET refs = refs + ? WHERE id = ?",
+            [(n, chunk_id) for chunk_id, n in refs.items() if n],
+        )
+        dropped = [chunk_id for chunk_id, n in refs.items() if n < 0]
+        for start in range(0, len(dropped), 500):
+            part = dropped[start : start + 500]
+            marks = ",".join("?" * len(part))
+            dead = [
+                r[0]
+                for r in db.execute(
+                    f"SELECT id FROM chunks WHERE refs <= 0 AND id IN ({marks})", part
+                )
+            ]
+            db.execute(f"DELETE FROM chunks WHERE refs <= 0 AND id IN ({marks})", part)
+            for chunk_id in dead:
+                chunk = self._chunks.get(chunk_id)
+                if chunk is not None:
+                    chunk.stored = False
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self._loaded or self._row(key) is not None
+
+    def create(self, user, name):
+        key = (user, name)
+        with self.lock:
+            if key in self:
+                raise ValueError(f"playlist {name!r} already exists")
+            # the row makes the name visible to names() before any spill
+            self._conn().execute(
+                "INSERT INTO playlists (user, name, length, chunks) VALUES (?, ?, 0, '[]')", key
+            )
+            self._hold(key, NamedPlaylist(dirty=False))
+            return True
+
+    def add(self, user, name, song_ids):
+        with self.lock:
+            playlist = self._get((user, name))
+            song_ids = list(song_ids)
+            chunks = playlist.chunks
+            pending = song_ids
+            if chunks and len(chunks[-1].song_ids) < self.CHUNK:
+                # the last chunk may be shared, so replace it, don't extend it
+                last = chunks.pop()
+                pending = list(last.song_ids) + song_ids
+            for i in range(0, len(pending), self.CHUNK):
+                chunks.append(self._chunk(pending[i : i + self.CHUNK]))
+            self._resized(playlist, len(song_ids))
+            return len(song_ids)
+
+    def remove(self, user, name, song_id):
+        # drops every occurrence; only chunks holding the id are rebuilt
+        with self.lock:
+            playlist = self._get((user, name))
+            removed = 0
+            chunks = []
+            for chunk in playlist.chunks:
+                if song_id not in chunk.song_ids:
+                    chunks.append(chunk)
+                    continue
+                kept = [i for i in chunk.song_ids if i != song_id]
+                removed += len(chunk.song_ids) - len(kept)
+                if kept:
+                    chunks.append(self._chunk(kept))
+            if removed:
+                playlist.chunks = chunks
+                self._resized(playlist, -removed)
+            return removed
+
+    def fork(self, user, name, to_user, to_name):
+        # copy-on-write: the copy starts out sharing every chunk
+        with self.lock:
+            source = self._get((user, name))
+            if (to_user, to_name) in self:
+                raise ValueError(f"playlist {to_name!r} already exists")
+            self._conn().execute(
+                "INSERT INTO playlists (user, name, length, chunks) VALUES (?, ?, 0, '[]')",
+                (to_user, to_name),
+            )
+            self._hold((to_user, to_name), NamedPlaylist(source.chunks))
+            return len(source)
+
+    def delete(self, user, name):
+        key = (user, name)
+        with self.lock:
+            row = self._row(key)
+            if row is None:
+                raise KeyError(f"no playlist {name!r} for user {user!r}")
+            self._loaded.pop(key, None)
+            db = self._conn()
+            db.execute("BEGIN")
+            db.execute("DELETE FROM playlists WHERE user = ? AND name = ?", key)
+            self._release(db, Counter(), json.loads(row[1]))
+            db.execute("COMMIT")
+            return True
+
+    def names(self, user):
+        with self.lock:
+            rows = self._conn().execute(
+                "SELECT name, length FROM playlists WHERE user = ? ORDER BY name", (user,)
+            )
+            out = []
+            for name, length in rows:
+                loaded = self._loaded.get((user, name))
+                out.append({"name": name, "length": length if loaded is None else len(loaded)})
+            return out
+
+    def get(self, user, name):
+        with self.lock:
+            return self._get((user, name))
+
+    def checkpoint(self):
+        # Pins every playlist as of now, for a state snapshot: a read
+        # transaction on a second connection keeps seeing the spill file as
+        # it is, and playlists changed since their last spill are captured
+        # as their (immutable) chunk lists, so no ids are copied.
+        with self.lock:
+            self._conn()
+            reader = sqlite3.connect(self._file, check_same_thread=False)
+            reader.execute("BEGIN")
+            reader.execute("SELECT count(*) FROM playlists").fetchone()
+            changed = {key: list(p.chunks) for key, p in self._loaded.items() if p.dirty}
+        return reader, changed
+
+    @staticmethod
+    def iter_checkpoint(reader, changed):
+        # (user, name, song ids) for every playlist in a checkpoint
+        try:
+            for user, name, ids in reader.execute("SELECT user, name, chunks FROM playlists"):
+                chunks = changed.get((user, name))
+                if chunks is not None:
+                    yield user, name, [i for c in chunks for i in c.song_ids]
+                    continue
+                song_ids = []
+                for chunk_id in json.loads(ids):
+                    row = reader.execute(
+                        "SELECT song_ids FROM chunks WHERE id = ?", (chunk_id,)
+                    ).fetchone()
+                    song_ids += json.loads(row[0])
+                yield user, name, song_ids
+        finally:
+            reader.close()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "loaded": len(self._loaded),
+                "chunks_in_memory": len(self._chunks),
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
 
 
 # %%
@@ -405,35 +2774,1258 @@ class Stack:
 # ----------------------------------------------------
 # LOAD SONGS FROM CSV
 # ----------------------------------------------------
-def load_songs(filename):
-    songs = []
+CSV_COLUMNS = (
+    "song_id",
+    "title",
+    "artist",
+    "album",
+    "genre",
+    "duration_sec",
+    "release_year",
+)
+
+
+def iter_song_rows(filename, bad_rows=None):
+    # Yields (song_id, title, artist, album, genre, duration, year) tuples.
+    # Rows that fail to parse are appended to bad_rows as
+    # (line_number, row, error) when a list is given, otherwise they raise.
     with open(filename, newline="", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            song = Song(
-                row["song_id"],
-                row["title"],
-                row["artist"],
-                row["album"],
-                row["genre"],
-                int(row["duration_sec"]),
-                int(row["release_year"]),
+        yield from read_csv_rows(f, bad_rows, filename)
+
+
+def read_csv_rows(lines, bad_rows=None, name="upload"):
+    # iter_song_rows over any iterable of CSV lines (a file, an upload).
+    # Columns are located once from the header and then read by position.
+    reader = csv.reader(lines)
+    header = next(reader, None)
+    if header is None:
+        return
+
+    missing = [c for c in CSV_COLUMNS if c not in header]
+    if missing:
+        raise ValueError(f"{name}: missing columns {', '.join(missing)}")
+    i_id, i_title, i_artist, i_album, i_genre, i_dur, i_year = (
+        header.index(c) for c in CSV_COLUMNS
+    )
+    intern = sys.intern
+
+    for row in reader:
+        if not row:
+            continue
+        try:
+            # artist/album/genre repeat across rows; share one string each
+            yield (
+                row[i_id],
+                row[i_title],
+                intern(row[i_artist]),
+                intern(row[i_album]),
+                intern(row[i_genre]),
+                int(row[i_dur]),
+                int(row[i_year]),
+            )
+        except (IndexError, ValueError) as e:
+            if bad_rows is None:
+                raise
+            bad_rows.append((reader.line_num, row, str(e)))
+
+
+def read_ndjson_rows(lines, bad_rows=None):
+    # Same tuples from one JSON object per line. Takes the export's field
+    # names (duration, year) as well as the CSV's (duration_sec, release_year).
+    intern = sys.intern
+    for line_num, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            d = json.loads(line)
+            yield (
+                str(d["song_id"]),
+                str(d["title"]),
+                intern(str(d["artist"])),
+                intern(str(d["album"])),
+                intern(str(d["genre"])),
+                int(d["duration"] if "duration" in d else d["duration_sec"]),
+                int(d["year"] if "year" in d else d["release_year"]),
             )
-            songs.append(song)
+        except (KeyError, TypeError, ValueError) as e:
+            if bad_rows is None:
+                raise
+            bad_rows.append((line_num, line.rstrip("\n"), str(e)))
+
+
+def iter_songs(filename, bad_rows=None):
+    for fields in iter_song_rows(filename, bad_rows):
+        yield Song(*fields)
+
+
+def load_songs(filename, columnar=False):
+    # columnar=True returns a SongCatalog instead of a list of Song objects
+    if not columnar:
+        return list(iter_songs(filename))
+
+    songs = SongCatalog()
+    for fields in iter_song_rows(filename):
+        songs.append(*fields)
     return songs
 
 
-songs = load_songs("songs_dataset_updated.csv")
+def stream_into_library(library, filename, batch_size=5000, on_progress=None):
+    # Streams the CSV into `library` batch_size songs at a time.
+    # on_progress(rows_loaded, rows_per_sec) is called after every batch.
+    # Returns (rows_loaded, bad_rows).
+    bad_rows = []
+    loaded = 0
+    start = time.perf_counter()
+    songs = iter_songs(filename, bad_rows)
+
+    while True:
+        batch = list(islice(songs, batch_size))
+        if not batch:
+            break
+        library.insert_many((s.song_id, s) for s in batch)
+        loaded += len(batch)
+        if on_progress:
+            elapsed = time.perf_counter() - start
+            on_progress(loaded, loaded / elapsed if elapsed else 0.0)
+
+    return loaded, bad_rows
+
+
+# ----------------------------------------------------
+# BINARY SNAPSHOT
+# ----------------------------------------------------
+# Layout: MAGIC, u32 header length, JSON header, then 8-byte aligned
+# sections. The header lists each section as [offset, nbytes, typecode]
+# plus the artist/album/genre dictionaries. Integers use native byte order.
+SNAPSHOT_MAGIC = b"SONGSNAP"
+SNAPSHOT_VERSION = 1
+
+
+def write_snapshot(path, songs):
+    # Writes `songs` (any iterable of Song) plus an id hash index, a sorted
+    # title permutation and a normalized-title blob for substring search.
+    catalog = SongCatalog()
+    normalized = BlobColumn()
+    for song in {s.song_id: s for s in songs}.values():
+        catalog.append(
+            song.song_id,
+            song.title,
+            song.artist,
+            song.album,
+            song.genre,
+            song.duration,
+            song.year,
+        )
+        normalized.append(TitleIndex.normalize(song.title))
+    n = len(catalog)
+
+    # open addressing, power-of-two slots, 0 = empty, otherwise row + 1
+    slots = array("I", [0]) * max(2, 1 << (2 * n).bit_length())
+    mask = len(slots) - 1
+    for row in range(n):
+        i = djb2(catalog.ids[row]) & mask
+        while slots[i]:
+            i = (i + 1) & mask
+        slots[i] = row + 1
+
+    # utf-8 byte order matches code point order, so raw bytes sort like str
+    title_order = array("I", sorted(range(n), key=normalized.raw))
+
+    sections = {
+        "id_data": catalog.ids.data,
+        "id_offsets": catalog.ids.offsets,
+        "title_data": catalog.titles.data,
+        "title_offsets": catalog.titles.offsets,
+        "norm_data": normalized.data,
+        "norm_offsets": normalized.offsets,
+        "artist_codes": catalog.artists.rows,
+        "album_codes": catalog.albums.rows,
+        "genre_codes": catalog.genres.rows,
+        "durations": catalog.durations,
+        "years": catalog.years,
+        "id_slots": slots,
+        "title_order": title_order,
+    }
+    header = {
+        "version": SNAPSHOT_VERSION,
+        "byteorder": sys.byteorder,
+        "rows": n,
+        "artists": catalog.artists.values,
+        "albums": catalog.albums.values,
+        "genres": catalog.genres.values,
+        "sections": {},
+    }
+
+    # offsets depend on the header length, which depends on the offsets;
+    # recompute until they stop changing (two or three rounds)
+    while True:
+        header_bytes = json.dumps(header).encode("utf-8")
+        offset = len(SNAPSHOT_MAGIC) + 4 + len(header_bytes)
+        layout = {}
+        for name, buf in sections.items():
+            offset += -offset % 8
+            typecode = buf.typecode if isinstance(buf, array) else "B"
+            nbytes = len(buf) * (buf.itemsize if isinstance(buf, array) else 1)
+            layout[name] = [offset, nbytes, typecode]
+            offset += nbytes
+        if layout == header["sections"]:
+            break
+        header["sections"] = layout
+
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(len(header_bytes).to_bytes(4, "little"))
+        f.write(header_bytes)
+        for name, buf in sections.items():
+            f.write(b"\0" * (header["sections"][name][0] - f.tell()))
+            f.write(buf)
+    os.replace(tmp, path)
+    return n
+
+
+class SnapshotCatalog(SongCatalog):
+    # Read-only SongCatalog whose columns are memoryviews over an mmap of a
+    # snapshot file. Opening one costs a header parse, nothing per row, and
+    # every worker mapping the same file shares its pages.
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        mm = self._mm
+        if mm[: len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a song snapshot")
+        start = len(SNAPSHOT_MAGIC) + 4
+        header_len = int.from_bytes(mm[len(SNAPSHOT_MAGIC) : start], "little")
+        header = json.loads(mm[start : start + header_len])
+        if header["version"] != SNAPSHOT_VERSION or header["byteorder"] != sys.byteorder:
+            raise ValueError(f"{path}: incompatible snapshot, rebuild it")
+
+        view = memoryview(mm)
+        self._sections = header["sections"]
+        s = {
+            name: view[off : off + nbytes].cast(typecode)
+            for name, (off, nbytes, typecode) in self._sections.items()
+        }
+        self.ids = BlobColumn(s["id_data"], s["id_offsets"])
+        self.titles = BlobColumn(s["title_data"], s["title_offsets"])
+        self.normalized = BlobColumn(s["norm_data"], s["norm_offsets"])
+        self.artists = DictColumn(header["artists"], s["artist_codes"])
+        self.albums = DictColumn(header["albums"], s["album_codes"])
+        self.genres = DictColumn(header["genres"], s["genre_codes"])
+        self.durations = s["durations"]
+        self.years = s["years"]
+        self.id_slots = s["id_slots"]
+        self.title_order = s["title_order"]
+
+    def append(self, *fields):
+        raise TypeError("snapshot catalogs are read-only")
+
+    def find_id(self, song_id):
+        mask = len(self.id_slots) - 1
+        i = djb2(song_id) & mask
+        target = song_id.encode("utf-8")
+        while True:
+            row = self.id_slots[i]
+            if not row:
+                return None
+            if self.ids.raw(row - 1) == target:
+                return row - 1
+            i = (i + 1) & mask
+
+    def find_title(self, title):
+        key = TitleIndex.normalize(title).encode("utf-8")
+        order = self.title_order
+
+        def raw(row):
+            return bytes(self.normalized.raw(row))
+
+        lo = bisect_left(order, key, key=raw)
+        rows = []
+        while lo < len(order) and raw(order[lo]) == key:
+            rows.append(order[lo])
+            lo += 1
+        return rows
+
+    def find_partial_title(self, partial):
+        # mmap.find scans the normalized-title section in C; a hit is mapped
+        # back to its row through the offsets and skipped past
+        query = partial.strip().lower().encode("utf-8")
+        if not query:
+            return list(range(len(self)))
+
+        base = self._sections["norm_data"][0]
+        end = base + len(self.normalized.data)
+        offsets = self.normalized.offsets
+        rows = []
+        pos = self._mm.find(query, base, end)
+        while pos != -1:
+            row = bisect_right(offsets, pos - base) - 1
+            row_end = base + offsets[row + 1]
+            if pos + len(query) <= row_end:
+                rows.append(row)
+                pos = row_end
+            else:
+                pos += 1
+            pos = self._mm.find(query, pos, end)
+        return rows
+
+
+SONGS_CSV = os.environ.get("SONGS_CSV", "songs_dataset_updated.csv")
+SONGS_SNAPSHOT = os.environ.get("SONGS_SNAPSHOT", "songs_dataset_updated.snapshot")
+
+
+def snapshot_is_fresh(snapshot=SONGS_SNAPSHOT, csv_file=SONGS_CSV):
+    return os.path.exists(snapshot) and (
+        not os.path.exists(csv_file)
+        or os.path.getmtime(snapshot) >= os.path.getmtime(csv_file)
+    )
+
+
+def build_snapshot(csv_file=SONGS_CSV, snapshot=SONGS_SNAPSHOT):
+    bad_rows = []
+    n = write_snapshot(snapshot, iter_songs(csv_file, bad_rows))
+    print(f"Wrote {n} songs to {snapshot} ({len(bad_rows)} bad rows skipped)")
 
 
-library = HashTable(size=60)
 playlist = LinkedList()
-queue = Queue()
-history = Stack()
+playlists = PlaylistStore()
+queue = Queue(capacity=10000)
+history = Stack(capacity=1000, max_bytes=1 << 20)
+
+
+class Catalog:
+    # Builds the song library on first use instead of at import time, so
+    # importing app (tests, CLI tools, gunicorn --preload) stays cheap.
+    # warm_up() can start the load in a background thread; until it
+    # finishes `ready` is False and requests get a "warming up" reply.
+    def __init__(self, csv_file=SONGS_CSV, snapshot=SONGS_SNAPSHOT):
+        self.csv_file = csv_file
+        self.snapshot = snapshot
+        self.error = None
+        self._library = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def ready(self):
+        return self._library is not None
+
+    @property
+    def warming_up(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def library(self):
+        if self._library is None:
+            self.load()
+        return self._library
+
+    def load(self):
+        with self._lock:
+            if self._library is not None:
+                return self._library
+            try:
+                self._library = self._build()
+            except Exception as e:
+                self.error = e
+                raise
+            return self._library
+
+    def _build(self):
+        # a snapshot built with `python app.py build-snapshot` is mapped
+        # instead of re-parsing the CSV in every worker
+        if snapshot_is_fresh(self.snapshot, self.csv_file):
+            return HashTable.from_snapshot(self.snapshot, size=60)
+
+        library = HashTable(size=60)
+        loaded, bad_rows = stream_into_library(library, self.csv_file)
+        for line_num, row, error in bad_rows:
+            print(f"Skipped line {line_num} of {self.csv_file}: {error}")
+        return library
+
+    def warm_up(self, background=True):
+        if self.ready or self.warming_up:
+            return
+        if not background:
+            self.load()
+            return
+        self._thread = threading.Thread(
+            target=self._warm_up, name="catalog-warm-up", daemon=True
+        )
+        self._thread.start()
 
-# Insert all into hash table
-for s in songs:
-    library.insert(s.song_id, s)
+    def _warm_up(self):
+        try:
+            self.load()
+            # replay/recover shared state now rather than on the first request
+            state.sync()
+        except Exception as e:
+            print(f"Catalog warm-up failed: {e}")
+
+
+catalog = Catalog()
+
+if os.environ.get("WARM_UP") == "1":
+    catalog.warm_up()
+
+
+def __getattr__(name):
+    # keeps `app.library` working for scripts without loading at import
+    if name == "library":
+        return catalog.library
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# ----------------------------------------------------
+# SHARED STATE
+# ----------------------------------------------------
+# Every mutation of the library/playlist/queue/history goes through a named
+# op. LocalState just applies it; SQLiteState also appends it to an op log
+# that all gunicorn workers share and replay, so each worker's in-memory
+# structures follow the same sequence of edits.
+OPS = {}
+
+
+def op(name):
+    def register(fn):
+        OPS[name] = fn
+        return fn
+
+    return register
+
+
+def apply_op(name, args):
+    return OPS[name](*args)
+
+
+def cascade_delete(song_ids):
+    # songs leaving the library leave the playlist, queue and history too;
+    # each keeps song_id -> its entries, so this costs O(entries), not a scan
+    playlist.discard_songs(song_ids)
+    queue.discard_songs(song_ids)
+    history.discard_songs(song_ids)
+
+
+@op("library.delete")
+def _library_delete(song_id):
+    deleted = catalog.library.delete(song_id)
+    if deleted:
+        cascade_delete([song_id])
+    return deleted
+
+
+@op("library.insert_many")
+def _library_insert_many(rows):
+    songs = [Song(*fields) for fields in rows]
+    return catalog.library.insert_many((s.song_id, s) for s in songs)
+
+
+@op("library.delete_many")
+def _library_delete_many(song_ids):
+    deleted = catalog.library.delete_many(song_ids)
+    if deleted:
+        cascade_delete(song_ids)
+    return deleted
+
+
+@op("playlist.add_start")
+def _playlist_add_start(song_id):
+    song = catalog.library.search(song_id)
+    return bool(song) and playlist.insert_at_start(song)
+
+
+@op("playlist.add_end")
+def _playlist_add_end(song_id):
+    song = catalog.library.search(song_id)
+    return bool(song) and playlist.insert_at_end(song)
+
+
+@op("playlist.insert_after")
+def _playlist_insert_after(target_id, song_id):
+    song = catalog.library.search(song_id)
+    return bool(song) and playlist.insert_after(target_id, song)
+
+
+@op("playlist.delete")
+def _playlist_delete(song_id):
+    return playlist.delete_song(song_id)
+
+
+@op("playlist.move_up")
+def _playlist_move_up(song_id):
+    return playlist.move_up(song_id)
+
+
+@op("playlist.move_down")
+def _playlist_move_down(song_id):
+    return playlist.move_down(song_id)
+
+
+@op("playlist.reverse")
+def _playlist_reverse():
+    playlist.reverse()
+
+
+@op("playlists.create")
+def _playlists_create(user, name):
+    return playlists.create(user, name)
+
+
+@op("playlists.add")
+def _playlists_add(user, name, song_ids):
+    # ids the library doesn't know are skipped
+    library = catalog.library
+    return playlists.add(user, name, [i for i in song_ids if library.search(i)])
+
+
+@op("playlists.remove")
+def _playlists_remove(user, name, song_id):
+    return playlists.remove(user, name, song_id)
+
+
+@op("playlists.fork")
+def _playlists_fork(user, name, to_user, to_name):
+    return playlists.fork(user, name, to_user, to_name)
+
+
+@op("playlists.delete")
+def _playlists_delete(user, name):
+    return playlists.delete(user, name)
+
+
+@op("queue.enqueue")
+def _queue_enqueue(song_id):
+    song = catalog.library.search(song_id)
+    return queue.enqueue(song) if song else "Song not found."
+
+
+@op("queue.enqueue_many")
+def _queue_enqueue_many(song_ids):
+    # picks chosen before the op runs (e.g. play similar), so every worker
+    # replaying it enqueues the same songs
+    songs = (catalog.library.search(song_id) for song_id in song_ids)
+    return [queue.enqueue(song) for song in songs if song]
+
+
+@op("queue.play_next")
+def _queue_play_next():
+    msg, song = queue.dequeue()
+    if song:
+        history.push(song)
+    return msg, song
+
+
+@op("queue.play")
+def _queue_play(song_id, n):
+    song = queue.take(song_id, n)
+    if not song:
+        return "Song not in queue.", None
+    history.push(song)
+    return f"Now playing: {song.title}", song
+
+
+@op("queue.shuffle")
+def _queue_shuffle(mode, seed):
+    queue.set_shuffle(mode, seed)
+
+
+@op("playlist.shuffle")
+def _playlist_shuffle(mode, seed):
+    playlist.set_shuffle(mode, seed)
+
+
+@op("playlist.play")
+def _playlist_play(song_id):
+    song = playlist.search(song_id)
+    if not song:
+        return "Song not in playlist.", None
+    playlist.mark_played(song_id)
+    history.push(song)
+    return f"Now playing: {song.title}", song
+
+
+@op("queue.replay")
+def _queue_replay():
+    return queue.replay(history)
+
+
+@op("history.undo")
+def _history_undo():
+    song, queued = queue.requeue_last(history)
+    if not song:
+        return "History empty.", None
+    if not queued:
+        return f"Queue full, not restored: {song.title}", None
+    return f"Restored to queue: {song.title}", song
+
+
+@op("history.clear")
+def _history_clear():
+    history.clear()
+
+
+# A state snapshot is a header, then batches of ids, then ["end"].
+# JournalState keeps them in files and SQLiteState in its database; both
+# take the cut (ids only) while no op can run and write it out after.
+SNAPSHOT_BATCH = 250
+
+
+def track_library(changes, name, args, result):
+    # changes: song_id -> row for songs imported since the catalog was
+    # loaded, None for deleted ones; it is all a snapshot needs to rebuild
+    # the library on top of the catalog
+    if name == "library.insert_many":
+        for row in args[0]:
+            changes[row[0]] = row
+    elif name == "library.delete" and result:
+        changes[args[0]] = None
+    elif name == "library.delete_many" and result:
+        for song_id in args[0]:
+            changes[song_id] = None
+
+
+def snapshot_cut(seq, library_changes):
+    header = {
+        "seq": seq,
+        "queue_removed": queue.removed,
+        # sequence number just before the oldest history entry
+        "history_base": history.pushed - len(history),
+        "playlist_reversed": playlist._rev,
+        "playlist_shuffle": playlist.shuffle and playlist.shuffle.to_dict(),
+        "queue_shuffle": queue.shuffle and queue.shuffle.to_dict(),
+    }
+    with playlist.reading():
+        playlist_ids = [song.song_id for song in playlist]
+    with queue.reading():
+        queue_ids = [song.song_id for song, _ in queue.scan()]
+    with history.reading():
+        history_ids = [song.song_id for song in history.iter_recent()][::-1]
+    reader, changed = playlists.checkpoint()
+    return {
+        "header": header,
+        "library": list(library_changes.items()),
+        "playlist": playlist_ids,
+        "queue": queue_ids,
+        "history": history_ids,
+        "playlists": (reader, changed),
+    }
+
+
+def snapshot_records(cut):
+    if cut["header"]["playlist_reversed"]:
+        cut["playlist"].reverse()  # stored head-to-tail of the physical chain
+    yield cut["header"]
+    n = SNAPSHOT_BATCH
+    for kind in ("library", "playlist", "queue", "history"):
+        items = cut[kind]
+        for i in range(0, len(items), n):
+            yield [kind, items[i : i + n]]
+    for user, name, ids in PlaylistStore.iter_checkpoint(*cut["playlists"]):
+        yield ["user_playlist", user, name, ids]
+    yield ["end"]
+
+
+def load_snapshot(records, library_changes):
+    # records as written by snapshot_records(), onto a freshly loaded
+    # catalog; False if the snapshot is incomplete
+    if not records or records[-1] != ["end"]:
+        return False
+    header = records[0]
+    library = catalog.library
+    songs, deleted = [], []
+    for record in records[1:]:
+        if record[0] == "library":
+            for song_id, row in record[1]:
+                library_changes[song_id] = row
+                if row is None:
+                    deleted.append(song_id)
+                else:
+                    songs.append(Song(*row))
+    library.insert_many((s.song_id, s) for s in songs)
+    library.delete_many(deleted)
+
+    def resolve(ids):
+        return [song for song in map(library.search, ids) if song]
+
+    queue.removed = header["queue_removed"]
+    history.pushed = header["history_base"]
+    for record in records[1:]:
+        kind = record[0]
+        if kind == "playlist":
+            for song in resolve(record[1]):
+                playlist.insert_at_end(song)
+        elif kind == "queue":
+            queue.enqueue_many(resolve(record[1]))
+        elif kind == "history":
+            for song in resolve(record[1]):
+                history.push(song)
+        elif kind == "user_playlist":
+            _, user, name, ids = record
+            playlists.create(user, name)
+            playlists.add(user, name, ids)
+    if header["playlist_reversed"]:
+        playlist.reverse()
+    if header.get("playlist_shuffle"):
+        playlist.shuffle = Shuffle.from_dict(header["playlist_shuffle"])
+    if header.get("queue_shuffle"):
+        queue.shuffle = Shuffle.from_dict(header["queue_shuffle"])
+    return True
+
+
+class LocalState:
+    # single process: ops are applied directly
+    def run(self, name, *args):
+        return apply_op(name, args)
+
+    def batch(self):
+        return nullcontext()
+
+    def sync(self):
+        pass
+
+
+class SQLiteState:
+    # Op log in a SQLite database in WAL mode, shared by all workers.
+    # A write takes the database write lock (BEGIN IMMEDIATE), replays any
+    # ops other workers appended, applies its own op and appends it, so
+    # every worker sees one total order. Reads call sync() first.
+    # batch() groups several ops into a single transaction/commit, and
+    # synchronous=NORMAL lets WAL checkpoints batch the fsyncs.
+    #
+    # Every `compact_every` ops the worker that crosses the mark takes a
+    # cut inside its write transaction and saves a snapshot (same records
+    # as JournalState) from a background thread. A new worker loads the
+    # newest snapshot and replays only the ops after it. Each worker
+    # records how far it has applied in the workers table, and ops are
+    # deleted only up to the snapshot and the slowest live worker, so no
+    # running worker ever finds a gap in the log.
+    def __init__(self, path, timeout=30.0, compact_every=100_000):
+        self.path = path
+        self.timeout = timeout
+        self.compact_every = compact_every
+        self.applied = 0  # seq of the last op applied in this process
+        self.snapshot_seq = 0  # newest snapshot taken or loaded
+        self.compactions = 0
+        self.library_changes = {}  # see track_library()
+        self._reported = None  # applied as last written to the workers table
+        self._db = None
+        self._pid = None
+        self._depth = 0
+        self._compactor = None
+        self._lock = threading.RLock()
+
+    def _connect(self):
+        db = sqlite3.connect(
+            self.path,
+            timeout=self.timeout,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def _conn(self):
+        # connections must not cross a fork, so reopen in each worker
+        if self._db is None or self._pid != os.getpid():
+            db = self._connect()
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS ops ("
+                "seq INTEGER PRIMARY KEY, name TEXT NOT NULL, args TEXT NOT NULL)"
+            )
+            # body is NULL while the worker `pid` is still writing it
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS snapshots ("
+                "seq INTEGER PRIMARY KEY, pid INTEGER NOT NULL, body BLOB)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS workers ("
+                "pid INTEGER PRIMARY KEY, applied INTEGER NOT NULL)"
+            )
+            self._db, self._pid, self._reported = db, os.getpid(), None
+        return self._db
+
+    def _catch_up(self, db):
+        # runs inside a transaction, so the snapshot and the ops after it
+        # are read as of one moment
+        if not self.applied:
+            row = db.execute(
+                "SELECT seq, body FROM snapshots WHERE body IS NOT NULL "
+                "ORDER BY seq DESC LIMIT 1"
+            ).fetchone()
+            if row:
+                records = [json.loads(line) for line in row[1].splitlines()]
+                if load_snapshot(records, self.library_changes):
+                    self.applied = self.snapshot_seq = row[0]
+        first = db.execute("SELECT min(seq) FROM ops").fetchone()[0]
+        if first is not None and first > self.applied + 1:
+            raise RuntimeError(
+                f"ops {self.applied + 1}-{first - 1} were compacted away before "
+                "this worker applied them; restart it to load the snapshot"
+            )
+        rows = db.execute(
+            "SELECT seq, name, args FROM ops WHERE seq > ? ORDER BY seq",
+            (self.applied,),
+        )
+        for seq, name, args in rows:
+            args = json.loads(args)
+            try:
+                track_library(self.library_changes, name, args, apply_op(name, args))
+            except Exception as e:
+                print(f"Replaying op {seq} ({name}) failed: {e}")
+            self.applied = seq
+
+    def _report(self, db):
+        # in a write transaction: tell the compactor how far this worker is
+        if self._reported != self.applied:
+            db.execute(
+                "INSERT OR REPLACE INTO workers (pid, applied) VALUES (?, ?)",
+                (self._pid, self.applied),
+            )
+            self._reported = self.applied
+
+    def sync(self):
+        with self._lock:
+            if self._depth:
+                return
+            db = self._conn()
+            if self._reported is None:
+                # first sync in this process: register while catching up
+                with self.batch():
+                    pass
+                return
+            db.execute("BEGIN")
+            try:
+                self._catch_up(db)
+            finally:
+                db.execute("COMMIT")
+            if self.applied - self._reported >= self.compact_every // 2:
+                # a read-mostly worker still lets the log be truncated
+                with self.batch():
+                    pass
+
+    @contextmanager
+    def batch(self):
+        with self._lock:
+            db = self._conn()
+            if not self._depth:
+                db.execute("BEGIN IMMEDIATE")
+                try:
+                    self._catch_up(db)
+                except BaseException:
+                    db.execute("ROLLBACK")
+                    raise
+            self._depth += 1
+            try:
+                yield
+            finally:
+                # ops already applied locally are committed even if a later
+                # one raised, so this process never runs ahead of the log
+                self._depth -= 1
+                if not self._depth:
+                    self._report(db)
+                    cut = self._maybe_cut(db)
+                    db.execute("COMMIT")
+                    if cut:
+                        self._compactor = threading.Thread(
+                            target=self._save_snapshot, args=(cut,),
+                            name="state-compaction", daemon=True,
+                        )
+                        self._compactor.start()
+
+    def run(self, name, *args):
+        with self.batch():
+            result = apply_op(name, args)
+            track_library(self.library_changes, name, args, result)
+            cur = self._conn().execute(
+                "INSERT INTO ops (name, args) VALUES (?, ?)", (name, json.dumps(args))
+            )
+            self.applied = cur.lastrowid
+            return result
+
+    def _maybe_cut(self, db):
+        # Still inside the write transaction, so this process's state is
+        # exactly the log up to self.applied. Claims the snapshot with a
+        # NULL row so other workers don't take the same cut.
+        if self.applied - self.snapshot_seq < self.compact_every:
+            return None
+        if self._compactor and self._compactor.is_alive():
+            return None
+        for seq, pid in db.execute(
+            "SELECT seq, pid FROM snapshots WHERE body IS NULL"
+        ).fetchall():
+            if pid_alive(pid):
+                return None  # another worker is still writing one
+            db.execute("DELETE FROM snapshots WHERE seq = ?", (seq,))
+        newest = db.execute("SELECT max(seq) FROM snapshots").fetchone()[0] or 0
+        self.snapshot_seq = max(self.snapshot_seq, newest)
+        if self.applied - self.snapshot_seq < self.compact_every:
+            return None
+        self.snapshot_seq = self.applied
+        db.execute(
+            "INSERT INTO snapshots (seq, pid) VALUES (?, ?)", (self.applied, self._pid)
+        )
+        return snapshot_cut(self.applied, self.library_changes)
+
+    def compact(self):
+        # take a snapshot now, whatever the op count
+        with self._lock:
+            if self._compactor:
+                self._compactor.join()  # or _maybe_cut would skip this one
+            every, self.compact_every = self.compact_every, 0
+            try:
+                with self.batch():
+                    pass
+            finally:
+                self.compact_every = every
+            compactor = self._compactor
+        if compactor:
+            compactor.join()
+
+    def _save_snapshot(self, cut):
+        seq = cut["header"]["seq"]
+        lines = []
+        for record in snapshot_records(cut):
+            lines.append(json.dumps(record))
+            time.sleep(0)  # see JournalState.compact
+        body = "\n".join(lines).encode("utf-8")
+        # a connection of its own: the worker's is used by request threads
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("UPDATE snapshots SET body = ? WHERE seq = ?", (body, seq))
+            live = []
+            for pid, applied in db.execute("SELECT pid, applied FROM workers").fetchall():
+                if pid_alive(pid):
+                    live.append(applied)
+                else:
+                    db.execute("DELETE FROM workers WHERE pid = ?", (pid,))
+            upto = min([seq] + live)
+            db.execute("DELETE FROM ops WHERE seq <= ?", (upto,))
+            db.execute(
+                "DELETE FROM snapshots WHERE seq < ? AND body IS NOT NULL", (seq,)
+            )
+            db.execute("COMMIT")
+        finally:
+            db.close()
+        self.compactions += 1
+
+    def stats(self):
+        return {
+            "applied": self.applied,
+            "snapshot_seq": self.snapshot_seq,
+            "compactions": self.compactions,
+        }
+
+
+def pid_alive(pid):
+    # workers share a database only on one host, so a pid check will do
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass  # alive, owned by someone else
+    return True
+
+
+def fsync_dir(path):
+    # makes a rename/unlink in `path` durable (not possible on Windows)
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class JournalState:
+    # Durable state for a single process. Ops are applied, then appended
+    # to a write-ahead log segment in `directory`; run() returns once its
+    # op is fsynced. One flusher thread writes and fsyncs whatever queued
+    # up during the previous fsync, so concurrent writers share fsyncs
+    # (group commit). wait=False acknowledges before the fsync instead,
+    # at the cost of losing up to one flush of ops on a crash.
+    #
+    # Every `compact_every` ops a background thread writes a snapshot of
+    # the state as of a cut and deletes the segments it covers, so
+    # recovery loads one snapshot and replays at most about
+    # `compact_every` ops. The cut itself only copies ids under the lock;
+    # the library is saved as the songs changed since it was loaded.
+    def __init__(self, directory, compact_every=100_000, wait=True):
+        self.directory = directory
+        self.compact_every = compact_every
+        self.wait = wait
+        self.seq = 0  # last op applied
+        self.synced = 0  # last op known to be on disk
+        self.snapshot_seq = 0  # op the newest snapshot (or cut) covers
+        self.error = None
+        self.recovery = None
+        self.compactions = 0
+        self.last_cut_ms = self.last_snapshot_s = None
+        self.library_changes = {}  # see track_library()
+        self._pending = []  # (seq, line), or (None, first seq of a new segment)
+        self._segment = None
+        self._recovered = False
+        self._depth = 0
+        self._compactor = None
+        self._dir_lock = None
+        self._lock = threading.RLock()
+        self._flushed = threading.Condition()
+
+    def _path(self, kind, seq):
+        return os.path.join(self.directory, f"{kind}-{seq:012d}.ndjson")
+
+    def _files(self, kind):
+        # [(first seq, path)] oldest first
+        out = []
+        for name in os.listdir(self.directory):
+            if name.startswith(kind + "-") and name.endswith(".ndjson"):
+                out.append((int(name[len(kind) + 1 : -7]), os.path.join(self.directory, name)))
+        return sorted(out)
+
+    @staticmethod
+    def _encode(record):
+        body = json.dumps(record, separators=(",", ":"))
+        return f"{zlib.crc32(body.encode('utf-8')):08x} {body}\n".encode("utf-8")
+
+    @staticmethod
+    def _read_log(path):
+        # yields [seq, name, args]; a torn or corrupt tail (a crash mid
+        # write) is cut off so later appends don't land after garbage
+        good = 0
+        with open(path, "rb") as f:
+            for line in f:
+                crc, _, body = line.rstrip(b"\n").partition(b" ")
+                if not line.endswith(b"\n") or crc != b"%08x" % zlib.crc32(body):
+                    print(f"Truncating {path} at byte {good}: incomplete record")
+                    os.truncate(path, good)
+                    return
+                good += len(line)
+                yield json.loads(body)
+
+    def _lock_directory(self):
+        # two processes appending to one log would interleave their ops
+        os.makedirs(self.directory, exist_ok=True)
+        if fcntl is None:
+            return
+        self._dir_lock = open(os.path.join(self.directory, "LOCK"), "w")
+        try:
+            fcntl.flock(self._dir_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            raise RuntimeError(
+                f"{self.directory} is in use by another process; "
+                "use STATE_DB to share state between workers"
+            )
+
+    def _recover(self):
+        start = time.perf_counter()
+        self._lock_directory()
+        for name in os.listdir(self.directory):
+            if name.endswith(".tmp"):
+                os.remove(os.path.join(self.directory, name))
+        for seq, path in reversed(self._files("snapshot")):
+            if self._load_snapshot(path):
+                self.seq = self.snapshot_seq = seq
+                break
+            print(f"Ignoring incomplete snapshot {path}")
+        loaded = time.perf_counter()
+
+        replayed = 0
+        for _, path in self._files("log"):
+            for seq, name, args in self._read_log(path):
+                if seq <= self.seq:
+                    continue
+                try:
+                    track_library(self.library_changes, name, args, apply_op(name, args))
+                except Exception as e:
+                    print(f"Replaying op {seq} ({name}) failed: {e}")
+                self.seq = seq
+                replayed += 1
+
+        # new ops always go to a fresh segment
+        self.synced = self.seq
+        self._pending.append((None, self.seq + 1))
+        threading.Thread(target=self._flush_loop, name="state-log", daemon=True).start()
+        self.recovery = {
+            "snapshot_seq": self.snapshot_seq,
+            "replayed_ops": replayed,
+            "snapshot_seconds": round(loaded - start, 3),
+            "seconds": round(time.perf_counter() - start, 3),
+        }
+        print(
+            f"Recovered state from {self.directory}: snapshot at op {self.snapshot_seq}, "
+            f"{replayed} ops replayed, {self.recovery['seconds']}s"
+        )
+        self._recovered = True
+        self._maybe_compact()
+
+    def _load_snapshot(self, path):
+        with open(path, "rb") as f:
+            return load_snapshot([json.loads(line) for line in f], self.library_changes)
+
+    def sync(self):
+        # the first call (catalog warm-up or first request) recovers
+        if not self._recovered:
+            with self._lock:
+                if not self._recovered:
+                    self._recover()
+
+    @contextmanager
+    def batch(self):
+        # ops in a batch wait for a single fsync at the end
+        self.sync()
+        with self._lock:
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+                outer, seq = not self._depth, self.seq
+        if outer:
+            self._wait(seq)
+
+    def run(self, name, *args):
+        with self.batch():
+            result = apply_op(name, args)
+            track_library(self.library_changes, name, args, result)
+            self.seq += 1
+            line = self._encode([self.seq, name, list(args)])
+            with self._flushed:
+                self._pending.append((self.seq, line))
+                self._flushed.notify_all()
+            self._maybe_compact()
+            return result
+
+    def _wait(self, seq):
+        if not self.wait:
+            return
+        with self._flushed:
+            while self.synced < seq and self.error is None:
+                self._flushed.wait()
+            if self.error is not None:
+                raise OSError(f"state log write failed: {self.error}")
+
+    def _flush_loop(self):
+        while True:
+            with self._flushed:
+                while not self._pending:
+                    self._flushed.wait()
+                batch, self._pending = self._pending, []
+            try:
+                last = self._write(batch)
+            except OSError as e:
+                with self._flushed:
+                    self.error = e
+                    self._flushed.notify_all()
+                return
+            with self._flushed:
+                self.synced = max(self.synced, last)
+                self._flushed.notify_all()
+
+    def _write(self, batch):
+        last = 0
+        for seq, data in batch:
+            if seq is None:
+                # data is the first seq of the next segment
+                if self._segment is not None:
+                    os.fsync(self._segment.fileno())
+                    self._segment.close()
+                self._segment = open(self._path("log", data), "ab")
+                fsync_dir(self.directory)
+                continue
+            self._segment.write(data)
+            last = seq
+        self._segment.flush()
+        os.fsync(self._segment.fileno())
+        return last
+
+    def close(self):
+        # flush anything still queued (wait=False) before the process exits
+        if self._recovered:
+            wait, self.wait = self.wait, True
+            self._wait(self.seq)
+            self.wait = wait
+
+    def _maybe_compact(self):
+        due = self.seq - self.snapshot_seq >= self.compact_every
+        if due and not (self._compactor and self._compactor.is_alive()):
+            self._compactor = threading.Thread(
+                target=self.compact, name="state-compaction", daemon=True
+            )
+            self._compactor.start()
+
+    def compact(self):
+        # the cut: under the lock, copy ids (not songs) and start a new
+        # segment; everything slow happens after the lock is released
+        with self._lock:
+            start = time.perf_counter()
+            seq = self.snapshot_seq = self.seq
+            cut = snapshot_cut(seq, self.library_changes)
+            with self._flushed:
+                self._pending.append((None, seq + 1))
+                self._flushed.notify_all()
+            self.last_cut_ms = round((time.perf_counter() - start) * 1000, 2)
+
+        final = self._path("snapshot", seq)
+        with open(final + ".tmp", "wb") as f:
+            for record in snapshot_records(cut):
+                f.write(json.dumps(record).encode("utf-8") + b"\n")
+                # let request threads take the GIL between records, so
+                # serializing never holds them up for a whole switch interval
+                time.sleep(0)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(final + ".tmp", final)
+        fsync_dir(self.directory)
+
+        # the snapshot covers every op up to seq
+        for first, path in self._files("log"):
+            if first <= seq:
+                os.remove(path)
+        for old, path in self._files("snapshot"):
+            if old < seq:
+                os.remove(path)
+        self.compactions += 1
+        self.last_snapshot_s = round(time.perf_counter() - start, 3)
+
+    def stats(self):
+        return {
+            "seq": self.seq,
+            "synced": self.synced,
+            "snapshot_seq": self.snapshot_seq,
+            "compactions": self.compactions,
+            "last_cut_ms": self.last_cut_ms,
+            "last_snapshot_s": self.last_snapshot_s,
+            "recovery": self.recovery,
+        }
+
+
+# STATE_DB=/path/to/state.db shares state between gunicorn workers. A
+# write is one SQLite commit; with synchronous=NORMAL that skips the
+# fsync, so it is fast but the last commits can be lost on power failure.
+# STATE_LOG=/path/to/dir makes one process's state survive restarts. A
+# write returns once its op is fsynced, so its latency is the disk's
+# fsync time (shared by concurrent writers). STATE_LOG_WAIT=0 returns
+# before the fsync instead: sub-millisecond writes, but a crash can lose
+# the ops of the last flush.
+STATE_DB = os.environ.get("STATE_DB")
+STATE_LOG = os.environ.get("STATE_LOG")
+if STATE_DB:
+    state = SQLiteState(
+        STATE_DB, compact_every=int(os.environ.get("STATE_DB_COMPACT", 100_000))
+    )
+elif STATE_LOG:
+    state = JournalState(
+        STATE_LOG,
+        compact_every=int(os.environ.get("STATE_LOG_COMPACT", 100_000)),
+        wait=os.environ.get("STATE_LOG_WAIT", "1") != "0",
+    )
+    atexit.register(state.close)
+else:
+    state = LocalState()
 
 # ----------------------------------------------------
 # FLASK APP
@@ -443,6 +4035,39 @@ for s in songs:
 # ----------------------------------------------------
 app = Flask(__name__)
 
+# endpoints that work before the catalog has loaded
+NO_CATALOG_ENDPOINTS = {"home", "ready", "static"}
+
+
+@app.before_request
+def require_catalog():
+    if catalog.ready or request.endpoint in NO_CATALOG_ENDPOINTS:
+        return None
+    if catalog.warming_up:
+        message = "Song library is warming up, please retry in a moment."
+        if request.path.startswith("/api/"):
+            return {"error": message}, 503, {"Retry-After": "1"}
+        return message, 503, {"Retry-After": "1"}
+    # no background warm-up running: load on this request
+    catalog.load()
+    return None
+
+
+@app.before_request
+def sync_state():
+    if request.endpoint not in NO_CATALOG_ENDPOINTS:
+        state.sync()
+
+
+@app.route("/ready", methods=["GET"])
+def ready():
+    if catalog.ready:
+        return {"ready": True, "songs": len(catalog.library)}
+    # a readiness probe may be the only traffic before routing starts, so
+    # it starts the background load itself rather than waiting for one
+    catalog.warm_up()
+    return {"ready": False, "warming_up": catalog.warming_up}, 503
+
 
 @app.route("/", methods=["GET"])
 def home():
@@ -455,50 +4080,30 @@ def library_action():
     song_id = request.form.get("song_id", "").strip()
     action = request.form.get("action")
 
-    # SEARCH
+    # SEARCH: id, then exact title, then partial title (cached); failing
+    # those, the closest matches over every field
     if action == "search":
-        q = song_id.lower()
-
-        # 1 ID match
-        by_id = library.search(song_id.upper())
-        if by_id:
-            return render_template(
-                "index.html",
-                active_section="library-section",
-                library_last_query=song_id,
-                library_output_search=str(by_id),
-            )
-
-        # 2 exact title
-        by_title = library.search_by_title(q)
-        if by_title:
-            return render_template(
-                "index.html",
-                active_section="library-section",
-                library_last_query=song_id,
-                library_output_search="\n".join(str(s) for s in by_title),
-            )
-
-        # 3 partial title
-        by_partial = library.search_by_partial_title(q)
-        if by_partial:
-            return render_template(
-                "index.html",
-                active_section="library-section",
-                library_last_query=song_id,
-                library_output_search="\n".join(str(s) for s in by_partial),
+        found = catalog.library.find(song_id)
+        if found:
+            output = "\n".join(str(s) for s in found)
+        else:
+            ranked = catalog.library.search_ranked(song_id)
+            output = (
+                "No exact match. Closest matches:\n"
+                + "\n".join(str(s) for _, s in ranked)
+                if ranked
+                else "No match found."
             )
-
         return render_template(
             "index.html",
             active_section="library-section",
             library_last_query=song_id,
-            library_output_search="No match found.",
+            library_output_search=output,
         )
 
     # DELETE
     if action == "delete":
-        ok = library.delete(song_id)
+        ok = state.run("library.delete", song_id)
         return render_template(
             "index.html",
             active_section="library-section",
@@ -512,7 +4117,7 @@ def library_display():
     return render_template(
         "index.html",
         active_section="library-section",
-        library_output_buckets=library.display(),
+        library_output_buckets=catalog.library.display(),
     )
 
 
@@ -521,7 +4126,7 @@ def library_all():
     return render_template(
         "index.html",
         active_section="library-section",
-        library_output_all=library.display_all_songs(),
+        library_output_all=catalog.library.display_all_songs(),
     )
 
 
@@ -533,7 +4138,7 @@ def playlist_action():
 
     # reverse does NOT need song_id
     if action == "reverse":
-        playlist.reverse()
+        state.run("playlist.reverse")
         return render_template(
             "index.html",
             active_section="playlist-section",
@@ -541,6 +4146,22 @@ def playlist_action():
             playlist_reorder_song=None,
         )
 
+    # SHUFFLE PLAY: neither needs song_id
+    if action in ("shuffle", "smart", "shuffle_off"):
+        return render_template(
+            "index.html",
+            active_section="playlist-section",
+            playlist_output=set_shuffle("playlist", "off" if action == "shuffle_off" else action),
+        )
+
+    if action == "play_next":
+        msg, _ = play_shuffled()
+        return render_template(
+            "index.html",
+            active_section="playlist-section",
+            playlist_output=msg,
+        )
+
     # INSERT AFTER
     if action == "insert_after":
         target_id = request.form.get("target_id")
@@ -554,8 +4175,8 @@ def playlist_action():
                 playlist_insert_target=target_id,
             )
 
-        song = library.search(song_id)
-        target_song = library.search(target_id)
+        song = catalog.library.search(song_id)
+        target_song = catalog.library.search(target_id)
 
         if not song or not target_song:
             return render_template(
@@ -566,12 +4187,16 @@ def playlist_action():
                 playlist_insert_target=target_id,
             )
 
-        playlist.insert_after(target_id, song)
+        ok = state.run("playlist.insert_after", target_id, song_id)
 
         return render_template(
             "index.html",
             active_section="playlist-section",
-            playlist_output=f"Inserted {song.title} after {target_song.title}",
+            playlist_output=(
+                f"Inserted {song.title} after {target_song.title}"
+                if ok
+                else "Target not in playlist, or song already in playlist."
+            ),
             playlist_insert_new=song_id,
             playlist_insert_target=target_id,
         )
@@ -586,11 +4211,7 @@ def playlist_action():
                 playlist_reorder_song=song_id,
             )
 
-        ok = (
-            playlist.move_up(song_id)
-            if action == "move_up"
-            else playlist.move_down(song_id)
-        )
+        ok = state.run(f"playlist.{action}", song_id)
 
         return render_template(
             "index.html",
@@ -609,7 +4230,7 @@ def playlist_action():
                 playlist_modify_song=song_id,
             )
 
-        song = library.search(song_id)
+        song = catalog.library.search(song_id)
 
         if not song and action != "delete":
             return render_template(
@@ -620,15 +4241,15 @@ def playlist_action():
             )
 
         if action == "add_start":
-            playlist.insert_at_start(song)
-            msg = "Inserted at start."
+            ok = state.run("playlist.add_start", song_id)
+            msg = "Inserted at start." if ok else "Song already in playlist."
 
         elif action == "add_end":
-            playlist.insert_at_end(song)
-            msg = "Inserted at end."
+            ok = state.run("playlist.add_end", song_id)
+            msg = "Inserted at end." if ok else "Song already in playlist."
 
         else:  # delete
-            removed = playlist.delete_song(song_id)
+            removed = state.run("playlist.delete", song_id)
             msg = "Deleted." if removed else "Song not found."
 
         return render_template(
@@ -650,18 +4271,70 @@ def playlist_display():
 
 # ---------------------- QUEUE ----------------------
 def find_song(text):
-    if library.search(text):
-        return library.search(text)
+    found = catalog.library.find(text)
+    return found[0] if found else None
 
-    t = library.search_by_title(text.lower())
-    if t:
-        return t[0]
 
-    p = library.search_by_partial_title(text.lower())
-    if p:
-        return p[0]
+SIMILAR_COUNT = 10
+# songs queued by "Play Next" when it empties the queue; 0 turns it off
+QUEUE_AUTOFILL = int(os.environ.get("QUEUE_AUTOFILL", 5))
+
+
+def play_similar(song_id, count=SIMILAR_COUNT):
+    # enqueue the songs most like song_id, leaving out anything already
+    # queued or in the play history (as of the batch, so as other workers
+    # left them)
+    with state.batch():
+        with history.lock:
+            played = {song.song_id for song in history.iter_recent()}
+        picks = catalog.library.similar(song_id, count, played | queue.song_ids())
+        return state.run("queue.enqueue_many", [song.song_id for song in picks])
+
+
+def recent_artists():
+    # what smart shuffle keeps apart: the artists of the last few plays
+    with history.lock:
+        return {song.artist for song in history.iter_recent(0, SMART_SPREAD)}
+
+
+def play_next():
+    # A shuffle pick is made here and the op plays that entry, so other
+    # workers and a replay of the log play the same song whatever their
+    # own cursor would have picked.
+    # The batch makes the pick, the play and any autofill one commit.
+    with state.batch():
+        picked = queue.next_shuffled(recent_artists()) if queue.shuffle else None
+        if picked:
+            msg, song = state.run("queue.play", picked[0].song_id, picked[1])
+        else:
+            msg, song = state.run("queue.play_next")
+        if song and QUEUE_AUTOFILL and not len(queue):
+            play_similar(song.song_id, QUEUE_AUTOFILL)
+        return msg, song
+
+
+def play_shuffled():
+    # the playlist's shuffle pass, one song at a time (see play_next)
+    with state.batch():
+        if playlist.shuffle is None:
+            return "Shuffle is off.", None
+        song = playlist.next_shuffled(recent_artists())
+        if not song:
+            return "Shuffle finished, turn it on again to start over.", None
+        return state.run("playlist.play", song.song_id)
+
+
+def set_shuffle(target, mode, seed=None):
+    # target is "playlist" or "queue"; a missing seed is drawn here, not
+    # in the op, so the logged op says exactly what to replay
+    if mode not in SHUFFLE_MODES:
+        raise ValueError(f"mode must be one of {', '.join(SHUFFLE_MODES)}")
+    seed = random.randrange(1 << 32) if seed in (None, "") else int(seed)
+    state.run(f"{target}.shuffle", mode, seed)
+    if mode == "off":
+        return "Shuffle off."
+    return f"{'Smart shuffle' if mode == 'smart' else 'Shuffle'} on (seed {seed})."
 
-    return None
 
 @app.route("/queue", methods=["POST"])
 def queue_action():
@@ -682,15 +4355,13 @@ def queue_action():
             args["queue_output_display"] = "Song not found."
             return render_template("index.html", **args)
 
-        args["queue_output_display"] = queue.enqueue(song)
+        args["queue_output_display"] = state.run("queue.enqueue", song.song_id)
         args["queue_output"] = queue.display()
         return render_template("index.html", **args)
 
     # DEQUEUE
     if action == "dequeue":
-        msg, song = queue.dequeue()
-        if song:
-            history.push(song)
+        msg, song = play_next()
 
         args["queue_output_display"] = msg
         args["queue_output"] = queue.display()
@@ -704,9 +4375,27 @@ def queue_action():
         args["queue_output"] = queue.display()
         return render_template("index.html", **args)
 
+    # SHUFFLE MODE (Play Next then picks from the whole queue)
+    if action in ("shuffle", "smart", "shuffle_off"):
+        mode = "off" if action == "shuffle_off" else action
+        args["queue_output_display"] = set_shuffle("queue", mode)
+        return render_template("index.html", **args)
+
+    # PLAY SIMILAR (to the song entered, else the last one played)
+    if action == "similar":
+        song = find_song(song_id) if song_id else history.peek()
+        if not song:
+            args["queue_output_display"] = "Song not found."
+            return render_template("index.html", **args)
+
+        added = play_similar(song.song_id)
+        args["queue_output_display"] = "\n".join(added) or f"No new songs like {song.title}."
+        args["queue_output"] = queue.display()
+        return render_template("index.html", **args)
+
     # REPLAY
     if action == "replay":
-        args["queue_output_display"] = queue.replay(history)
+        args["queue_output_display"] = state.run("queue.replay")
         args["queue_output"] = queue.display()
         args["queue_last_song"] = ""
         return render_template("index.html", **args)
@@ -714,6 +4403,7 @@ def queue_action():
     args["queue_output_display"] = "Invalid action."
     return render_template("index.html", **args)
 
+
 @app.route("/queue/display", methods=["POST"])
 def queue_display():
     return render_template(
@@ -724,29 +4414,22 @@ def queue_display():
         queue_last_song=""
     )
 
+
 # ---------------------- HISTORY ----------------------
 @app.route("/history", methods=["POST"])
 def history_action():
     action = request.form.get("action")
 
     if action == "undo":
-        song = history.pop()
-        if not song:
-            return render_template(
-                "index.html",
-                active_section="history-section",
-                history_output="History empty.",
-            )
-
-        queue.enqueue(song)
+        msg, _ = state.run("history.undo")
         return render_template(
             "index.html",
             active_section="history-section",
-            history_output=f"Restored to queue: {song.title}",
+            history_output=msg,
         )
 
     if action == "clear":
-        history.items.clear()
+        state.run("history.clear")
         return render_template(
             "index.html",
             active_section="history-section",
@@ -763,8 +4446,450 @@ def history_display():
     )
 
 
-import os
+# ---------------------- JSON API (v1) ----------------------
+API_DEFAULT_LIMIT = 50
+API_MAX_LIMIT = 1000
+API_SEARCH_LIMIT = 10
+API_SEARCH_MAX = 100
+
+
+def encode_cursor(cursor):
+    raw = json.dumps(cursor, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(text):
+    if not text:
+        return None
+    return json.loads(base64.urlsafe_b64decode(text.encode("ascii")))
+
+
+def paginate(pairs, limit):
+    # pairs yields (song, cursor); only limit + 1 of them are ever pulled
+    page = list(islice(pairs, limit + 1))
+    has_more = len(page) > limit
+    page = page[:limit]
+    return {
+        "items": [song.to_dict() for song, _ in page],
+        "next_cursor": encode_cursor(page[-1][1]) if has_more else None,
+    }
+
+
+def api_page(structure):
+    try:
+        limit = int(request.args.get("limit", API_DEFAULT_LIMIT))
+        if limit < 1:
+            raise ValueError("limit must be positive")
+        cursor = decode_cursor(request.args.get("cursor"))
+        with structure.reading():
+            body = paginate(structure.scan(cursor), min(limit, API_MAX_LIMIT))
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        return {"error": f"Bad request: {e}"}, 400
+    body["total"] = len(structure)
+    return body
+
+
+def search_body(text, limit):
+    # ranked fuzzy search over every field, best first
+    text = (text or "").strip()
+    if not text:
+        raise ValueError("q is required")
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    ranked = catalog.library.search_ranked(text, min(limit, API_SEARCH_MAX))
+    return {"items": [dict(song.to_dict(), score=round(score, 4)) for score, song in ranked]}
+
+
+def int_arg(args, name):
+    value = args.get(name)
+    return int(value) if value not in (None, "") else None
+
+
+def query_body(args):
+    # filters: genre, year_min/year_max, duration_min/duration_max;
+    # facets=1 also counts genre/artist/decade over every match
+    limit = int(args.get("limit") or API_DEFAULT_LIMIT)
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    filters = {
+        "genre": args.get("genre") or None,
+        "year": (int_arg(args, "year_min"), int_arg(args, "year_max")),
+        "duration": (int_arg(args, "duration_min"), int_arg(args, "duration_max")),
+    }
+    library = catalog.library
+    cursor = decode_cursor(args.get("cursor"))
+    body = paginate(library.query(cursor=cursor, **filters), min(limit, API_MAX_LIMIT))
+    body["total"] = library.query_count(**filters)
+    if args.get("facets") == "1":
+        facets = {"genre": Counter(), "artist": Counter(), "decade": Counter()}
+        for song, _ in library.query(**filters):
+            facets["genre"][song.genre] += 1
+            facets["artist"][song.artist] += 1
+            facets["decade"][decade(song.year)] += 1
+        body["total"] = sum(facets["genre"].values())
+        body["facets"] = {name: dict(counter.most_common()) for name, counter in facets.items()}
+    return body
+
+
+def facets_body(args):
+    top = int_arg(args, "top")
+    if top is not None and top < 1:
+        raise ValueError("top must be positive")
+    return catalog.library.facet_counts(top)
+
+
+def analytics_body(args):
+    # kind=group: by (genre/artist/album/year/decade), value (duration/year),
+    #   agg (count/sum/mean/min/max), optional top=k and order=asc;
+    # kind=histogram: field (duration/year) and optional width
+    columns = catalog.library.columns()
+    kind = args.get("kind") or "group"
+    if kind == "group":
+        order = args.get("order") or "desc"
+        if order not in ("asc", "desc"):
+            raise ValueError("order must be asc or desc")
+        items = columns.group_by(
+            args.get("by") or "genre",
+            args.get("value") or "duration",
+            args.get("agg") or "count",
+            int_arg(args, "top"),
+            ascending=order == "asc",
+        )
+    elif kind == "histogram":
+        width = int_arg(args, "width")
+        items = columns.histogram(args.get("field") or "year", 1 if width is None else width)
+    else:
+        raise ValueError(f"unknown analytics kind: {kind}")
+    return {"items": items, "total": len(columns)}
+
+
+def similar_body(args):
+    song_id = (args.get("song_id") or "").strip()
+    if not song_id:
+        raise ValueError("song_id is required")
+    limit = int(args.get("limit") or SIMILAR_COUNT)
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    songs = catalog.library.similar(song_id, min(limit, API_SEARCH_MAX))
+    return {"items": [song.to_dict() for song in songs]}
+
+
+@app.route("/api/v1/library", methods=["GET"])
+def api_library():
+    return api_page(catalog.library)
+
+
+@app.route("/api/v1/library/query", methods=["GET"])
+def api_library_query():
+    try:
+        return query_body(request.args)
+    except (ValueError, KeyError, TypeError) as e:
+        return {"error": f"Bad request: {e}"}, 400
+
+
+@app.route("/api/v1/library/facets", methods=["GET"])
+def api_library_facets():
+    try:
+        return facets_body(request.args)
+    except ValueError as e:
+        return {"error": f"Bad request: {e}"}, 400
+
+
+@app.route("/api/v1/library/analytics", methods=["GET"])
+def api_library_analytics():
+    try:
+        return analytics_body(request.args)
+    except ValueError as e:
+        return {"error": f"Bad request: {e}"}, 400
+
+
+@app.route("/api/v1/library/similar", methods=["GET"])
+def api_library_similar():
+    try:
+        return similar_body(request.args)
+    except ValueError as e:
+        return {"error": f"Bad request: {e}"}, 400
+
+
+@app.route("/api/v1/library/search", methods=["GET"])
+def api_library_search():
+    try:
+        limit = int(request.args.get("limit", API_SEARCH_LIMIT))
+        return search_body(request.args.get("q"), limit)
+    except ValueError as e:
+        return {"error": f"Bad request: {e}"}, 400
+
+
+@app.route("/api/v1/playlist", methods=["GET"])
+def api_playlist():
+    return api_page(playlist)
+
+
+@app.route("/api/v1/queue", methods=["GET"])
+def api_queue():
+    return api_page(queue)
+
+
+@app.route("/api/v1/history", methods=["GET"])
+def api_history():
+    return api_page(history)
+
+
+# ---------------------- STREAMING EXPORT ----------------------
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+
+def export_csv_lines(songs):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(CSV_COLUMNS)
+    for s in songs:
+        writer.writerow(
+            (s.song_id, s.title, s.artist, s.album, s.genre, s.duration, s.year)
+        )
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    # the header alone, for an empty library
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def export_ndjson_lines(songs):
+    for s in songs:
+        yield json.dumps(s.to_dict()) + "\n"
+
+
+def accepts_gzip(accept_encoding):
+    # gzip only when the client lists it (or *) with q > 0 and doesn't
+    # prefer identity; "gzip;q=0" is a refusal
+    accepted = parse_accept_header(accept_encoding or "")
+    return accepted.best_match(["gzip", "identity"]) == "gzip"
+
+
+def export_chunks(lines, compress=False):
+    # Groups lines into ~EXPORT_CHUNK_BYTES chunks. The first line goes out on
+    # its own so the client sees bytes immediately; with compress=True each
+    # chunk is gzip'd and sync-flushed so it can be decoded as it arrives.
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+    def emit(text):
+        data = text.encode("utf-8")
+        return gz.compress(data) + gz.flush(zlib.Z_SYNC_FLUSH) if gz else data
+
+    pending, size, first = [], 0, True
+    for line in lines:
+        pending.append(line)
+        size += len(line)
+        if first or size >= EXPORT_CHUNK_BYTES:
+            yield emit("".join(pending))
+            pending, size, first = [], 0, False
+    if pending:
+        yield emit("".join(pending))
+    if gz:
+        yield gz.flush()
+
+
+def export_response(lines, mimetype, filename):
+    headers = {"Content-Disposition": f"attachment; filename={filename}"}
+    compress = accepts_gzip(request.headers.get("Accept-Encoding"))
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+        headers["Vary"] = "Accept-Encoding"
+    return Response(export_chunks(lines, compress), mimetype=mimetype, headers=headers)
+
+
+@app.route("/api/v1/library/export.csv", methods=["GET"])
+def export_library_csv():
+    lines = export_csv_lines(catalog.library.songs())
+    return export_response(lines, "text/csv", "songs.csv")
+
+
+@app.route("/api/v1/library/export.ndjson", methods=["GET"])
+def export_library_ndjson():
+    lines = export_ndjson_lines(catalog.library.songs())
+    return export_response(lines, "application/x-ndjson", "songs.ndjson")
+
+
+# ---------------------- NAMED PLAYLISTS ----------------------
+PLAYLIST_NAME_MAX = 100
+
+
+def required_text(value, field):
+    value = str(value or "").strip()
+    if not value:
+        raise ValueError(f"{field} is required")
+    if len(value) > PLAYLIST_NAME_MAX:
+        raise ValueError(f"{field} is longer than {PLAYLIST_NAME_MAX} characters")
+    return value
+
+
+def named_playlist_body(user, name, args):
+    limit = int(args.get("limit") or API_DEFAULT_LIMIT)
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    cursor = decode_cursor(args.get("cursor"))
+    library = catalog.library
+    with playlists.reading():
+        named = playlists.get(user, name)
+        songs = ((library.search(song_id), pos) for song_id, pos in named.scan(cursor))
+        body = paginate(((song, pos) for song, pos in songs if song), min(limit, API_MAX_LIMIT))
+        body["total"] = len(named)
+    return body
+
+
+def named_playlist_action(user, name, body):
+    # {"action": "create" | "add" | "remove" | "fork" | "delete", ...};
+    # add takes song_id or a song_ids list, fork takes to_name and
+    # optionally to_user (default: the same user)
+    user, name = required_text(user, "user"), required_text(name, "name")
+    action = body.get("action")
+    if action == "create":
+        return state.run("playlists.create", user, name)
+    if action == "add":
+        song_ids = body.get("song_ids") or [body.get("song_id")]
+        if not isinstance(song_ids, list):
+            raise ValueError("song_ids must be a list")
+        return state.run(
+            "playlists.add", user, name, [required_text(i, "song_id") for i in song_ids]
+        )
+    if action == "remove":
+        song_id = required_text(body.get("song_id"), "song_id")
+        return state.run("playlists.remove", user, name, song_id)
+    if action == "fork":
+        to_user = required_text(body.get("to_user") or user, "to_user")
+        to_name = required_text(body.get("to_name"), "to_name")
+        return state.run("playlists.fork", user, name, to_user, to_name)
+    if action == "delete":
+        return state.run("playlists.delete", user, name)
+    raise ValueError(f"unknown playlist action: {action}")
+
+
+@app.route("/api/v1/users/<user>/playlists", methods=["GET"])
+def api_user_playlists(user):
+    return {"items": playlists.names(user)}
+
+
+@app.route("/api/v1/users/<user>/playlists/<name>", methods=["GET"])
+def api_named_playlist(user, name):
+    try:
+        return named_playlist_body(user, name, request.args)
+    except KeyError as e:
+        return {"error": f"Not found: {e.args[0]}"}, 404
+    except (ValueError, TypeError) as e:
+        return {"error": f"Bad request: {e}"}, 400
+
+
+@app.route("/api/v1/users/<user>/playlists/<name>", methods=["POST"])
+def api_named_playlist_action(user, name):
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return {"error": "Bad request: body must be a JSON object"}, 400
+    try:
+        return {"result": named_playlist_action(user, name, body)}
+    except KeyError as e:
+        return {"error": f"Not found: {e.args[0]}"}, 404
+    except (ValueError, TypeError) as e:
+        return {"error": f"Bad request: {e}"}, 400
+
+
+# ---------------------- BULK IMPORT / DELETE ----------------------
+# Uploads are read as a stream and applied IMPORT_BATCH rows at a time,
+# one op per batch, so memory stays flat and the indexes are updated
+# once per batch rather than once per row. Each chunk is read off the
+# stream before its op starts, so a slow client never holds the state
+# lock or a write transaction while it is still sending.
+IMPORT_BATCH = 5000
+IMPORT_MAX_ERRORS = 20
+
+
+def upload_format(fmt, content_type):
+    # ?format= wins, then the Content-Type; CSV by default
+    if fmt:
+        if fmt not in ("csv", "ndjson"):
+            raise ValueError(f"unknown format {fmt}")
+        return fmt
+    return "ndjson" if "json" in (content_type or "") else "csv"
+
+
+def import_body(lines, fmt):
+    bad_rows = []
+    if fmt == "ndjson":
+        rows = read_ndjson_rows(lines, bad_rows)
+    else:
+        rows = read_csv_rows(lines, bad_rows)
+
+    start = time.perf_counter()
+    total = added = 0
+    while True:
+        batch = list(islice(rows, IMPORT_BATCH))
+        if not batch:
+            break
+        added += state.run("library.insert_many", batch)
+        total += len(batch)
+    return {
+        "rows": total,
+        "added": added,
+        "replaced": total - added,
+        "bad_rows": len(bad_rows),
+        "errors": [
+            {"line": line_num, "error": error}
+            for line_num, _, error in bad_rows[:IMPORT_MAX_ERRORS]
+        ],
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+
+def read_song_ids(lines):
+    # one id per line: bare, as a JSON string, or as {"song_id": ...};
+    # a "song_id" header line (a one-column CSV) is skipped
+    for line in lines:
+        line = line.strip()
+        if not line or line == "song_id":
+            continue
+        if line[0] in "{\"":
+            value = json.loads(line)
+            line = value["song_id"] if isinstance(value, dict) else value
+        yield str(line)
+
+
+def delete_body(lines):
+    ids = read_song_ids(lines)
+    requested = deleted = 0
+    while True:
+        batch = list(islice(ids, IMPORT_BATCH))
+        if not batch:
+            break
+        deleted += state.run("library.delete_many", batch)
+        requested += len(batch)
+    return {"requested": requested, "deleted": deleted, "missing": requested - deleted}
+
+
+def upload_lines():
+    return io.TextIOWrapper(request.stream, encoding="utf-8", newline="")
+
+
+@app.route("/api/v1/library/import", methods=["POST"])
+def api_library_import():
+    try:
+        fmt = upload_format(request.args.get("format"), request.content_type)
+        return import_body(upload_lines(), fmt)
+    except (ValueError, KeyError) as e:
+        return {"error": f"Bad request: {e}"}, 400
+
+
+@app.route("/api/v1/library/delete", methods=["POST"])
+def api_library_bulk_delete():
+    try:
+        return delete_body(upload_lines())
+    except (ValueError, KeyError) as e:
+        return {"error": f"Bad request: {e}"}, 400
+
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["build-snapshot"]:
+        build_snapshot(*sys.argv[2:4])
+        sys.exit(0)
+
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
@@ -0,0 +1,425 @@
+# %%
+# ASGI entry point, served alongside the Flask app:
+#
+#   uvicorn asgi:app
+#
+# Async handlers for the JSON API over the same library, playlist, queue
+# and history as app.py, using the same ops (so STATE_DB sharing works the
+# same way). Anything that walks data or may block on the state database
+# runs in a thread pool, so the event loop keeps accepting requests.
+import asyncio
+import io
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import app as music
+
+executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("ASGI_THREADS", 8)),
+    thread_name_prefix="music-asgi",
+)
+
+
+async def in_thread(fn, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, fn, *args)
+
+
+def synced(fn, *args):
+    # same as Flask's before_request: replay other workers' ops first
+    music.state.sync()
+    return fn(*args)
+
+
+def to_json(value):
+    if isinstance(value, music.Song):
+        return value.to_dict()
+    if isinstance(value, (list, tuple)):
+        return [to_json(v) for v in value]
+    return value
+
+
+# ----------------------------------------------------
+# REQUEST / RESPONSE HELPERS
+# ----------------------------------------------------
+class Request:
+    def __init__(self, scope, receive):
+        self.method = scope["method"]
+        self.path = scope["path"].rstrip("/") or "/"
+        self.query = {
+            k: v[-1] for k, v in parse_qs(scope["query_string"].decode("latin-1")).items()
+        }
+        self.headers = {
+            k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]
+        }
+        self.receive = receive
+
+    async def json(self):
+        body = b""
+        while True:
+            message = await self.receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        return json.loads(body) if body else {}
+
+
+async def send_json(send, status, body, headers=()):
+    data = json.dumps(body).encode("utf-8")
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(data)).encode("ascii")),
+                *headers,
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": data})
+
+
+class BadRequest(Exception):
+    pass
+
+
+class BodyReader(io.RawIOBase):
+    # The request body as a blocking file for code in the thread pool:
+    # each read waits on the event loop for the next chunk, so an upload
+    # is parsed as it arrives instead of being buffered whole.
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._chunk = b""
+        self._done = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._chunk and not self._done:
+            message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            self._chunk = message.get("body", b"")
+            self._done = not message.get("more_body")
+        n = min(len(buffer), len(self._chunk))
+        buffer[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        return n
+
+
+# ----------------------------------------------------
+# READ HANDLERS
+# ----------------------------------------------------
+STRUCTURES = {
+    "library": lambda: music.catalog.library,
+    "playlist": lambda: music.playlist,
+    "queue": lambda: music.queue,
+    "history": lambda: music.history,
+}
+
+
+def read_page(name, cursor_text, limit_text):
+    structure = STRUCTURES[name]()
+    try:
+        limit = int(limit_text or music.API_DEFAULT_LIMIT)
+        if limit < 1:
+            raise ValueError("limit must be positive")
+        cursor = music.decode_cursor(cursor_text)
+        with structure.reading():
+            body = music.paginate(structure.scan(cursor), min(limit, music.API_MAX_LIMIT))
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        raise BadRequest(str(e))
+    body["total"] = len(structure)
+    return body
+
+
+async def get_page(request, name):
+    return 200, await in_thread(
+        synced, read_page, name, request.query.get("cursor"), request.query.get("limit")
+    )
+
+
+def ranked_search(text, limit_text):
+    try:
+        return music.search_body(text, int(limit_text or music.API_SEARCH_LIMIT))
+    except ValueError as e:
+        raise BadRequest(str(e))
+
+
+def library_view(body, args):
+    try:
+        return body(args)
+    except (ValueError, KeyError, TypeError) as e:
+        raise BadRequest(str(e))
+
+
+async def get_library_view(request, body):
+    return 200, await in_thread(synced, library_view, body, request.query)
+
+
+async def get_search(request):
+    return 200, await in_thread(
+        synced, ranked_search, request.query.get("q"), request.query.get("limit")
+    )
+
+
+# ----------------------------------------------------
+# WRITE HANDLERS
+# ----------------------------------------------------
+# action -> (op name, request fields passed as op arguments)
+ACTIONS = {
+    "library": {
+        "delete": ("library.delete", ["song_id"]),
+    },
+    "playlist": {
+        "add_start": ("playlist.add_start", ["song_id"]),
+        "add_end": ("playlist.add_end", ["song_id"]),
+        "delete": ("playlist.delete", ["song_id"]),
+        "insert_after": ("playlist.insert_after", ["target_id", "song_id"]),
+        "move_up": ("playlist.move_up", ["song_id"]),
+        "move_down": ("playlist.move_down", ["song_id"]),
+        "reverse": ("playlist.reverse", []),
+    },
+    "queue": {
+        "enqueue": ("queue.enqueue", ["song_id"]),
+        "replay": ("queue.replay", []),
+    },
+    "history": {
+        "undo": ("history.undo", []),
+        "clear": ("history.clear", []),
+    },
+}
+
+
+def queue_similar(text):
+    song = music.find_song(text)
+    if not song:
+        raise BadRequest("song not found")
+    return music.play_similar(song.song_id)
+
+
+# actions that pick songs before running their ops -> (handler, fields)
+HANDLERS = {
+    "playlist": {
+        "play_next": (music.play_shuffled, []),
+    },
+    "queue": {
+        "dequeue": (music.play_next, []),
+        "similar": (queue_similar, ["song_id"]),
+    },
+}
+
+
+def required(body, fields):
+    args = []
+    for field in fields:
+        value = str(body.get(field) or "").strip()
+        if not value:
+            raise BadRequest(f"{field} is required")
+        args.append(value)
+    return args
+
+
+def run_action(section, body):
+    action = body.get("action")
+    if section == "queue" and action == "peek":
+        return music.queue.peek()
+    if section in ("playlist", "queue") and action == "shuffle":
+        # {"mode": "shuffle" | "smart" | "off", "seed": optional int}
+        try:
+            return music.set_shuffle(section, body.get("mode"), body.get("seed"))
+        except (ValueError, TypeError) as e:
+            raise BadRequest(str(e))
+    if action in HANDLERS.get(section, {}):
+        handler, fields = HANDLERS[section][action]
+        return handler(*required(body, fields))
+    if action not in ACTIONS[section]:
+        raise BadRequest(f"unknown {section} action: {action}")
+
+    op_name, fields = ACTIONS[section][action]
+    args = required(body, fields)
+    if op_name == "queue.enqueue":
+        # like the form, enqueue accepts an id, a title or part of one
+        song = music.find_song(args[0])
+        if not song:
+            raise BadRequest("song not found")
+        args = [song.song_id]
+    return music.state.run(op_name, *args)
+
+
+async def post_action(request, section):
+    try:
+        body = await request.json()
+    except ValueError:
+        raise BadRequest("body must be JSON")
+    if not isinstance(body, dict):
+        raise BadRequest("body must be a JSON object")
+    result = await in_thread(synced, run_action, section, body)
+    return 200, {"result": to_json(result)}
+
+
+def upload(body, lines, *args):
+    try:
+        return body(lines, *args)
+    except (ValueError, KeyError) as e:
+        raise BadRequest(str(e))
+
+
+async def post_upload(request, body, *args):
+    reader = BodyReader(request.receive, asyncio.get_running_loop())
+    lines = io.TextIOWrapper(io.BufferedReader(reader), encoding="utf-8", newline="")
+    return 200, await in_thread(synced, upload, body, lines, *args)
+
+
+async def post_import(request):
+    try:
+        fmt = music.upload_format(request.query.get("format"), request.headers.get("content-type"))
+    except ValueError as e:
+        raise BadRequest(str(e))
+    return await post_upload(request, music.import_body, fmt)
+
+
+def named_playlist_view(user, name, args):
+    try:
+        return music.named_playlist_body(user, name, args)
+    except (ValueError, TypeError) as e:
+        raise BadRequest(str(e))
+
+
+def named_playlist_action(user, name, body):
+    try:
+        return music.named_playlist_action(user, name, body)
+    except (ValueError, TypeError) as e:
+        raise BadRequest(str(e))
+
+
+async def user_playlists(request, user, name):
+    if name is None:
+        if request.method != "GET":
+            raise LookupError(request.path)
+        return 200, {"items": await in_thread(synced, music.playlists.names, user)}
+    if request.method == "GET":
+        return 200, await in_thread(synced, named_playlist_view, user, name, request.query)
+    if request.method != "POST":
+        raise LookupError(request.path)
+    try:
+        body = await request.json()
+    except ValueError:
+        raise BadRequest("body must be JSON")
+    if not isinstance(body, dict):
+        raise BadRequest("body must be a JSON object")
+    result = await in_thread(synced, named_playlist_action, user, name, body)
+    return 200, {"result": result}
+
+
+# ----------------------------------------------------
+# STREAMING EXPORT
+# ----------------------------------------------------
+EXPORTS = {
+    "/api/v1/library/export.csv": (music.export_csv_lines, b"text/csv"),
+    "/api/v1/library/export.ndjson": (music.export_ndjson_lines, b"application/x-ndjson"),
+}
+
+
+async def stream_export(request, send):
+    make_lines, mimetype = EXPORTS[request.path]
+    compress = music.accepts_gzip(request.headers.get("accept-encoding"))
+    chunks = music.export_chunks(make_lines(music.catalog.library.songs()), compress)
+
+    headers = [(b"content-type", mimetype)]
+    if compress:
+        headers += [(b"content-encoding", b"gzip"), (b"vary", b"Accept-Encoding")]
+    await send({"type": "http.response.start", "status": 200, "headers": headers})
+    while True:
+        # each chunk walks part of the table, so build it off the loop
+        chunk = await in_thread(next, chunks, None)
+        if chunk is None:
+            break
+        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+
+# ----------------------------------------------------
+# ROUTING
+# ----------------------------------------------------
+def route(request):
+    path, method = request.path, request.method
+    if path == "/api/v1/library/search" and method == "GET":
+        return get_search(request)
+    if path == "/api/v1/library/query" and method == "GET":
+        return get_library_view(request, music.query_body)
+    if path == "/api/v1/library/facets" and method == "GET":
+        return get_library_view(request, music.facets_body)
+    if path == "/api/v1/library/analytics" and method == "GET":
+        return get_library_view(request, music.analytics_body)
+    if path == "/api/v1/library/similar" and method == "GET":
+        return get_library_view(request, music.similar_body)
+    if path == "/api/v1/library/import" and method == "POST":
+        return post_import(request)
+    if path == "/api/v1/library/delete" and method == "POST":
+        return post_upload(request, music.delete_body)
+    parts = path.split("/")
+    # /api/v1/users/<user>/playlists[/<name>]
+    if parts[1:4] == ["api", "v1", "users"] and len(parts) in (6, 7) and parts[5] == "playlists":
+        return user_playlists(request, parts[4], parts[6] if len(parts) == 7 else None)
+    name = path.rsplit("/", 1)[-1]
+    if path == f"/api/v1/{name}" and name in STRUCTURES:
+        if method == "GET":
+            return get_page(request, name)
+        if method == "POST":
+            return post_action(request, name)
+    raise LookupError(path)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            music.catalog.warm_up()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            executor.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    request = Request(scope, receive)
+    if request.path == "/ready":
+        if music.catalog.ready:
+            await send_json(send, 200, {"ready": True, "songs": len(music.catalog.library)})
+        else:
+            music.catalog.warm_up()  # see app.ready()
+            await send_json(send, 503, {"ready": False, "warming_up": music.catalog.warming_up})
+        return
+
+    if not music.catalog.ready:
+        # servers without lifespan support start the warm-up here
+        music.catalog.warm_up()
+        await send_json(
+            send,
+            503,
+            {"error": "Song library is warming up, please retry in a moment."},
+            [(b"retry-after", b"1")],
+        )
+        return
+
+    try:
+        if request.path in EXPORTS and request.method == "GET":
+            await stream_export(request, send)
+            return
+        status, body = await route(request)
+    except LookupError:
+        status, body = 404, {"error": "Not found"}
+    except BadRequest as e:
+        status, body = 400, {"error": f"Bad request: {e}"}
+    await send_json(send, status, body)
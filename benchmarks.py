@@ -0,0 +1,1140 @@
+# %%
+# Micro-benchmarks for the music library data structures.
+#
+#   python benchmarks.py              # run everything
+#   python benchmarks.py title_index  # run one benchmark by name
+import asyncio
+import csv
+import heapq
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import deque
+from itertools import islice
+
+from app import (
+    HashTable,
+    LinkedList,
+    PlaylistStore,
+    Queue,
+    Song,
+    Stack,
+    load_songs,
+    stream_into_library,
+    write_snapshot,
+)
+
+
+WORDS = [
+    "midnight", "neon", "city", "lost", "horizon", "dream", "echo", "fire",
+    "summer", "rain", "shadow", "light", "velvet", "ocean", "silver", "road",
+    "heart", "storm", "golden", "night", "wild", "electric", "river", "sky",
+]
+GENRES = ["Pop", "Rock", "Jazz", "Alternative", "Hip-Hop", "Electronic", "Indie"]
+
+
+def synthetic_songs(n, seed=42):
+    rng = random.Random(seed)
+    for i in range(n):
+        title = " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 4))).title()
+        yield Song(
+            f"S{i:07d}",
+            title,
+            f"Artist {rng.randrange(n // 20 + 1)}",
+            f"Album {rng.randrange(n // 10 + 1)}",
+            rng.choice(GENRES),
+            rng.randint(120, 420),
+            rng.randint(1960, 2024),
+        )
+
+
+def write_csv(path, n):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(
+            ["song_id", "title", "artist", "album", "genre", "duration_sec", "release_year"]
+        )
+        for s in synthetic_songs(n):
+            writer.writerow(
+                [s.song_id, s.title, s.artist, s.album, s.genre, s.duration, s.year]
+            )
+
+
+def build_library(n):
+    library = HashTable(size=60)
+    for s in synthetic_songs(n):
+        library.insert(s.song_id, s)
+    return library
+
+
+def timed(fn, repeat=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - start) / repeat, result
+
+
+# ----------------------------------------------------
+# EXACT TITLE LOOKUP: INDEX VS FULL SCAN
+# ----------------------------------------------------
+def scan_by_title(library, title):
+    # the pre-index search_by_title: walk every bucket, lower-case every title
+    title = title.strip().lower()
+    matches = []
+    for bucket in library._buckets():
+        node = bucket
+        while node:
+            if node.value.title.strip().lower() == title:
+                matches.append(node.value)
+            node = node.next
+    return matches
+
+
+def bench_title_index(n=500_000):
+    library = build_library(n)
+    query = next(synthetic_songs(1)).title.upper()
+
+    scan_t, scanned = timed(lambda: scan_by_title(library, query))
+    index_t, indexed = timed(lambda: library.search_by_title(query), repeat=1000)
+    assert {s.song_id for s in scanned} == {s.song_id for s in indexed}
+
+    print(f"title lookup over {n} songs ({len(indexed)} matches)")
+    print(f"  full scan : {scan_t * 1e6:12.1f} us")
+    print(f"  index     : {index_t * 1e6:12.1f} us")
+    print(f"  speedup   : {scan_t / index_t:10.0f}x")
+
+
+# ----------------------------------------------------
+# PARTIAL TITLE SEARCH: TRIGRAM INDEX VS FULL SCAN
+# ----------------------------------------------------
+def scan_by_partial_title(library, partial):
+    partial = partial.strip().lower()
+    matches = []
+    for bucket in library._buckets():
+        node = bucket
+        while node:
+            if partial in node.value.title.lower():
+                matches.append(node.value)
+            node = node.next
+    return matches
+
+
+def bench_partial_index(n=500_000):
+    library = build_library(n)
+    print(f"partial title search over {n} songs")
+
+    for query in ["storm golden", "ight ri", "velvet"]:
+        scan_t, scanned = timed(lambda: scan_by_partial_title(library, query))
+        index_t, indexed = timed(lambda: library.search_by_partial_title(query), 5)
+        assert {s.song_id for s in scanned} == {s.song_id for s in indexed}
+        print(
+            f"  {query!r:16} {len(indexed):7} matches  "
+            f"scan {scan_t * 1000:8.1f} ms  index {index_t * 1000:8.1f} ms"
+        )
+
+
+# ----------------------------------------------------
+# SEARCH CACHE: SKEWED QUERY MIX WITH WRITES
+# ----------------------------------------------------
+def bench_search_cache(n=200_000, queries=20_000, write_ratios=(0, 0.001, 0.01)):
+    songs = list(synthetic_songs(n))
+    rng = random.Random(7)
+    # a few hundred distinct queries, popular ones asked far more often
+    pool = (
+        [s.song_id for s in rng.sample(songs, 100)]
+        + [s.title for s in rng.sample(songs, 100)]
+        + [" ".join(rng.sample(WORDS, 2)) for _ in range(100)]
+        + [w[1:5] for w in WORDS]
+    )
+    weights = [1 / (rank + 1) for rank in range(len(pool))]
+    workload = rng.choices(pool, weights, k=queries)
+
+    print(f"search over {n} songs, {queries} skewed queries")
+    for write_ratio in write_ratios:
+        # a write re-inserts a song, invalidating every query it could match
+        writes = [rng.random() < write_ratio for _ in range(queries)]
+        for label, cache_size in [("no cache", 0), ("LRU cache", 1024)]:
+            library = HashTable(size=60, cache_size=cache_size)
+            library.insert_many((s.song_id, s) for s in songs)
+
+            def run():
+                for text, write in zip(workload, writes):
+                    if write:
+                        song = rng.choice(songs)
+                        library.delete(song.song_id)
+                        library.insert(song.song_id, song)
+                    library.find(text)
+
+            t, _ = timed(run)
+            stats = library.cache.stats()
+            print(
+                f"  {write_ratio:5.1%} writes, {label:9}: {t / queries * 1e6:8.1f} us/query   "
+                f"hits {stats['hits']} misses {stats['misses']} "
+                f"evictions {stats['evictions']} invalidations {stats['invalidations']}"
+            )
+
+    # one- and two-letter partial queries each match a large share of the
+    # library; without a result budget every one of them would stay cached
+    short = sorted({w[i : i + k] for w in WORDS for k in (1, 2) for i in range(len(w) - k + 1)})
+    workload = rng.choices(short, k=queries // 10)
+    print(f"short partial queries: {len(short)} distinct, {len(workload)} asked")
+    for label, cache_results in [("unbounded", n * len(short)), ("result budget", 100_000)]:
+        library = HashTable(size=60, cache_results=cache_results)
+        library.insert_many((s.song_id, s) for s in songs)
+        t, _ = timed(lambda: [library.find(text) for text in workload])
+        stats = library.cache.stats()
+        print(
+            f"  {label:13}: {t / len(workload) * 1e3:8.2f} ms/query   "
+            f"songs held {stats['results']:>9}   entries {stats['entries']:4}   "
+            f"not cached (oversized) {stats['oversized']}"
+        )
+
+
+# ----------------------------------------------------
+# RANKED FUZZY SEARCH: LATENCY AT 1M SONGS
+# ----------------------------------------------------
+def typo(word, rng):
+    i = rng.randrange(len(word))
+    kind = rng.choice(["swap", "drop", "double", "replace"])
+    if kind == "swap" and i + 1 < len(word):
+        return word[:i] + word[i + 1] + word[i] + word[i + 2 :]
+    if kind == "drop":
+        return word[:i] + word[i + 1 :]
+    if kind == "double":
+        return word[:i] + word[i] + word[i:]
+    return word[:i] + rng.choice("aeiourst") + word[i + 1 :]
+
+
+def fuzzy_queries(songs, count, rng):
+    queries = []
+    for _ in range(count):
+        song = rng.choice(songs)
+        words = song.title.lower().split()
+        kind = rng.randrange(5)
+        if kind == 0:
+            queries.append(rng.choice(words))
+        elif kind == 1:
+            queries.append(" ".join(typo(w, rng) for w in words[:2]))
+        elif kind == 2:
+            queries.append(song.artist)
+        elif kind == 3:
+            queries.append(f"{words[0]} {song.genre} {song.artist.split()[-1]}")
+        else:
+            queries.append(song.title[: rng.randint(3, 8)])
+    return queries
+
+
+def bench_fuzzy(n=1_000_000, queries=500, k=10):
+    songs = list(synthetic_songs(n))
+    rng = random.Random(11)
+    workload = fuzzy_queries(songs, queries, rng)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "songs.snapshot")
+        write_snapshot(path, songs)
+        library = HashTable.from_snapshot(path, size=60)
+        # a few songs on top of the snapshot, as after edits
+        for song in rng.sample(songs, 1000):
+            library.insert(song.song_id, song)
+
+        build_t, _ = timed(library.search_index)
+        latencies = []
+        for text in workload:
+            t, results = timed(lambda: library.search_ranked(text, k))
+            latencies.append(t)
+        latencies.sort()
+
+        def pct(p):
+            return latencies[int(len(latencies) * p)] * 1000
+
+        print(f"ranked fuzzy search over {n} songs, {queries} queries, top {k}")
+        print(f"  index build : {build_t:8.2f} s")
+        print(
+            f"  latency     : p50 {pct(0.5):6.2f} ms   p95 {pct(0.95):6.2f} ms   "
+            f"max {latencies[-1] * 1000:6.2f} ms"
+        )
+        for text in workload[:5]:
+            top = library.search_ranked(text, 1)
+            print(f"  {text!r:32} -> {top[0][1].title if top else None}")
+
+        # churn on top of the snapshot: deleting most of the chained songs
+        # starts index compactions, which must not land on one request
+        churn = rng.sample(songs, 20_000)
+        library.insert_many((s.song_id, s) for s in churn)
+        deletes = []
+        for song in churn:
+            t, _ = timed(lambda: library.delete(song.song_id))
+            deletes.append(t)
+        deletes.sort()
+        print(
+            f"  delete      : p50 {deletes[len(deletes) // 2] * 1000:6.2f} ms   "
+            f"p99 {deletes[int(len(deletes) * 0.99)] * 1000:6.2f} ms   "
+            f"max {deletes[-1] * 1000:6.2f} ms"
+        )
+
+
+# ----------------------------------------------------
+# RANGE / FACET QUERIES: SORTED INDEXES VS FULL SCAN
+# ----------------------------------------------------
+def scan_query(library, genre=None, year=(None, None), duration=(None, None)):
+    def within(value, bounds):
+        lo, hi = bounds
+        return (lo is None or value >= lo) and (hi is None or value <= hi)
+
+    return [
+        s
+        for s in library.songs()
+        if (genre is None or s.genre.lower() == genre.lower())
+        and within(s.year, year)
+        and within(s.duration, duration)
+    ]
+
+
+def bench_query(n=1_000_000, page=50):
+    songs = list(synthetic_songs(n))
+    queries = [
+        {"genre": "Rock", "year": (1990, 1999), "duration": (None, 239)},
+        {"year": (2001, 2001)},
+        {"duration": (200, 202)},
+        {"genre": "Jazz", "year": (2020, 2024)},
+    ]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "songs.snapshot")
+        write_snapshot(path, songs)
+        library = HashTable.from_snapshot(path, size=60)
+        build_t, _ = timed(library.attribute_index)
+        print(f"range queries over {n} songs, first {page} results")
+        print(f"  index build : {build_t:8.2f} s")
+
+        for filters in queries:
+            scan_t, scanned = timed(lambda: scan_query(library, **filters))
+            index_t, first = timed(
+                lambda: [s for s, _ in islice(library.query(**filters), page)], 20
+            )
+            matched = {s.song_id for s in scanned}
+            assert len(first) == min(page, len(scanned))
+            assert all(s.song_id in matched for s in first)
+            label = ", ".join(f"{k}={v}" for k, v in filters.items())
+            print(
+                f"  {label:52} {len(scanned):7} matches  "
+                f"scan {scan_t * 1000:8.1f} ms  index {index_t * 1000:6.2f} ms"
+            )
+
+        facet_t, _ = timed(lambda: library.facet_counts(10), 20)
+        print(f"  facet counts (top 10) : {facet_t * 1000:.2f} ms")
+
+        # write cost with the indexes maintained
+        extra = list(synthetic_songs(10_000, seed=99))
+        insert_t, _ = timed(lambda: [library.insert("X" + s.song_id, s) for s in extra])
+        print(f"  insert with indexes   : {insert_t / len(extra) * 1e6:.1f} us/song")
+
+
+# ----------------------------------------------------
+# BULK IMPORT / DELETE VS PER-ROW, INDEXES BUILT
+# ----------------------------------------------------
+def indexed_library(songs):
+    library = HashTable(size=60)
+    library.insert_many((s.song_id, s) for s in songs)
+    library.search_index()
+    library.attribute_index()
+    for word in WORDS:
+        library.find(word)
+    return library
+
+
+def bench_bulk(n=200_000, incoming=200_000, batch=5000):
+    existing = list(synthetic_songs(n))
+    # half of the nightly feed re-sends known songs (one in ten edited),
+    # half is new
+    rng = random.Random(3)
+    feed = [
+        Song(s.song_id, s.title, s.artist, s.album, s.genre, s.duration, rng.randint(1960, 2024))
+        if rng.random() < 0.1
+        else s
+        for s in rng.sample(existing, incoming // 2)
+    ] + [
+        Song("N" + s.song_id, s.title, s.artist, s.album, s.genre, s.duration, s.year)
+        for s in synthetic_songs(incoming - incoming // 2, seed=3)
+    ]
+    gone = [s.song_id for s in random.Random(5).sample(existing, incoming // 2)]
+
+    print(f"sync {incoming} songs into {n} (search, attribute indexes and cache built)")
+    for label, bulk in [("per row", False), (f"batches of {batch}", True)]:
+        library = indexed_library(existing)
+
+        def ingest():
+            if not bulk:
+                for s in feed:
+                    library.insert(s.song_id, s)
+                return
+            for i in range(0, len(feed), batch):
+                library.insert_many((s.song_id, s) for s in feed[i : i + batch])
+
+        def remove():
+            if not bulk:
+                for song_id in gone:
+                    library.delete(song_id)
+                return
+            for i in range(0, len(gone), batch):
+                library.delete_many(gone[i : i + batch])
+
+        ingest_t, _ = timed(ingest)
+        delete_t, _ = timed(remove)
+        print(
+            f"  {label:18}: import {len(feed) / ingest_t:9.0f} rows/s   "
+            f"delete {len(gone) / delete_t:9.0f} rows/s   ({len(library)} songs)"
+        )
+
+
+# ----------------------------------------------------
+# ANALYTICS: NUMPY COLUMNS VS A PYTHON LOOP
+# ----------------------------------------------------
+def python_analytics(songs):
+    # the same three reports in one pass over Song objects
+    totals, counts, per_year, album_length = {}, {}, {}, {}
+    for s in songs:
+        totals[s.genre] = totals.get(s.genre, 0) + s.duration
+        counts[s.genre] = counts.get(s.genre, 0) + 1
+        per_year[s.year] = per_year.get(s.year, 0) + 1
+        album_length[s.album] = album_length.get(s.album, 0) + s.duration
+    mean_by_genre = {g: totals[g] / counts[g] for g in totals}
+    longest = heapq.nlargest(10, album_length.items(), key=lambda item: item[1])
+    return mean_by_genre, per_year, longest
+
+
+def numpy_analytics(columns):
+    return (
+        columns.group_by("genre", "duration", "mean"),
+        columns.histogram("year"),
+        columns.group_by("album", "duration", "sum", top=10),
+    )
+
+
+def bench_analytics(n=1_000_000):
+    songs = list(synthetic_songs(n))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "songs.snapshot")
+        write_snapshot(path, songs)
+        library = HashTable.from_snapshot(path, size=60)
+        print(f"mean duration by genre, songs per year, 10 longest albums over {n} songs")
+        build_t, columns = timed(library.columns)
+        print(f"  columns from snapshot : {build_t * 1000:8.1f} ms")
+        load_t, _ = timed(lambda: HashTable(size=60).columns().load(songs))
+        print(f"  columns from Songs    : {load_t * 1000:8.1f} ms")
+
+        loop_t, (means, per_year, longest) = timed(lambda: python_analytics(songs))
+        scan_t, _ = timed(lambda: python_analytics(library.songs()))
+        vector_t, (by_genre, years, albums) = timed(lambda: numpy_analytics(columns), 5)
+        assert {r["key"]: round(r["mean"], 6) for r in by_genre} == {
+            g: round(m, 6) for g, m in means.items()
+        }
+        assert {r["start"]: r["count"] for r in years if r["count"]} == per_year
+        assert [r["sum"] for r in albums] == [total for _, total in longest]
+        print(f"  python, Song list     : {loop_t * 1000:8.1f} ms")
+        print(f"  python, library scan  : {scan_t * 1000:8.1f} ms")
+        print(f"  numpy columns         : {vector_t * 1000:8.1f} ms  ({loop_t / vector_t:.0f}x)")
+
+        # the mirror is maintained on every write once built
+        extra = list(synthetic_songs(10_000, seed=99))
+        insert_t, _ = timed(lambda: [library.insert("X" + s.song_id, s) for s in extra])
+        print(f"  insert with columns   : {insert_t / len(extra) * 1e6:.1f} us/song")
+
+
+# ----------------------------------------------------
+# SIMILAR SONGS: NEIGHBOUR TABLE VS SCORING EVERY SONG
+# ----------------------------------------------------
+def bench_similar(n=1_000_000, queries=1000, writes=200, k=10):
+    library = HashTable(size=60)
+    library.insert_many((s.song_id, s) for s in synthetic_songs(n))
+    print(f"similar songs over {n} songs, top {k}")
+    build_t, index = timed(library.similar_index)
+    print(f"  neighbour table build : {build_t:8.2f} s")
+
+    rng = random.Random(11)
+    ids = [f"S{rng.randrange(n):07d}" for _ in range(queries)]
+    table_t, _ = timed(lambda: [index.similar(song_id, k) for song_id in ids])
+    with index._lock:
+        exact_t, exact = timed(
+            lambda: [index._everyone(index.row_of[song_id], k)[0][0] for song_id in ids[:50]]
+        )
+    found = sum(
+        len(set(index.similar(song_id, k)) & {index.ids[row] for row in rows})
+        for song_id, rows in zip(ids, exact)
+    )
+    print(f"  table lookup          : {table_t / queries * 1e6:8.1f} us/query")
+    print(f"  score every song      : {exact_t / 50 * 1e6:8.1f} us/query")
+    print(f"  recall@{k} vs exact    : {found / (50 * k):8.3f}")
+
+    extra = list(synthetic_songs(writes, seed=99))
+    insert_t, _ = timed(lambda: [library.insert("X" + s.song_id, s) for s in extra])
+    delete_t, _ = timed(lambda: [library.delete("X" + s.song_id) for s in extra])
+    print(f"  insert, table updated : {insert_t / writes * 1e6:8.1f} us/song")
+    print(f"  delete, table updated : {delete_t / writes * 1e6:8.1f} us/song")
+
+
+# ----------------------------------------------------
+# CASCADE DELETE: REVERSE REFS VS SCANNING EACH CONTAINER
+# ----------------------------------------------------
+def bench_cascade(playlist_size=100_000, queued=10_000, played=1000, deletes=1000):
+    songs = list(synthetic_songs(playlist_size))
+    rng = random.Random(7)
+    queue_songs = rng.choices(songs, k=queued)
+    history_songs = rng.choices(songs, k=played)
+    gone = [s.song_id for s in rng.sample(queue_songs, deletes)]
+
+    playlist = LinkedList()
+    for s in songs:
+        playlist.insert_at_end(s)
+    queue = Queue()
+    queue.enqueue_many(queue_songs)
+    history = Stack(capacity=played)
+    for s in history_songs:
+        history.push(s)
+
+    def cascade():
+        for song_id in gone:
+            for container in (playlist, queue, history):
+                container.discard_songs([song_id])
+
+    # what a delete had to do before: walk every container for the song
+    lists = [list(songs), list(queue_songs), list(history_songs)]
+
+    def scan():
+        for song_id in gone:
+            for i, items in enumerate(lists):
+                lists[i] = [s for s in items if s.song_id != song_id]
+
+    cascade_t, _ = timed(cascade)
+    scan_t, _ = timed(scan)
+    assert [len(playlist), len(queue), len(history)] == [len(items) for items in lists]
+    print(
+        f"delete {deletes} songs from a {playlist_size} song playlist, "
+        f"{queued} queued and {played} played"
+    )
+    print(f"  reverse refs: {cascade_t / deletes * 1e6:9.1f} us/delete")
+    print(f"  scan        : {scan_t / deletes * 1e6:9.1f} us/delete")
+
+
+# ----------------------------------------------------
+# NAMED PLAYLISTS: COPY-ON-WRITE FORKS AND EVICTION
+# ----------------------------------------------------
+def bench_playlists(size=100_000, forks=1000, users=200_000, per_user=20, max_loaded=10_000):
+    ids = [s.song_id for s in synthetic_songs(size)]
+    store = PlaylistStore()
+    store.create("u0", "big")
+    store.add("u0", "big", ids)
+
+    def fork_all():
+        for i in range(forks):
+            store.fork("u0", "big", f"f{i}", "big")
+
+    def copy_all():
+        return [list(ids) for _ in range(forks)]
+
+    fork_t, _ = timed(fork_all)
+    copy_t, _ = timed(copy_all)
+    copy_bytes = retained_bytes(copy_all)
+    for i in range(forks):
+        store.delete(f"f{i}", "big")
+    fork_bytes = retained_bytes(fork_all)
+    print(f"{forks} forks of a {size} song playlist")
+    print(f"  copy-on-write: {fork_t / forks * 1e6:9.1f} us/fork  {fork_bytes / forks:10.0f} B/fork")
+    print(f"  list copy    : {copy_t / forks * 1e6:9.1f} us/fork  {copy_bytes / forks:10.0f} B/fork")
+
+    store = PlaylistStore(max_loaded=max_loaded)
+    rng = random.Random(11)
+
+    def fill():
+        for u in range(users):
+            store.create(f"u{u}", "mix")
+            store.add(f"u{u}", "mix", rng.sample(ids, per_user))
+
+    def read(n=20_000):
+        for _ in range(n):
+            u = rng.randrange(users)
+            for _ in store.get(f"u{u}", "mix").scan():
+                pass
+        return n
+
+    fill_t, _ = timed(fill)
+    read_t, reads = timed(read)
+    print(f"{users} users x {per_user} songs, at most {max_loaded} playlists loaded")
+    print(f"  create + add   : {fill_t / users * 1e6:9.1f} us/playlist")
+    print(f"  random reads   : {read_t / reads * 1e6:9.1f} us/read   {store.stats()}")
+
+
+# ----------------------------------------------------
+# QUEUE: DEQUEUE COST AT DIFFERENT DEPTHS
+# ----------------------------------------------------
+def bench_queue(sizes=(10_000, 100_000, 1_000_000), ops=10_000):
+    song = next(synthetic_songs(1))
+    print(f"dequeue cost, averaged over {ops} dequeues")
+
+    for n in sizes:
+        queue = Queue()
+        queue.enqueue_many(song for _ in range(n))
+        per_op, _ = timed(lambda: [queue.dequeue() for _ in range(ops)])
+
+        old = [song] * n  # the previous list-backed queue used pop(0)
+        old_per_op, _ = timed(lambda: [old.pop(0) for _ in range(ops)])
+
+        print(
+            f"  {n:>9} queued: deque {per_op / ops * 1e9:8.0f} ns/op   "
+            f"list.pop(0) {old_per_op / ops * 1e9:10.0f} ns/op"
+        )
+
+
+# ----------------------------------------------------
+# SHUFFLE: LAZY FISHER-YATES VS SHUFFLING A COPY
+# ----------------------------------------------------
+def shuffled_steps(structure, steps, avoid):
+    # one play at a time the way the play ops do it, recent artists avoided
+    recent = deque(maxlen=3)
+    for _ in range(steps):
+        if isinstance(structure, Queue):
+            song, nth = structure.next_shuffled(set(recent) if avoid else ())
+            structure.take(song.song_id, nth)
+        else:
+            song = structure.next_shuffled(set(recent) if avoid else ())
+            structure.mark_played(song.song_id)
+        recent.append(song.artist)
+
+
+def bench_shuffle(n=1_000_000, steps=10_000):
+    songs = list(synthetic_songs(n))
+    print(f"first {steps} plays of a shuffled {n} song playlist / queue")
+    for label, make in [("playlist", LinkedList), ("queue", Queue)]:
+        for mode in ("shuffle", "smart"):
+            structure = make()
+            if label == "playlist":
+                for song in songs:
+                    structure.insert_at_end(song)
+            else:
+                structure.enqueue_many(songs)
+            structure.set_shuffle(mode, seed=1)
+            step_t, _ = timed(lambda: shuffled_steps(structure, steps, mode == "smart"))
+            structure.set_shuffle(mode, seed=2)
+            grown = retained_bytes(lambda: shuffled_steps(structure, steps, mode == "smart"))
+            print(
+                f"  {label:8} {mode:7}: {step_t / steps * 1e6:6.1f} us/play   "
+                f"{grown / steps:6.0f} B/play retained"
+            )
+
+    def copy_and_shuffle():
+        order = list(songs)
+        random.Random(1).shuffle(order)
+        return order
+
+    copy_t, _ = timed(copy_and_shuffle)
+    print(
+        f"  list copy + random.shuffle: {copy_t * 1000:.0f} ms up front, "
+        f"{retained_bytes(copy_and_shuffle) / 2**20:.1f} MiB"
+    )
+
+
+# ----------------------------------------------------
+# MEMORY: SONG OBJECTS VS COLUMNAR CATALOG
+# ----------------------------------------------------
+class DictSong:
+    # the Song class as it was before __slots__
+    def __init__(self, song_id, title, artist, album, genre, duration, year):
+        self.song_id = song_id
+        self.title = title
+        self.artist = artist
+        self.album = album
+        self.genre = genre
+        self.duration = int(duration)
+        self.year = int(year)
+
+
+def load_dict_songs(filename):
+    with open(filename, newline="", encoding="utf-8") as f:
+        return [
+            DictSong(
+                row["song_id"],
+                row["title"],
+                row["artist"],
+                row["album"],
+                row["genre"],
+                int(row["duration_sec"]),
+                int(row["release_year"]),
+            )
+            for row in csv.DictReader(f)
+        ]
+
+
+def retained_bytes(fn):
+    tracemalloc.start()
+    result = fn()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current
+
+
+def bench_memory(n=1_000_000):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "songs.csv")
+        write_csv(path, n)
+
+        baseline = retained_bytes(lambda: load_dict_songs(path))
+        print(f"memory held after loading {n} songs")
+        print(f"  Song with __dict__ : {baseline / n:7.1f} B/song")
+        for label, fn in [
+            ("Song with __slots__", lambda: load_songs(path)),
+            ("SongCatalog", lambda: load_songs(path, columnar=True)),
+        ]:
+            used = retained_bytes(fn)
+            print(f"  {label:19}: {used / n:7.1f} B/song  ({baseline / used:.1f}x smaller)")
+
+
+# ----------------------------------------------------
+# CSV LOAD: STREAMING LOADER THROUGHPUT
+# ----------------------------------------------------
+def bench_load(n=1_000_000):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "songs.csv")
+        write_csv(path, n)
+
+        def progress(rows, rate):
+            if rows % 250_000 == 0:
+                print(f"  {rows:>9} rows  {rate:>10.0f} rows/s")
+
+        print(f"streaming {n} rows into a HashTable")
+        library = HashTable(size=60)
+        elapsed, (loaded, bad_rows) = timed(
+            lambda: stream_into_library(library, path, on_progress=progress)
+        )
+        print(f"  loaded {loaded} rows in {elapsed:.2f} s, {len(bad_rows)} bad rows")
+
+
+# ----------------------------------------------------
+# COLD START: CSV PARSE VS MAPPED SNAPSHOT
+# ----------------------------------------------------
+def bench_snapshot(n=1_000_000):
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, "songs.csv")
+        snap_path = os.path.join(tmp, "songs.snapshot")
+        write_csv(csv_path, n)
+
+        build_t, _ = timed(lambda: write_snapshot(snap_path, synthetic_songs(n)))
+        print(f"cold start with {n} songs")
+        print(f"  snapshot build : {build_t:8.2f} s  ({os.path.getsize(snap_path) >> 20} MiB)")
+
+        def from_csv():
+            library = HashTable(size=60)
+            stream_into_library(library, csv_path)
+            return library
+
+        csv_t, from_csv_lib = timed(from_csv)
+        snap_t, snap_lib = timed(lambda: HashTable.from_snapshot(snap_path, size=60), 20)
+        print(f"  CSV startup    : {csv_t * 1000:8.0f} ms")
+        print(f"  snapshot start : {snap_t * 1000:8.2f} ms")
+
+        probe = [f"S{i:07d}" for i in range(0, n, n // 1000)]
+        for label, lib in [("CSV", from_csv_lib), ("snapshot", snap_lib)]:
+            t, _ = timed(lambda: [lib.search(k) for k in probe])
+            print(f"  {label + ' lookup':15}: {t / len(probe) * 1e6:8.1f} us")
+
+
+# ----------------------------------------------------
+# MULTI-WORKER LOAD TEST ON THE SHARED SQLITE STATE
+# ----------------------------------------------------
+def _worker_requests(db_path, n, seed):
+    # runs in a forked worker: a mix of reads, enqueues and plays
+    import app
+
+    app.state = app.SQLiteState(db_path)
+    app.QUEUE_AUTOFILL = 0  # only requested enqueues, for the invariant below
+    client = app.app.test_client()
+    rng = random.Random(seed)
+    enqueued = played = 0
+    for _ in range(n):
+        r = rng.random()
+        if r < 0.5:
+            client.get("/api/v1/queue?limit=20")
+        elif r < 0.75:
+            client.post("/queue", data={"action": "enqueue", "song_id": f"S{rng.randint(1, 60):03d}"})
+            enqueued += 1
+        else:
+            body = client.post("/queue", data={"action": "dequeue"}).get_data(as_text=True)
+            played += "Now playing" in body
+    return enqueued, played
+
+
+def bench_workers(worker_counts=(1, 2, 4), requests_per_worker=2000):
+    import app
+
+    ctx = multiprocessing.get_context("fork")
+    print(f"shared SQLite state, {requests_per_worker} requests per worker (50% reads)")
+    for workers in worker_counts:
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, "state.db")
+            start = time.perf_counter()
+            with ctx.Pool(workers) as pool:
+                results = pool.starmap(
+                    _worker_requests,
+                    [(db_path, requests_per_worker, seed) for seed in range(workers)],
+                )
+            elapsed = time.perf_counter() - start
+
+            # replay the log in a fresh process and check nothing was lost or
+            # played twice: every enqueued song is either queued or in history
+            enqueued = sum(e for e, _ in results)
+            played = sum(p for _, p in results)
+            checker = ctx.Pool(1)
+            queued, in_history = checker.apply(_replayed_sizes, (db_path,))
+            checker.close()
+            assert queued + played == enqueued, (queued, played, enqueued)
+            assert in_history == min(played, app.history.capacity)
+
+            total = workers * requests_per_worker
+            print(
+                f"  {workers} worker(s): {total / elapsed:8.0f} req/s   "
+                f"enqueued {enqueued}, played {played}, still queued {queued}"
+            )
+
+
+def _replayed_sizes(db_path):
+    import app
+
+    app.state = app.SQLiteState(db_path)
+    app.state.sync()
+    return len(app.queue), len(app.history)
+
+
+# ----------------------------------------------------
+# STATE LOG: WRITE LATENCY, COMPACTION AND RECOVERY
+# ----------------------------------------------------
+def _journal_writes(directory, threads, ops, compact_every, wait, library=100_000, songs=20_000):
+    # runs in a fresh process: a library import and a long playlist give
+    # the snapshots some weight, then `threads` writers share the log
+    import contextlib
+
+    import app
+
+    app.state = app.JournalState(directory, compact_every, wait)
+    rows = [
+        [s.song_id, s.title, s.artist, s.album, s.genre, s.duration, s.year]
+        for s in synthetic_songs(library)
+    ]
+    ids = [row[0] for row in rows]
+    latencies = []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        app.state.sync()
+        for i in range(0, len(rows), 5000):
+            app.state.run("library.insert_many", rows[i : i + 5000])
+        for song_id in ids[:songs]:
+            app.state.run("playlist.add_end", song_id)
+        app.state.run("playlists.create", "bench", "mix")
+
+        def writer(t):
+            rng = random.Random(t)
+            mine = []
+            for _ in range(ops):
+                r = rng.random()
+                if r < 0.4:
+                    op = ("queue.enqueue", rng.choice(ids))
+                elif r < 0.7:
+                    op = ("queue.play_next",)
+                elif r < 0.9:
+                    op = ("playlist.move_up", rng.choice(ids[:songs]))
+                else:
+                    op = ("playlists.add", "bench", "mix", [rng.choice(ids)])
+                start = time.perf_counter()
+                app.state.run(*op)
+                mine.append(time.perf_counter() - start)
+            latencies.extend(mine)
+
+        pool = [threading.Thread(target=writer, args=(t,)) for t in range(threads)]
+        start = time.perf_counter()
+        for th in pool:
+            th.start()
+        for th in pool:
+            th.join()
+        elapsed = time.perf_counter() - start
+    if app.state._compactor:
+        app.state._compactor.join()
+    latencies.sort()
+    return latencies, elapsed, app.state.stats()
+
+
+def _journal_recover(directory):
+    import contextlib
+
+    import app
+
+    app.state = app.JournalState(directory, compact_every=10**9)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        app.state.sync()
+    return app.state.recovery, len(app.catalog.library), len(app.playlist)
+
+
+def bench_journal(thread_counts=(1, 8, 32), ops=5000, compact_every=20_000):
+    ctx = multiprocessing.get_context("spawn")
+    print(f"state log writes: {ops} ops per thread, snapshot every {compact_every} ops")
+    runs = [(threads, True) for threads in thread_counts] + [(thread_counts[-1], False)]
+    for threads, wait in runs:
+        with tempfile.TemporaryDirectory() as tmp, ctx.Pool(1) as pool:
+            lat, elapsed, stats = pool.apply(
+                _journal_writes, (tmp, threads, ops, compact_every, wait)
+            )
+            label = f"{threads} thread(s), {'fsync' if wait else 'no wait'}"
+            print(
+                f"  {label:26}: p50 {lat[len(lat) // 2] * 1e6:6.0f} us   "
+                f"p99 {lat[int(len(lat) * 0.99)] * 1e6:6.0f} us   "
+                f"p99.9 {lat[int(len(lat) * 0.999)] * 1e3:6.2f} ms   "
+                f"{len(lat) / elapsed:7.0f} ops/s   "
+                f"{stats['compactions']} snapshots, cut {stats['last_cut_ms']} ms, "
+                f"write {stats['last_snapshot_s']} s"
+            )
+
+    print("recovery (100k imported songs, 20k song playlist)")
+    for label, every, n in [
+        ("log only", 10**9, 10_000),
+        ("log only", 10**9, 40_000),
+        (f"snapshot every {compact_every}", compact_every, 40_000),
+    ]:
+        with tempfile.TemporaryDirectory() as tmp:
+            with ctx.Pool(1) as pool:
+                pool.apply(_journal_writes, (tmp, 4, n, every, True))
+            with ctx.Pool(1) as pool:
+                recovery, songs, playlist_len = pool.apply(_journal_recover, (tmp,))
+            total = recovery["snapshot_seq"] + recovery["replayed_ops"]
+            print(
+                f"  {label:20} {total:7} ops: {recovery['seconds']:6.2f} s   "
+                f"(snapshot {recovery['snapshot_seconds']} s, "
+                f"{recovery['replayed_ops']} ops replayed)"
+            )
+
+
+# ----------------------------------------------------
+# THREAD STRESS: CONCURRENT ROUTES AND INVARIANTS
+# ----------------------------------------------------
+def check_playlist(playlist):
+    forward, node = [], playlist.head
+    while node:
+        forward.append(node.song.song_id)
+        node = playlist.next_node(node)
+    backward, node = [], playlist.tail
+    while node:
+        backward.append(node.song.song_id)
+        node = playlist.prev_node(node)
+    assert forward == backward[::-1], "prev/next links disagree"
+    assert len(forward) == len(playlist) == len(set(forward)), "length or duplicates"
+    assert set(forward) == set(playlist._nodes), "id -> node map out of sync"
+
+
+def stress_hash_table(threads=8, keys_per_thread=3000):
+    table = HashTable(size=60)
+    songs = list(synthetic_songs(threads * keys_per_thread))
+    kept = [set() for _ in range(threads)]
+
+    def worker(t):
+        rng = random.Random(t)
+        mine = songs[t * keys_per_thread : (t + 1) * keys_per_thread]
+        for s in mine:
+            table.insert(s.song_id, s)
+        for s in rng.sample(mine, keys_per_thread // 2):
+            assert table.delete(s.song_id)
+        for s in mine:
+            if table.search(s.song_id) is not None:
+                kept[t].add(s.song_id)
+
+    pool = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    for th in pool:
+        th.start()
+    for th in pool:
+        th.join()
+
+    expected = set().union(*kept)
+    assert len(table) == len(expected) == threads * keys_per_thread // 2
+    assert {s.song_id for s in table.songs()} == expected
+    assert all(table.search(k).song_id == k for k in expected)
+    print(f"  hash table: {threads} threads, {table.stats()}")
+
+
+def stress_routes(threads=8, requests_per_thread=400):
+    import app
+
+    app.catalog.load()
+    app.QUEUE_AUTOFILL = 0  # the queue invariant counts requested enqueues only
+    enqueued, played = [0] * threads, [0] * threads
+
+    def worker(t):
+        client = app.app.test_client()
+        rng = random.Random(t)
+        for _ in range(requests_per_thread):
+            sid = f"S{rng.randint(1, 60):03d}"
+            r = rng.random()
+            if r < 0.2:
+                client.post("/queue", data={"action": "enqueue", "song_id": sid})
+                enqueued[t] += 1
+            elif r < 0.35:
+                body = client.post("/queue", data={"action": "dequeue"}).get_data(as_text=True)
+                played[t] += "Now playing" in body
+            elif r < 0.7:
+                action = rng.choice(["add_end", "add_start", "delete", "move_up", "move_down"])
+                client.post("/playlist", data={"action": action, "song_id": sid})
+            elif r < 0.75:
+                client.post("/playlist", data={"action": "reverse"})
+            elif r < 0.85:
+                client.get("/api/v1/playlist?limit=25")
+            else:
+                client.post("/library", data={"action": "search", "song_id": sid})
+
+    pool = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    for th in pool:
+        th.start()
+    for th in pool:
+        th.join()
+
+    check_playlist(app.playlist)
+    assert sum(played) + len(app.queue) == sum(enqueued), "queue lost or duplicated songs"
+    assert len(app.history) == sum(played)
+    print(
+        f"  routes: {threads} threads x {requests_per_thread} requests, "
+        f"{sum(enqueued)} enqueued, {sum(played)} played, playlist {len(app.playlist)}"
+    )
+
+
+def bench_stress():
+    # switch threads very often to shake out races
+    old = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        print("thread stress")
+        stress_hash_table()
+        stress_routes()
+    finally:
+        sys.setswitchinterval(old)
+
+
+# ----------------------------------------------------
+# SYNC WORKERS VS ASGI UNDER HIGH CONCURRENCY
+# ----------------------------------------------------
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(port, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1) as s:
+                s.sendall(b"GET /ready HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n\r\n")
+                if s.recv(64).startswith(b"HTTP/1.1 200"):
+                    return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"server on port {port} never became ready")
+
+
+async def _client(port, paths, deadline, latencies, errors):
+    # one request per connection: gunicorn's sync workers do not keep alive
+    i = 0
+    while time.perf_counter() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        start = time.perf_counter()
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n\r\n".encode())
+            await writer.drain()
+            response = await reader.read()
+            writer.close()
+        except OSError:
+            errors.append(path)
+            continue
+        if not response.startswith(b"HTTP/1.1 200"):
+            errors.append(path)
+            continue
+        latencies.append(time.perf_counter() - start)
+
+
+async def _load(port, paths, concurrency, seconds):
+    latencies, errors = [], []
+    deadline = time.perf_counter() + seconds
+    await asyncio.gather(
+        *(_client(port, paths, deadline, latencies, errors) for _ in range(concurrency))
+    )
+    return latencies, errors
+
+
+def bench_asgi(concurrency=(16, 128, 512), seconds=5, sync_workers=4):
+    servers = {
+        f"gunicorn sync x{sync_workers}": [
+            "gunicorn", "-w", str(sync_workers), "--backlog", "2048",
+            "--log-level", "warning", "-b", "127.0.0.1:{port}", "app:app",
+        ],
+        "uvicorn asgi": [
+            "uvicorn", "--log-level", "warning", "--backlog", "2048",
+            "--port", "{port}", "asgi:app",
+        ],
+    }
+    missing = [cmd[0] for cmd in servers.values() if not shutil.which(cmd[0])]
+    if missing:
+        print(f"skipping sync vs ASGI benchmark, not installed: {', '.join(missing)}")
+        return
+
+    paths = ["/api/v1/library?limit=100", "/api/v1/queue?limit=20", "/api/v1/history"]
+    print(f"sync workers vs ASGI, {seconds} s per run, GET {', '.join(paths)}")
+    for label, command in servers.items():
+        port = free_port()
+        server = subprocess.Popen(
+            [part.format(port=port) for part in command],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env={**os.environ, "WARM_UP": "1"},
+        )
+        try:
+            wait_ready(port)
+            for clients in concurrency:
+                latencies, errors = asyncio.run(_load(port, paths, clients, seconds))
+                latencies.sort()
+                p99 = latencies[int(len(latencies) * 0.99)] if latencies else float("nan")
+                print(
+                    f"  {label:18} {clients:4} clients: {len(latencies) / seconds:7.0f} req/s   "
+                    f"p99 {p99 * 1000:7.1f} ms   errors {len(errors)}"
+                )
+        finally:
+            server.terminate()
+            server.wait()
+
+
+BENCHMARKS = {
+    "title_index": bench_title_index,
+    "partial_index": bench_partial_index,
+    "search_cache": bench_search_cache,
+    "fuzzy": bench_fuzzy,
+    "query": bench_query,
+    "bulk": bench_bulk,
+    "analytics": bench_analytics,
+    "similar": bench_similar,
+    "cascade": bench_cascade,
+    "playlists": bench_playlists,
+    "queue": bench_queue,
+    "shuffle": bench_shuffle,
+    "memory": bench_memory,
+    "load": bench_load,
+    "snapshot": bench_snapshot,
+    "workers": bench_workers,
+    "journal": bench_journal,
+    "stress": bench_stress,
+    "asgi": bench_asgi,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()